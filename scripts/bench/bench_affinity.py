@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+📊 BENCH: checkpoint-affinity job ordering (images/hour)
+========================================================
+Simulates a factory run whose jobs are spread over several checkpoints and
+compares:
+- fifo:     jobs rendered in submission order (round-robin over checkpoints)
+- affinity: forge_client.JobScheduler draining one checkpoint group at a time
+  (factory.py also groups the whole plan up front, which matches --depths 0)
+
+Swap and render times are simulated on a virtual clock (defaults are typical
+SDXL numbers on a RunPod A40), so no GPU is needed. Pass your own measured
+"Checkpoints: N swaps, Xs" numbers from a factory run to calibrate.
+
+Usage:
+    python3 scripts/bench/bench_affinity.py
+    python3 scripts/bench/bench_affinity.py --jobs 200 --checkpoints 3 --swap 35 --render 22
+"""
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from forge_client import JobScheduler
+
+
+def make_jobs(count, checkpoints, shuffle):
+    names = [f"checkpoint_{i}.safetensors" for i in range(checkpoints)]
+    jobs = [{"model": names[i % checkpoints], "vae": None} for i in range(count)]
+    if shuffle:
+        random.shuffle(jobs)
+    return jobs
+
+
+def simulate(jobs, depth, affinity, swap_s, render_s):
+    """Feed jobs through a JobScheduler of the given depth, as the prompt
+    builder does, and return (swaps, seconds)."""
+    scheduler = JobScheduler(maxsize=depth, affinity=affinity)
+    pending = iter(jobs)
+    loaded = None
+    swaps = 0
+    elapsed = 0.0
+
+    def refill():
+        while scheduler.qsize() < depth:
+            job = next(pending, None)
+            if job is None:
+                scheduler.close()
+                return
+            scheduler.put(job)
+
+    refill()
+    while True:
+        job = scheduler.get(prefer=lambda j: j["model"] == loaded)
+        if job is None:
+            break
+        if job["model"] != loaded:
+            swaps += 1
+            elapsed += swap_s
+            loaded = job["model"]
+        elapsed += render_s
+        refill()
+    return swaps, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark checkpoint-affinity scheduling")
+    parser.add_argument("--jobs", type=int, default=100, help="Render requests in the run")
+    parser.add_argument("--checkpoints", type=int, default=2, help="Distinct checkpoints in the run")
+    parser.add_argument("--swap", type=float, default=30.0, help="Seconds to load an SDXL checkpoint")
+    parser.add_argument("--render", type=float, default=20.0, help="Seconds per render (hires + ADetailer)")
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 8, 0], help="Scheduler buffer sizes (0 = whole plan)")
+    parser.add_argument("--shuffle", action="store_true", help="Random job order instead of round-robin")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    jobs = make_jobs(args.jobs, args.checkpoints, args.shuffle)
+    print(f"{args.jobs} jobs over {args.checkpoints} checkpoints, swap {args.swap:.0f}s, render {args.render:.0f}s\n")
+    print(f"{'mode':>8} | {'depth':>5} | {'swaps':>5} | {'swap time':>9} | {'images/hour':>11}")
+    print("-" * 52)
+    for depth in args.depths:
+        for affinity in (False, True):
+            swaps, seconds = simulate(jobs, depth or len(jobs), affinity, args.swap, args.render)
+            mode = "affinity" if affinity else "fifo"
+            print(f"{mode:>8} | {depth or 'all':>5} | {swaps:>5} | {swaps * args.swap:>8.0f}s | {args.jobs * 3600 / seconds:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
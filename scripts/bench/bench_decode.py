@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+📊 BENCH: txt2img response decoding (buffered vs streaming)
+============================================================
+Compares peak Python memory and wall time of:
+- legacy:    resp.json() + base64.b64decode() per image (old generate_image)
+- streaming: forge_client.stream_json_images() decoding chunks straight to disk
+
+The response body is synthesized on the fly from a small random block, so
+the benchmark itself never holds a full body in memory. No GPU needed.
+
+Usage:
+    python3 scripts/bench/bench_decode.py
+    python3 scripts/bench/bench_decode.py --image-mb 8 --batches 1 2 4 8
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from forge_client import stream_json_images, STREAM_CHUNK_SIZE
+
+BLOCK = base64.b64encode(os.urandom(3 * 4096))  # 16 KiB of valid base64
+
+
+def fake_body_chunks(batch, image_mb, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield a txt2img JSON body in network-sized chunks."""
+    b64_len = (image_mb * 1024 * 1024 * 4 // 3) // len(BLOCK) * len(BLOCK)
+    pending = bytearray(b'{"images": [')
+    for idx in range(batch):
+        pending += b'"'
+        remaining = b64_len
+        while remaining:
+            take = min(remaining, len(BLOCK))
+            pending += BLOCK[:take]
+            remaining -= take
+            while len(pending) >= chunk_size:
+                yield bytes(pending[:chunk_size])
+                del pending[:chunk_size]
+        pending += b'"' + (b", " if idx < batch - 1 else b"")
+    pending += b'], "parameters": {"prompt": "bench"}, "info": "{\\"seed\\": 1}"}'
+    yield bytes(pending)
+
+
+def run_legacy(batch, image_mb, out_dir):
+    # requests' resp.json() joins the whole body, then json.loads it
+    body = b"".join(fake_body_chunks(batch, image_mb))
+    data = json.loads(body)
+    for idx, img_b64 in enumerate(data["images"]):
+        with open(os.path.join(out_dir, f"legacy_{idx}.png"), "wb") as f:
+            f.write(base64.b64decode(img_b64))
+    return len(data["images"])
+
+
+def run_streaming(batch, image_mb, out_dir):
+    def open_image(idx):
+        return open(os.path.join(out_dir, f"stream_{idx}.png"), "wb")
+    count, _ = stream_json_images(fake_body_chunks(batch, image_mb), open_image)
+    return count
+
+
+def measure(fn, batch, image_mb):
+    with tempfile.TemporaryDirectory() as out_dir:
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = fn(batch, image_mb, out_dir)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    assert count == batch
+    return peak / (1024 * 1024), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark txt2img response decoding")
+    parser.add_argument("--image-mb", type=int, default=6, help="Decoded PNG size per image (1664x2432 ≈ 6-8 MB)")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 2, 4], help="batch_size values to test")
+    args = parser.parse_args()
+
+    print(f"Image size: {args.image_mb} MB decoded, chunk size {STREAM_CHUNK_SIZE // 1024} KiB\n")
+    print(f"{'batch':>5} | {'legacy peak':>12} | {'stream peak':>12} | {'legacy time':>11} | {'stream time':>11}")
+    print("-" * 65)
+    for batch in args.batches:
+        legacy_mb, legacy_s = measure(run_legacy, batch, args.image_mb)
+        stream_mb, stream_s = measure(run_streaming, batch, args.image_mb)
+        print(f"{batch:>5} | {legacy_mb:>9.1f} MB | {stream_mb:>9.1f} MB | {legacy_s:>10.2f}s | {stream_s:>10.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+📊 BENCH: factory.py end to end against mock Forge + LLM servers (no GPU)
+=========================================================================
+Starts one bench/mock_forge.py server per --backends, then runs
+factory.main() once per scenario in a child process, with all state
+(caches, queue, trace, stats) in a temp FACTORY_DATA_DIR so the real
+database/ is never touched. Reports per scenario:
+- images/hour and GPU utilisation (mock busy time / wall time)
+- client CPU seconds per image and peak RSS of the factory process
+- mean client-side seconds per job for each traced stage
+
+Numbers are only comparable between runs with the same mock settings; the
+point is to catch regressions in pooling, batching or decoding.
+
+Usage:
+    python3 scripts/bench/bench_factory.py
+    python3 scripts/bench/bench_factory.py --count 24 --backends 2 --latency 1 --image-mb 8
+    python3 scripts/bench/bench_factory.py --scenarios batched --extra "--no-hires"
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_forge import MockForge, add_mock_arguments, mock_kwargs
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = {
+    "sequential": [],
+    "pipelined": ["--pipeline-depth", "2"],
+    "batched": ["--pipeline-depth", "2", "--batch-size", "4"],
+}
+# Client-side stages worth watching (GPU-side phases come from the mock)
+OVERHEAD_STAGES = ["prompt", "llm", "backend_wait", "queue_wait", "transfer", "decode", "write"]
+
+
+def run_factory(argv):
+    """Child process: run factory.main() and write its resource usage to BENCH_RESULT."""
+    sys.path.insert(0, SCRIPTS_DIR)
+    import factory
+
+    sys.argv = ["factory.py"] + argv
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    factory.main()
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    stages = {}
+    try:
+        with open(factory.TRACE_FILE, "r") as f:
+            for line in f:
+                span = json.loads(line)
+                stages.setdefault(span["stage"], []).append(span["seconds"])
+    except (OSError, ValueError):
+        pass
+    jobs = len(stages.get("job", [])) or 1
+    result = {
+        "wall": wall,
+        "cpu": (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        "rss_mb": after.ru_maxrss / 1024,  # Linux reports KiB
+        "images": sum(1 for name in os.listdir(os.environ["BENCH_OUTPUT"]) if name.endswith(".png")),
+        "stages": {stage: sum(values) / jobs for stage, values in stages.items()},
+    }
+    with open(os.environ["BENCH_RESULT"], "w") as f:
+        json.dump(result, f)
+
+
+def run_scenario(argv, args, mocks, verbose):
+    data_dir = tempfile.mkdtemp(prefix="bench_factory_")
+    output_dir = os.path.join(data_dir, "out")
+    os.makedirs(output_dir)
+    urls = [mock.url for mock in mocks]
+    env = dict(os.environ, **{
+        "FACTORY_DATA_DIR": data_dir,
+        "BENCH_OUTPUT": output_dir,
+        "BENCH_RESULT": os.path.join(data_dir, "result.json"),
+        "REFORGE_API": urls[0],
+        "FORGE_BACKENDS": ",".join(urls),
+        "GROQ_KEY": "mock",
+        "OPENROUTER_KEY": "mock",
+        "GROQ_API_URL": f"{urls[0]}/v1/chat/completions",
+        "OPENROUTER_API_URL": f"{urls[0]}/v1/chat/completions",
+        "PROMPT_CACHE": "false",
+        "PROMPT_POOL": "false",
+        "RESULT_CACHE": "false",
+    })
+    factory_argv = ["--count", str(args.count), "--output", output_dir] + argv + shlex.split(args.extra)
+    busy_before = [mock.busy_seconds for mock in mocks]
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(factory_argv)],
+                       env=env, stdout=None if verbose else subprocess.DEVNULL, timeout=args.timeout, check=True)
+        with open(env["BENCH_RESULT"], "r") as f:
+            result = json.load(f)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    busy = max(mock.busy_seconds - before for mock, before in zip(mocks, busy_before))
+    result["gpu_util"] = busy / result["wall"] if result["wall"] else 0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark factory.py end to end against mock servers")
+    parser.add_argument("--count", type=int, default=12, help="Images per scenario")
+    parser.add_argument("--backends", type=int, default=1, help="Mock Forge servers (FORGE_BACKENDS)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--extra", default="", help="Extra factory.py flags for every scenario")
+    parser.add_argument("--timeout", type=float, default=1800, help="Seconds before a scenario is abandoned")
+    parser.add_argument("--verbose", action="store_true", help="Show factory output")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    if args.child:
+        run_factory(json.loads(args.child))
+        return
+
+    mocks = [MockForge(**mock_kwargs(args)).start() for _ in range(max(1, args.backends))]
+    print(f"{args.count} images/scenario, {len(mocks)} mock backend(s), {args.latency:g}s/image, "
+          f"{args.image_mb:g} MB PNGs, LLM {args.llm_latency:g}s, fail rate {args.fail_rate:g}\n")
+    print(f"{'scenario':>10} | {'images':>6} | {'images/hour':>11} | {'GPU util':>8} | {'CPU/image':>9} | {'peak RSS':>9}")
+    print("-" * 70)
+    stage_rows = []
+    try:
+        for name in args.scenarios:
+            result = run_scenario(SCENARIOS[name], args, mocks, args.verbose)
+            images = result["images"]
+            rate = images * 3600 / result["wall"] if result["wall"] else 0
+            print(f"{name:>10} | {images:>6} | {rate:>11.1f} | {result['gpu_util']:>7.0%} | "
+                  f"{result['cpu'] / max(images, 1):>8.3f}s | {result['rss_mb']:>6.0f} MB")
+            stage_rows.append((name, result["stages"]))
+    finally:
+        for mock in mocks:
+            mock.stop()
+
+    print("\nMean seconds per job (client side):")
+    print(f"{'scenario':>10} | " + " | ".join(f"{stage:>12}" for stage in OVERHEAD_STAGES))
+    print("-" * (13 + 15 * len(OVERHEAD_STAGES)))
+    for name, stages in stage_rows:
+        print(f"{name:>10} | " + " | ".join(f"{stages.get(stage, 0):>11.3f}s" for stage in OVERHEAD_STAGES))
+
+
+if __name__ == "__main__":
+    main()
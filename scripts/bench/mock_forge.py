@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+🧪 MOCK FORGE - Local stand-in for the Forge and LLM APIs factory.py calls
+==========================================================================
+Serves the /sdapi/v1/* endpoints factory.py uses plus an OpenAI-style
+/v1/chat/completions (Groq and OpenRouter are pointed at it through
+GROQ_API_URL / OPENROUTER_API_URL), so factory runs end to end on a
+CPU-only box.
+
+Behaves like one GPU: renders are serialized, take --latency seconds per
+image (extra batch images cost --batch-cost of that), checkpoint changes
+sleep --swap seconds, /progress reports sampling steps while rendering and
+a --fail-rate share of txt2img calls answer HTTP 500. Images are real PNGs
+of about --image-mb MB (incompressible pixels, so decode/write cost is real).
+
+Usage:
+    python3 scripts/bench/mock_forge.py --port 7861 --latency 2 --image-mb 6
+    REFORGE_API=http://127.0.0.1:7861 GROQ_KEY=mock GROQ_API_URL=http://127.0.0.1:7861/v1/chat/completions \\
+        python3 scripts/factory.py --count 4
+"""
+
+import os
+import json
+import time
+import zlib
+import base64
+import random
+import struct
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CHECKPOINTS = ["waiIllustriousSDXL_v160.safetensors", "oneObsession_v15.safetensors"]
+PROMPT_WORDS = ["1girl", "solo", "gothic dress", "moonlit balcony", "red eyes", "long hair", "lace gloves",
+                "cathedral", "candlelight", "rose petals", "looking at viewer", "night sky", "smile"]
+RENDER_STEPS = 28
+
+
+def make_png(image_mb):
+    """Valid RGB PNG of roughly image_mb MB whose pixels do not compress."""
+    width = 1024
+    height = max(1, int(image_mb * 1024 * 1024) // (width * 3 + 1))
+    row = width * 3
+    raw = b"".join(b"\x00" + os.urandom(row) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 0)) + chunk(b"IEND", b""))
+
+
+class MockForge:
+    """One fake Forge server (+ LLM endpoint) on a background thread."""
+
+    def __init__(self, port=0, latency=2.0, image_mb=6.0, fail_rate=0.0, batch_cost=0.6, swap=8.0,
+                 llm_latency=0.8, llm_fail_rate=0.0, vram_gb=24):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.batch_cost = batch_cost
+        self.swap = swap
+        self.llm_latency = llm_latency
+        self.llm_fail_rate = llm_fail_rate
+        self.vram_gb = vram_gb
+        self.image_b64 = base64.b64encode(make_png(image_mb))
+        self.options = {"sd_model_checkpoint": CHECKPOINTS[0], "sd_vae": "Automatic"}
+        self.gpu = threading.Lock()
+        self.rendering = None  # (start, seconds) of the current render
+        self.busy_seconds = 0.0
+        self.renders = 0
+        self.failures = 0
+        self.llm_calls = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _gpu_work(self, seconds):
+        """Hold the GPU for seconds (renders and checkpoint loads never overlap)."""
+        with self.gpu:
+            self.rendering = (time.time(), seconds)
+            time.sleep(seconds)
+            self.rendering = None
+            self.busy_seconds += seconds
+
+    def _progress(self):
+        current = self.rendering
+        if not current:
+            return {"progress": 0, "state": {"job_count": 0, "sampling_step": 0, "sampling_steps": 0}}
+        done = min(1.0, (time.time() - current[0]) / current[1]) if current[1] else 1.0
+        return {"progress": done,
+                "state": {"job_count": 1, "sampling_step": max(1, int(done * RENDER_STEPS)), "sampling_steps": RENDER_STEPS}}
+
+    def _txt2img(self, body):
+        images = max(1, int(body.get("batch_size", 1))) * max(1, int(body.get("n_iter", 1)))
+        checkpoint = (body.get("override_settings") or {}).get("sd_model_checkpoint")
+        if checkpoint and checkpoint != self.options["sd_model_checkpoint"]:
+            self._gpu_work(self.swap)
+            self.options["sd_model_checkpoint"] = checkpoint
+        self._gpu_work(self.latency * (1 + self.batch_cost * (images - 1)))
+        if random.random() < self.fail_rate:
+            self.failures += 1
+            return 500, b'{"error": "OutOfMemoryError", "detail": "mock failure"}'
+        self.renders += 1
+        seed = body.get("seed", -1)
+        if seed in (-1, None):
+            seed = random.randint(0, 2**32 - 1)
+        info = json.dumps({"seed": seed, "all_seeds": [seed + i for i in range(images)]})
+        parts = [b'{"images": [', b", ".join([b'"' + self.image_b64 + b'"'] * images),
+                 b'], "parameters": {}, "info": ', json.dumps(info).encode(), b"}"]
+        return 200, b"".join(parts)
+
+    def _chat(self, body):
+        time.sleep(self.llm_latency)
+        self.llm_calls += 1
+        if random.random() < self.llm_fail_rate:
+            return 503, b'{"error": {"message": "mock overload"}}'
+        content = ", ".join(random.sample(PROMPT_WORDS, 8))
+        return 200, json.dumps({"model": body.get("model"),
+                                "choices": [{"message": {"role": "assistant", "content": content}}]}).encode()
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like Forge behind uvicorn
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, obj):
+                self._send(200, json.dumps(obj).encode())
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/sdapi/v1/sd-models":
+                    self._json([{"title": name, "model_name": name.split(".")[0]} for name in CHECKPOINTS])
+                elif path == "/sdapi/v1/loras":
+                    self._json([{"name": "aesthetic_quality_masterpiece"}, {"name": "perfect_hands"}])
+                elif path == "/sdapi/v1/scripts":
+                    self._json({"txt2img": ["adetailer"], "img2img": []})
+                elif path == "/sdapi/v1/samplers":
+                    self._json([{"name": "Euler a"}, {"name": "DPM++ 2M Karras"}])
+                elif path == "/sdapi/v1/upscalers":
+                    self._json([{"name": "R-ESRGAN 4x+ Anime6B"}])
+                elif path == "/sdapi/v1/options":
+                    self._json(mock.options)
+                elif path == "/sdapi/v1/memory":
+                    total = mock.vram_gb * 1024**3
+                    self._json({"cuda": {"system": {"free": total * 0.9, "total": total}}})
+                elif path == "/sdapi/v1/progress":
+                    self._json(mock._progress())
+                else:
+                    self._send(404, b'{"detail": "Not Found"}')
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = {}
+                path = self.path.split("?")[0]
+                if path in ("/sdapi/v1/txt2img", "/sdapi/v1/img2img"):  # Finalize sends drafts through img2img
+                    self._send(*mock._txt2img(body))
+                elif path == "/sdapi/v1/options":
+                    checkpoint = body.get("sd_model_checkpoint")
+                    if checkpoint and checkpoint != mock.options["sd_model_checkpoint"]:
+                        mock._gpu_work(mock.swap)
+                    mock.options.update(body)
+                    self._json({})
+                elif path.endswith("/chat/completions"):
+                    self._send(*mock._chat(body))
+                else:
+                    self._json({})
+
+        return Handler
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--latency", type=float, default=2.0, help="GPU seconds per image")
+    parser.add_argument("--image-mb", type=float, default=6.0, help="PNG size per image")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of txt2img calls answering 500")
+    parser.add_argument("--batch-cost", type=float, default=0.6, help="Cost of each extra batch image vs the first")
+    parser.add_argument("--swap", type=float, default=8.0, help="Seconds to load another checkpoint")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="Seconds per chat completion")
+    parser.add_argument("--llm-fail-rate", type=float, default=0.0, help="Share of chat completions answering 503")
+    parser.add_argument("--vram-gb", type=float, default=24, help="GPU memory reported by /sdapi/v1/memory")
+
+
+def mock_kwargs(args):
+    return {"latency": args.latency, "image_mb": args.image_mb, "fail_rate": args.fail_rate,
+            "batch_cost": args.batch_cost, "swap": args.swap, "llm_latency": args.llm_latency,
+            "llm_fail_rate": args.llm_fail_rate, "vram_gb": args.vram_gb}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Forge + LLM server for offline factory runs")
+    parser.add_argument("--port", type=int, default=7861)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    mock = MockForge(port=args.port, **mock_kwargs(args)).start()
+    print(f"🧪 Mock Forge at {mock.url} (chat completions at {mock.url}/v1/chat/completions)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
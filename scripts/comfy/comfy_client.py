@@ -1,17 +1,241 @@
 import websocket # NOTE: pip install websocket-client
 import uuid
 import json
-import urllib.request
-import urllib.parse
-import random
 import os
+import sys
 import time
+import math
+import asyncio
+import threading
+import requests
+
+try:
+    import aiohttp  # AsyncComfyClient only (installed with discord.py)
+except ImportError:
+    aiohttp = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # scripts/ (result_cache)
+from result_cache import ResultCache, canonical_hash
+
+VIEW_CHUNK_SIZE = 1024 * 1024  # /view downloads are streamed to disk in 1 MiB chunks
+WS_SAVE_NODES = ("SaveImageWebsocket",)
+BINARY_HEADER_BYTES = 8  # Event type + image format ahead of the image in a binary frame
+
+# === MULTI-SERVER BALANCING (ComfyBalancer) ===
+COMFY_POLL_INTERVAL = float(os.getenv("COMFY_POLL_INTERVAL", "2"))  # Seconds between /queue + /system_stats polls
+COMFY_MODELS_TTL = float(os.getenv("COMFY_MODELS_TTL", "300"))  # Seconds before /object_info is re-read
+COMFY_RETRY_AFTER = float(os.getenv("COMFY_RETRY_AFTER", "15"))  # Seconds before re-polling a lost endpoint
+COMFY_ACQUIRE_TIMEOUT = 120  # Seconds to wait for any endpoint to come back
+COMFY_MAX_OVERTAKES = int(os.getenv("COMFY_MAX_OVERTAKES", "4"))  # Times a queued prompt may be jumped for cache affinity
+MODEL_LOADERS = {"ckpt_name": "CheckpointLoaderSimple", "unet_name": "UNETLoader"}  # Input -> node in /object_info
+
+class WorkflowTemplate:
+    """An API-format workflow parsed once, with its injection points resolved.
+
+    Injection points are found by node title (_meta.title containing "seed",
+    "positive", "negative", "size"/"resolution"), falling back to the old
+    heuristics: sampler nodes with a seed input, CLIPTextEncode nodes holding
+    the POSITIVE_PROMPT / NEGATIVE_PROMPT placeholders (or empty text) and
+    EmptyLatentImage for the size. apply() copies only the touched nodes; the
+    rest of the graph is shared with the template and must not be mutated.
+    UI-only _meta is dropped after parsing, and an empty negative prompt
+    keeps the workflow's own, so loaders and encoders are identical from
+    job to job and stay in ComfyUI's execution cache.
+    Templates are cached by path and mtime (WorkflowTemplate.load)."""
+
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, graph, name="workflow"):
+        if not isinstance(graph, dict) or "nodes" in graph:
+            raise ValueError(f"{name} is not an API-format workflow (use 'Save (API Format)' in ComfyUI)")
+        self.graph = graph
+        self.name = name
+        self.points = {"seed": [], "positive": [], "negative": [], "size": []}
+        titled = {key: [] for key in self.points}
+        for node_id, node in graph.items():
+            class_type = node.get("class_type", "")
+            inputs = node.get("inputs", {})
+            title = (node.get("_meta") or {}).get("title", "").lower()
+            text = inputs.get("text")
+            seed_inputs = [name for name in ("seed", "noise_seed") if name in inputs and not isinstance(inputs[name], list)]
+            has_size = "width" in inputs and "height" in inputs
+
+            if "seed" in title and seed_inputs:
+                titled["seed"].append((node_id, seed_inputs))
+            if isinstance(text, str) and "positive" in title:
+                titled["positive"].append(node_id)
+            elif isinstance(text, str) and "negative" in title:
+                titled["negative"].append(node_id)
+            if has_size and ("size" in title or "resolution" in title):
+                titled["size"].append(node_id)
+
+            # Heuristics (untitled workflows)
+            if "Sampler" in class_type and seed_inputs:
+                self.points["seed"].append((node_id, seed_inputs))
+            if "CLIPTextEncode" in class_type and isinstance(text, str):
+                if "POSITIVE_PROMPT" in text or text == "":
+                    self.points["positive"].append(node_id)
+                elif "NEGATIVE_PROMPT" in text:
+                    self.points["negative"].append(node_id)
+            if has_size and "EmptyLatentImage" in class_type:
+                self.points["size"].append(node_id)
+
+        for key, nodes in titled.items():
+            if nodes:
+                self.points[key] = nodes
+        self.graph = {node_id: {k: v for k, v in node.items() if k != "_meta"} for node_id, node in graph.items()}
+        if not self.points["positive"]:
+            print(f"⚠️ {name}: no positive prompt node (title 'Positive ...' or POSITIVE_PROMPT placeholder)")
+
+    @classmethod
+    def load(cls, workflow_path):
+        """Template for a workflow file, re-parsed only when the file changes."""
+        stat = os.stat(workflow_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with cls._lock:
+            cached = cls._cache.get(workflow_path)
+            if cached and cached[0] == stamp:
+                return cached[1]
+        with open(workflow_path, 'r', encoding='utf-8') as f:
+            template = cls(json.load(f), name=os.path.basename(workflow_path))
+        with cls._lock:
+            cls._cache[workflow_path] = (stamp, template)
+        return template
+
+    def apply(self, prompt_text, negative_prompt="", seed=None, width=None, height=None):
+        """Graph for one job: a shallow copy with only the injected fields written."""
+        writes = {}
+        for node_id, names in self.points["seed"]:
+            for name in names:
+                writes.setdefault(node_id, {})[name] = seed
+        for node_id in self.points["positive"]:
+            writes.setdefault(node_id, {})["text"] = prompt_text
+        for node_id in self.points["negative"]:
+            if negative_prompt or "NEGATIVE_PROMPT" in self.graph[node_id]["inputs"]["text"]:
+                writes.setdefault(node_id, {})["text"] = negative_prompt
+        if width and height:
+            for node_id in self.points["size"]:
+                writes.setdefault(node_id, {}).update(width=width, height=height)
+
+        workflow = dict(self.graph)
+        for node_id, fields in writes.items():
+            node = dict(workflow[node_id])
+            node["inputs"] = dict(node["inputs"], **fields)
+            workflow[node_id] = node
+        return workflow
+
+def prepare_workflow(workflow_path, prompt_text, negative_prompt="", seed=None, width=None, height=None):
+    """Workflow graph for one job with prompts, seed and optional size injected.
+    Without a seed it is derived from the request, so a repeated request (same
+    workflow, prompts and size, e.g. a Discord user re-sending !gen) is the same
+    graph and comes from the result cache. Returns (workflow, seed); workflow is
+    None if the file is missing or not an API-format workflow."""
+    if seed is None:
+        request = [os.path.abspath(workflow_path), prompt_text, negative_prompt, width, height]
+        seed = int(canonical_hash(request)[:12], 16) % 1000000000000 + 1
+    if not os.path.exists(workflow_path):
+        print(f"❌ Workflow not found: {workflow_path}")
+        return None, seed
+    try:
+        template = WorkflowTemplate.load(workflow_path)
+    except (OSError, ValueError) as e:
+        print(f"❌ Cannot load workflow: {e}")
+        return None, seed
+    return template.apply(prompt_text, negative_prompt, seed, width, height), seed
+
+def websocket_save_nodes(workflow):
+    """Node ids whose images arrive as binary websocket frames instead of files."""
+    return {node_id for node_id, node in workflow.items() if node.get("class_type") in WS_SAVE_NODES}
+
+def output_files(outputs, seed, output_dir):
+    """Yield (filename, out_path, source) for every image of a prompt: source is
+    the PNG bytes for SaveImageWebsocket frames, else the /view image entry."""
+    for node_id, output in outputs.items():
+        for idx, data in enumerate(output.get('ws_images', [])):
+            filename = f"ws_{node_id}_{idx:05d}.png"
+            yield filename, os.path.join(output_dir, f"comfy_{seed}_{filename}"), data
+        for image in output.get('images', []):
+            yield image['filename'], os.path.join(output_dir, f"comfy_{seed}_{image['filename']}"), image
+
+def required_models(workflow):
+    """{loader input: {model file, ...}} the graph loads, for the inputs in MODEL_LOADERS."""
+    required = {}
+    for node in workflow.values():
+        for input_name, value in node.get("inputs", {}).items():
+            if input_name in MODEL_LOADERS and isinstance(value, str):
+                required.setdefault(input_name, set()).add(value)
+    return required
+
+def affinity_key(workflow):
+    """(model files, prompt texts) of a graph. Prompts with the same key that run
+    back to back reuse ComfyUI's cached loaders and text encoders."""
+    models = []
+    texts = []
+    for node in workflow.values():
+        for input_name, value in node.get("inputs", {}).items():
+            if isinstance(value, str):
+                if input_name in MODEL_LOADERS:
+                    models.append(value)
+                elif input_name == "text":
+                    texts.append(value)
+    return tuple(sorted(models)), tuple(sorted(texts))
+
+def canonical_json(obj):
+    """Compact, key-sorted JSON: unchanged nodes serialize to the same bytes every job."""
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def view_params(image):
+    return {"filename": image['filename'], "subfolder": image['subfolder'], "type": image['type']}
+
+def restore_cached(result_cache, cached, seed, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    generated_files = []
+    for src, filename in zip(cached["paths"], cached["meta"].get("filenames", [])):
+        out_path = os.path.join(output_dir, f"comfy_{seed}_{filename}")
+        if not os.path.exists(out_path):
+            result_cache.restore(src, out_path)
+        generated_files.append(out_path)
+    return generated_files
+
+class NodeCacheStats:
+    """Per-node ComfyUI execution cache hits: 'execution_cached' lists the nodes
+    reused from the previous prompt, 'executing' names each node that ran."""
+
+    def __init__(self):
+        self.nodes = {}  # "ClassType #id" -> [cached, executed]
+
+    @staticmethod
+    def _label(workflow, node_id):
+        return f"{(workflow.get(node_id) or {}).get('class_type', '?')} #{node_id}"
+
+    def cached(self, workflow, node_ids):
+        for node_id in node_ids:
+            self.nodes.setdefault(self._label(workflow, node_id), [0, 0])[0] += 1
+
+    def executed(self, workflow, node_id):
+        self.nodes.setdefault(self._label(workflow, node_id), [0, 0])[1] += 1
+
+    def summary(self):
+        cached = sum(c for c, _ in self.nodes.values())
+        total = cached + sum(e for _, e in self.nodes.values())
+        rate = (cached / total * 100) if total else 0
+        return f"{cached}/{total} node runs from ComfyUI's cache ({rate:.0f}%)"
+
+    def summary_lines(self):
+        lines = []
+        for label, (cached, executed) in sorted(self.nodes.items(), key=lambda item: -sum(item[1])):
+            lines.append(f"{label}: {cached}/{cached + executed} cached ({cached / (cached + executed):.0%})")
+        return lines
 
 class ComfyClient:
-    def __init__(self, server_address="127.0.0.1:8188"):
+    def __init__(self, server_address="127.0.0.1:8188", result_cache=None, cache_stats=None):
         self.server_address = server_address
         self.client_id = str(uuid.uuid4())
         self.ws = None
+        self.http = requests.Session()  # Keep-alive for /view downloads
+        self.result_cache = result_cache or ResultCache()
+        self.cache_stats = cache_stats or NodeCacheStats()
 
     def connect(self):
         """Establishes websocket connection"""
@@ -27,27 +251,36 @@ class ComfyClient:
     def queue_prompt(self, prompt_workflow):
         """Sends the workflow (JSON) to the queue"""
         p = {"prompt": prompt_workflow, "client_id": self.client_id}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
-        return json.loads(urllib.request.urlopen(req).read())
+        response = self.http.post(f"http://{self.server_address}/prompt", data=canonical_json(p).encode('utf-8'),
+                                  headers={"Content-Type": "application/json"})
+        response.raise_for_status()
+        return response.json()
 
     def get_image(self, filename, subfolder, folder_type):
         """Downloads the generated image"""
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"http://{self.server_address}/view?{url_values}") as response:
-            return response.read()
+        response = self.http.get(f"http://{self.server_address}/view", params=data)
+        response.raise_for_status()
+        return response.content
+
+    def download_image(self, image, out_path):
+        """Streams a /view download to out_path without holding the file in memory"""
+        with self.http.get(f"http://{self.server_address}/view", params=view_params(image), stream=True) as response:
+            response.raise_for_status()
+            _save_chunks(response.iter_content(VIEW_CHUNK_SIZE), out_path)
 
     def get_history(self, prompt_id):
         """Gets execution history for a prompt ID"""
-        with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+        response = self.http.get(f"http://{self.server_address}/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
 
-    def generate(self, workflow_path, prompt_text, negative_prompt="", seed=None, output_dir="output"):
+    def generate(self, workflow_path, prompt_text, negative_prompt="", seed=None, output_dir="output",
+                 width=None, height=None):
         """
         Main generation function.
-        1. Loads workflow JSON.
-        2. Injects prompts and seed.
+        1. Loads workflow template (cached, re-read only when the file changes).
+        2. Injects prompts, seed and optional size.
         3. Queues job.
         4. Waits for result.
         5. Downloads image.
@@ -55,94 +288,620 @@ class ComfyClient:
         if not self.ws and not self.connect():
             return None
 
-        if not os.path.exists(workflow_path):
-            print(f"❌ Workflow not found: {workflow_path}")
+        workflow, seed = prepare_workflow(workflow_path, prompt_text, negative_prompt, seed, width, height)
+        if workflow is None:
             return None
-            
-        with open(workflow_path, 'r', encoding='utf-8') as f:
-            workflow = json.load(f)
-
-        # === INJECTION MAGIC ===
-        # We need to find the KSampler, CLIP Text Encode, etc.
-        # This is heuristics-based since node IDs change.
-        # Ideally, we tag nodes in ComfyUI, but for raw JSON we iterate types.
-        
-        if seed is None:
-            seed = random.randint(1, 1000000000000)
 
-        loader_node = None
-        pos_node = None
-        neg_node = None
-        seed_node = None
-        
-        for node_id, node in workflow.items():
-            class_type = node.get("class_type", "")
-            inputs = node.get("inputs", {})
-            
-            # Find KSampler (for seed)
-            if "KSampler" in class_type or "Sampler" in class_type:
-                if "seed" in inputs:
-                    inputs["seed"] = seed
-                    # Also set random generation to 'fixed' to ensure our seed works
-                    # inputs["control_after_generate"] = "fixed" 
-                    seed_node = node_id
-
-            # Find Prompts (CLIPTextEncode)
-            # Heuristic: Positive usually connects to KSampler 'positive', Negative to 'negative'
-            # But simpler: check text content placeholders if they exist, OR
-            # Just look for the boxes. 
-            # FOR NOW: We assume the user has put "POSITIVE_PROMPT" and "NEGATIVE_PROMPT" 
-            # strings in the workflow JSON as placeholders.
-            if "CLIPTextEncode" in class_type:
-                text_val = inputs.get("text", "")
-                if isinstance(text_val, str):
-                    if "POSITIVE_PROMPT" in text_val or text_val == "":
-                        inputs["text"] = prompt_text
-                        pos_node = node_id
-                    elif "NEGATIVE_PROMPT" in text_val:
-                        inputs["text"] = negative_prompt
-                        neg_node = node_id
+        # Identical graph (prompts + seed injected) already rendered → serve from disk
+        cache_key = self.result_cache.key(workflow)
+        cached = self.result_cache.get(cache_key)
+        if cached:
+            print(f"🗄️ Result cache hit ({cache_key[:12]}), skipping ComfyUI")
+            return restore_cached(self.result_cache, cached, seed, output_dir)
 
         # Send to Queue
         print(f"🚀 Queuing Prompt (Seed: {seed})...")
         prompt_res = self.queue_prompt(workflow)
         prompt_id = prompt_res['prompt_id']
         
-        # Wait for completion via WebSocket
+        # Wait for completion via WebSocket, collecting outputs as nodes finish
+        ws_nodes = websocket_save_nodes(workflow)
+        outputs = {}
+        current_node = None
         while True:
             out = self.ws.recv()
             if isinstance(out, str):
                 message = json.loads(out)
+                data = message.get('data') or {}
+                if data.get('prompt_id') != prompt_id:
+                    continue
                 if message['type'] == 'executing':
-                    data = message['data']
-                    if data['node'] is None and data['prompt_id'] == prompt_id:
+                    current_node = data['node']
+                    if current_node is None:
                         print("✨ Generation Complete!")
                         break # Execution done
+                    self.cache_stats.executed(workflow, current_node)
+                elif message['type'] == 'execution_cached':
+                    self.cache_stats.cached(workflow, data.get('nodes') or [])
+                elif message['type'] == 'executed':
+                    outputs.setdefault(data['node'], {}).update(data.get('output') or {})
+                elif message['type'] in ('execution_error', 'execution_interrupted'):
+                    print(f"❌ ComfyUI generation failed: {data.get('exception_message', 'interrupted').strip()}")
+                    return None
+            elif current_node in ws_nodes and len(out) > BINARY_HEADER_BYTES:
+                # SaveImageWebsocket output: the PNG itself, no /view round trip
+                outputs.setdefault(current_node, {}).setdefault('ws_images', []).append(out[BINARY_HEADER_BYTES:])
+
+        if not outputs:
+            # Everything came from ComfyUI's cache: no 'executed' messages
+            outputs = self.get_history(prompt_id)[prompt_id]['outputs']
+
+        os.makedirs(output_dir, exist_ok=True)
+        generated_files = []
+        filenames = []
+        for filename, out_path, source in output_files(outputs, seed, output_dir):
+            if isinstance(source, bytes):
+                _save_chunks([source], out_path)
             else:
-                continue # Binary data (previews)
+                print(f"📥 Downloading {filename}...")
+                self.download_image(source, out_path)
+            generated_files.append(out_path)
+            filenames.append(filename)
 
-        # Get Result Filename from History
-        history = self.get_history(prompt_id)[prompt_id]
-        outputs = history['outputs']
-        
+        try:
+            self.result_cache.put(cache_key, generated_files, {"filenames": filenames})
+        except OSError as e:
+            print(f"⚠️ Result cache store failed: {e}")
+        return generated_files
+
+
+class ComfyExecutionError(Exception):
+    """ComfyUI reported execution_error / execution_interrupted for a prompt."""
+
+    def __init__(self, prompt_id, message, node_id=None):
+        super().__init__(f"{message} (node {node_id})" if node_id else message)
+        self.prompt_id = prompt_id
+        self.node_id = node_id
+
+
+class AsyncComfyClient:
+    """asyncio client: any number of prompts in flight on one websocket.
+
+    submit() queues a workflow and returns a future per prompt_id; a single
+    reader task routes executing / executed / execution_error messages to the
+    right future, which resolves to the prompt's node outputs (as in /history).
+    SaveImageWebsocket frames are attributed to the node ComfyUI is executing
+    and land in outputs[node_id]['ws_images'] as PNG bytes.
+
+    Graphs are posted as canonical JSON. A prompt sharing the checkpoint and
+    prompt texts (else just the checkpoint) of one running or still waiting in
+    ComfyUI's queue gets a /prompt "number" right behind it, so the two run
+    back to back on cached loaders / encoders; no queued prompt is jumped more
+    than COMFY_MAX_OVERTAKES times. Per-node cache hits are kept in cache_stats.
+
+        comfy = AsyncComfyClient("127.0.0.1:8188")
+        await comfy.connect()
+        futures = [await comfy.submit(wf) for wf in workflows]   # queue stays full
+        outputs = await futures[0]
+        files = await comfy.generate(WORKFLOW_PATH, "1girl, ...")  # submit + download
+    """
+
+    def __init__(self, server_address="127.0.0.1:8188", result_cache=None, cache_stats=None):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.result_cache = result_cache or ResultCache()
+        self.cache_stats = cache_stats or NodeCacheStats()
+        self.session = None
+        self.ws = None
+        self._reader = None
+        self._futures = {}   # prompt_id -> Future
+        self._outputs = {}   # prompt_id -> {node_id: output} from 'executed'
+        self._finished = {}  # prompt_id -> outputs/exception that arrived before submit() registered it
+        self._done = {}      # prompt_id -> None for recently finished prompts (ordered set, bounded)
+        self._ws_nodes = {}  # prompt_id -> SaveImageWebsocket node ids
+        self._executing = (None, None)  # (prompt_id, node_id) ComfyUI is running now
+        self._graphs = {}    # prompt_id -> submitted workflow (node classes for cache_stats)
+        self._pending = {}   # prompt_id -> [queue number, affinity key, times overtaken] until it starts
+        self._running = None  # [queue number, affinity key, 0] of our prompt ComfyUI ran last (its cache)
+        self._submit_lock = None
+        self._connect_lock = None
+
+    async def connect(self):
+        """Open the HTTP session + websocket and start the reader task."""
+        if aiohttp is None:
+            raise RuntimeError("AsyncComfyClient needs aiohttp (pip install aiohttp)")
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._submit_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.ws is not None and not self.ws.closed:
+                return True
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            try:
+                self.ws = await self.session.ws_connect(
+                    f"ws://{self.server_address}/ws?clientId={self.client_id}", heartbeat=30, max_msg_size=0)
+            except (aiohttp.ClientError, OSError) as e:
+                print(f"❌ Failed to connect to ComfyUI: {e}")
+                return False
+            self._reader = asyncio.create_task(self._read_loop(self.ws))
+            print(f"✅ Connected to ComfyUI at {self.server_address}")
+            return True
+
+    async def close(self):
+        if self._reader:
+            self._reader.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+        self.ws = self.session = self._reader = None
+
+    async def queue_prompt(self, prompt_workflow, prompt_id=None, number=None):
+        """POST the workflow; returns ComfyUI's response ({"prompt_id": ..., "number": ...}).
+        number is the queue priority (lowest runs first; default: end of the queue)."""
+        payload = {"prompt": prompt_workflow, "client_id": self.client_id}
+        if prompt_id:
+            payload["prompt_id"] = prompt_id
+        if number is not None:
+            payload["number"] = number
+        async with self.session.post(f"http://{self.server_address}/prompt", data=canonical_json(payload).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"}) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def submit(self, prompt_workflow):
+        """Queue a workflow; returns an asyncio.Future resolving to its node outputs
+        (raises ComfyExecutionError / ConnectionError on failure)."""
+        if not await self.connect():
+            raise ConnectionError(f"ComfyUI not reachable at {self.server_address}")
+        # Our own prompt_id, so messages and binary frames can be routed before the POST returns
+        prompt_id = str(uuid.uuid4())
+        ws_nodes = websocket_save_nodes(prompt_workflow)
+        if ws_nodes:
+            self._ws_nodes[prompt_id] = ws_nodes
+        self._graphs[prompt_id] = prompt_workflow
+        key = affinity_key(prompt_workflow)
+        # One POST at a time, so each queue number sees every prompt queued before it
+        async with self._submit_lock:
+            try:
+                queued = await self.queue_prompt(prompt_workflow, prompt_id, self._queue_number(key))
+            except BaseException:
+                self._ws_nodes.pop(prompt_id, None)
+                self._graphs.pop(prompt_id, None)
+                raise
+            queued_id = queued['prompt_id']
+            if queued_id != prompt_id:
+                # Older ComfyUI ignores client prompt ids
+                for routes in (self._ws_nodes, self._graphs):
+                    if prompt_id in routes:
+                        routes[queued_id] = routes.pop(prompt_id)
+            prompt_id = queued_id
+            if queued.get('number') is not None and prompt_id not in self._finished and self._executing[0] != prompt_id:
+                self._pending[prompt_id] = [float(queued['number']), key, 0]
+        future = asyncio.get_running_loop().create_future()
+        future.prompt_id = prompt_id
+        if prompt_id in self._finished:
+            self._settle(future, self._finished.pop(prompt_id))
+        else:
+            self._futures[prompt_id] = future
+        return future
+
+    def _queue_number(self, key):
+        """Queue number right behind our last waiting prompt with the same affinity
+        key (models + texts, else models only), or None to append."""
+        pending = sorted(self._pending.values(), key=lambda p: p[0])
+        candidates = ([self._running] if self._running else []) + pending
+        for same in (lambda k: k == key, lambda k: k[0] == key[0]):
+            anchors = [p[0] for p in candidates if same(p[1])]
+            if not anchors:
+                continue
+            later = [p for p in pending if p[0] > anchors[-1]]
+            if not later or any(p[2] >= COMFY_MAX_OVERTAKES for p in later):
+                return None
+            # Strictly between the anchor and the next number (ours or ComfyUI's integer counter)
+            upper = min(later[0][0], math.floor(anchors[-1]) + 1)
+            number = (anchors[-1] + upper) / 2
+            if not anchors[-1] < number < upper:
+                return None
+            for p in later:
+                p[2] += 1
+            return number
+        return None
+
+    @staticmethod
+    def _settle(future, result):
+        if future.done():
+            return
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def _finish(self, prompt_id, result):
+        if prompt_id in self._done:
+            return  # Already settled (e.g. execution_error, then the final 'executing' node=None)
+        self._done[prompt_id] = None
+        while len(self._done) > 256:
+            self._done.pop(next(iter(self._done)))
+        self._outputs.pop(prompt_id, None)
+        self._ws_nodes.pop(prompt_id, None)
+        self._graphs.pop(prompt_id, None)
+        self._pending.pop(prompt_id, None)
+        future = self._futures.pop(prompt_id, None)
+        if future is not None:
+            self._settle(future, result)
+        else:
+            # Finished while submit() was still waiting for the POST response
+            self._finished[prompt_id] = result
+            while len(self._finished) > 256:
+                self._finished.pop(next(iter(self._finished)))
+
+    async def _read_loop(self, ws):
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    prompt_id, node_id = self._executing
+                    if node_id in self._ws_nodes.get(prompt_id, ()) and len(msg.data) > BINARY_HEADER_BYTES:
+                        # SaveImageWebsocket output: the PNG itself, no /view round trip
+                        node = self._outputs.setdefault(prompt_id, {}).setdefault(node_id, {})
+                        node.setdefault('ws_images', []).append(msg.data[BINARY_HEADER_BYTES:])
+                    continue  # Otherwise previews
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                data = message.get('data') or {}
+                prompt_id = data.get('prompt_id')
+                kind = message.get('type')
+                if kind in ('execution_start', 'executing') and prompt_id in self._pending:
+                    self._running = self._pending.pop(prompt_id)
+                if kind == 'executing' and prompt_id:
+                    self._executing = (prompt_id, data.get('node'))
+                    if data.get('node') is not None:
+                        self.cache_stats.executed(self._graphs.get(prompt_id, {}), data['node'])
+                elif kind == 'execution_cached' and prompt_id:
+                    self.cache_stats.cached(self._graphs.get(prompt_id, {}), data.get('nodes') or [])
+                if kind == 'executed' and prompt_id:
+                    self._outputs.setdefault(prompt_id, {}).setdefault(data['node'], {}).update(data.get('output') or {})
+                elif kind == 'executing' and prompt_id and data.get('node') is None:
+                    if prompt_id in self._done:
+                        continue  # Failed or interrupted: the end-of-prompt message changes nothing
+                    outputs = self._outputs.get(prompt_id)
+                    if outputs is None:
+                        # Everything came from ComfyUI's cache: no 'executed' messages
+                        asyncio.create_task(self._finish_from_history(prompt_id))
+                    else:
+                        self._finish(prompt_id, outputs)
+                elif kind == 'execution_error' and prompt_id:
+                    self._finish(prompt_id, ComfyExecutionError(
+                        prompt_id, data.get('exception_message', 'execution error').strip(), data.get('node_id')))
+                elif kind == 'execution_interrupted' and prompt_id:
+                    self._finish(prompt_id, ComfyExecutionError(prompt_id, "interrupted", data.get('node_id')))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ ComfyUI websocket reader stopped: {e}")
+        # Socket gone: nothing in flight can complete on this connection
+        self._pending.clear()
+        self._running = None
+        pending, self._futures = self._futures, {}
+        for prompt_id, future in pending.items():
+            self._graphs.pop(prompt_id, None)
+            self._ws_nodes.pop(prompt_id, None)
+            self._settle(future, ConnectionError(f"ComfyUI websocket closed before {prompt_id} finished"))
+
+    async def _finish_from_history(self, prompt_id):
+        try:
+            history = await self.get_history(prompt_id)
+            self._finish(prompt_id, history[prompt_id]['outputs'])
+        except Exception as e:
+            self._finish(prompt_id, e)
+
+    async def get_json(self, path, timeout=10):
+        """GET a JSON endpoint (/queue, /system_stats, /object_info/...), websocket or not."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.session.get(f"http://{self.server_address}{path}",
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def get_history(self, prompt_id):
+        async with self.session.get(f"http://{self.server_address}/history/{prompt_id}") as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def get_image(self, filename, subfolder, folder_type):
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        async with self.session.get(f"http://{self.server_address}/view", params=params) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    async def download_image(self, image, out_path):
+        """Stream a /view download to out_path in VIEW_CHUNK_SIZE chunks (pooled session)."""
+        async with self.session.get(f"http://{self.server_address}/view", params=view_params(image)) as resp:
+            resp.raise_for_status()
+            tmp_path = f"{out_path}.tmp"
+            f = await asyncio.to_thread(open, tmp_path, 'wb')
+            try:
+                async for chunk in resp.content.iter_chunked(VIEW_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+            except BaseException:
+                await asyncio.to_thread(_discard, f, tmp_path)
+                raise
+            await asyncio.to_thread(f.close)
+            os.replace(tmp_path, out_path)
+
+    async def save_outputs(self, outputs, seed, output_dir):
+        """Write a finished prompt's images; returns (paths, ComfyUI filenames)."""
+        os.makedirs(output_dir, exist_ok=True)
         generated_files = []
-        for node_id in outputs:
-            node_output = outputs[node_id]
-            if 'images' in node_output:
-                for image in node_output['images']:
-                    filename = image['filename']
-                    subfolder = image['subfolder']
-                    folder_type = image['type']
-                    
-                    print(f"📥 Downloading {filename}...")
-                    image_data = self.get_image(filename, subfolder, folder_type)
-                    
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-                        
-                    out_path = os.path.join(output_dir, f"comfy_{seed}_{filename}")
-                    with open(out_path, 'wb') as f:
-                        f.write(image_data)
-                    generated_files.append(out_path)
-                    
+        filenames = []
+        for filename, out_path, source in output_files(outputs, seed, output_dir):
+            if isinstance(source, bytes):
+                await asyncio.to_thread(_save_chunks, [source], out_path)
+            else:
+                print(f"📥 Downloading {filename}...")
+                await self.download_image(source, out_path)
+            generated_files.append(out_path)
+            filenames.append(filename)
+        return generated_files, filenames
+
+    async def generate(self, workflow_path, prompt_text, negative_prompt="", seed=None, output_dir="output",
+                       width=None, height=None):
+        """Async ComfyClient.generate(): same injection, result cache and file names.
+        Returns the saved paths, or None on failure."""
+        workflow, seed = prepare_workflow(workflow_path, prompt_text, negative_prompt, seed, width, height)
+        if workflow is None:
+            return None
+
+        cache_key = self.result_cache.key(workflow)
+        cached = self.result_cache.get(cache_key)
+        if cached:
+            print(f"🗄️ Result cache hit ({cache_key[:12]}), skipping ComfyUI")
+            return restore_cached(self.result_cache, cached, seed, output_dir)
+
+        print(f"🚀 Queuing Prompt (Seed: {seed})...")
+        try:
+            outputs = await (await self.submit(workflow))
+        except (ComfyExecutionError, ConnectionError, aiohttp.ClientError) as e:
+            print(f"❌ ComfyUI generation failed: {e}")
+            return None
+        print("✨ Generation Complete!")
+
+        try:
+            generated_files, filenames = await self.save_outputs(outputs, seed, output_dir)
+        except (aiohttp.ClientError, OSError) as e:
+            print(f"❌ ComfyUI download failed: {e}")
+            return None
+
+        try:
+            self.result_cache.put(cache_key, generated_files, {"filenames": filenames})
+        except OSError as e:
+            print(f"⚠️ Result cache store failed: {e}")
         return generated_files
+
+
+class ComfyEndpoint:
+    def __init__(self, client):
+        self.client = client
+        self.queue_depth = 0   # Running + pending prompts at the last poll
+        self.sent = 0          # Prompts we queued since that poll
+        self.vram_free = 0
+        self.models = {}       # Loader input -> model files (from /object_info)
+        self.models_at = 0.0
+        self.completed = 0
+        self.failures = 0
+        self.down_until = 0.0  # 0 = in rotation
+
+    @property
+    def address(self):
+        return self.client.server_address
+
+    @property
+    def depth(self):
+        return self.queue_depth + self.sent
+
+    def has_models(self, required):
+        """False only if /object_info was read and lacks one of the required files."""
+        for input_name, names in required.items():
+            known = self.models.get(input_name)
+            if known is not None and not names <= known:
+                return False
+        return True
+
+
+class ComfyBalancer:
+    """AsyncComfyClient.generate() over several ComfyUI servers (e.g. a RunPod fleet).
+
+    A poller reads /queue and /system_stats from every endpoint each
+    COMFY_POLL_INTERVAL seconds (and the checkpoint / UNet lists from
+    /object_info every COMFY_MODELS_TTL). Each prompt goes to the endpoint
+    with the shortest queue (polled depth + prompts sent since), among those
+    that have the workflow's models; ties go to the most free VRAM. An
+    endpoint that stops answering is taken out of rotation, its prompt is
+    retried on the next one, and it is re-polled after COMFY_RETRY_AFTER
+    seconds (backing off on repeat failures).
+
+        comfy = ComfyBalancer("pod-a:8188,pod-b:8188")   # or COMFY_URLS
+        await comfy.connect()
+        files = await comfy.generate(WORKFLOW_PATH, "1girl, ...")
+    """
+
+    def __init__(self, server_addresses, result_cache=None, poll_interval=COMFY_POLL_INTERVAL,
+                 retry_after=COMFY_RETRY_AFTER):
+        if isinstance(server_addresses, str):
+            server_addresses = server_addresses.split(",")
+        addresses = list(dict.fromkeys(a.strip() for a in server_addresses if a.strip()))
+        self.result_cache = result_cache or ResultCache()
+        self.cache_stats = NodeCacheStats()
+        self.endpoints = [ComfyEndpoint(AsyncComfyClient(a, result_cache=self.result_cache, cache_stats=self.cache_stats))
+                          for a in addresses]
+        self.poll_interval = poll_interval
+        self.retry_after = retry_after
+        self._poller = None
+
+    async def connect(self):
+        """Poll every endpoint once and start the poller. True if any endpoint is up."""
+        if aiohttp is None:
+            raise RuntimeError("ComfyBalancer needs aiohttp (pip install aiohttp)")
+        await self._poll_all()
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll_loop())
+        up = [e for e in self.endpoints if not e.down_until]
+        print(f"✅ ComfyUI endpoints up: {len(up)}/{len(self.endpoints)}")
+        return bool(up)
+
+    async def close(self):
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self._poll_all()
+
+    async def _poll_all(self):
+        now = time.time()
+        due = [e for e in self.endpoints if not e.down_until or e.down_until <= now]
+        await asyncio.gather(*(self._poll(e) for e in due))
+
+    async def _poll(self, endpoint):
+        client = endpoint.client
+        try:
+            queue = await client.get_json("/queue")
+            stats = await client.get_json("/system_stats")
+            if time.time() - endpoint.models_at > COMFY_MODELS_TTL:
+                models = {}
+                for input_name, node_class in MODEL_LOADERS.items():
+                    info = await client.get_json(f"/object_info/{node_class}")
+                    spec = (((info.get(node_class) or {}).get("input") or {}).get("required") or {}).get(input_name)
+                    if spec and isinstance(spec[0], list):
+                        models[input_name] = set(spec[0])
+                    elif spec and spec[0] == "COMBO":  # Newer ComfyUI: ["COMBO", {"options": [...]}]
+                        models[input_name] = set(spec[1].get("options", []))
+                endpoint.models, endpoint.models_at = models, time.time()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError, IndexError) as e:
+            self._mark_down(endpoint, e)
+            return
+        endpoint.queue_depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        endpoint.sent = 0
+        endpoint.vram_free = sum(d.get("vram_free", 0) for d in stats.get("devices", []))
+        if endpoint.down_until:
+            endpoint.down_until = 0.0
+            print(f"✅ ComfyUI endpoint back in rotation: {endpoint.address}")
+
+    def _mark_down(self, endpoint, error):
+        endpoint.failures += 1
+        retry_in = self.retry_after * min(endpoint.failures, 4)
+        if not endpoint.down_until:
+            print(f"⚠️ ComfyUI endpoint out of rotation: {endpoint.address} ({error}), retry in {retry_in:.0f}s")
+        endpoint.down_until = time.time() + retry_in
+
+    async def _acquire(self, required, tried):
+        """Endpoint with the shortest queue that has the required models, waiting
+        up to COMFY_ACQUIRE_TIMEOUT while all are down. None if there is none."""
+        deadline = time.time() + COMFY_ACQUIRE_TIMEOUT
+        while True:
+            untried = [e for e in self.endpoints if e not in tried and e.has_models(required)]
+            if not untried:
+                if not tried:
+                    missing = sorted(set().union(*required.values())) if required else []
+                    print(f"❌ No ComfyUI endpoint has {', '.join(missing)}")
+                return None
+            ready = [e for e in untried if not e.down_until]
+            if ready:
+                endpoint = min(ready, key=lambda e: (e.depth, -e.vram_free))
+                endpoint.sent += 1
+                return endpoint
+            if time.time() >= deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def generate(self, workflow_path, prompt_text, negative_prompt="", seed=None, output_dir="output",
+                       width=None, height=None):
+        """AsyncComfyClient.generate() on the least busy endpoint, failing over
+        to the next one if it disappears. Returns the saved paths, or None."""
+        if self._poller is None:
+            await self.connect()
+        workflow, seed = prepare_workflow(workflow_path, prompt_text, negative_prompt, seed, width, height)
+        if workflow is None:
+            return None
+
+        cache_key = self.result_cache.key(workflow)
+        cached = self.result_cache.get(cache_key)
+        if cached:
+            print(f"🗄️ Result cache hit ({cache_key[:12]}), skipping ComfyUI")
+            return restore_cached(self.result_cache, cached, seed, output_dir)
+
+        required = required_models(workflow)
+        tried = set()
+        while True:
+            endpoint = await self._acquire(required, tried)
+            if endpoint is None:
+                print("❌ ComfyUI generation failed: no endpoint available")
+                return None
+            tried.add(endpoint)
+            client = endpoint.client
+            print(f"🚀 Queuing Prompt (Seed: {seed}) on {endpoint.address} (queue {endpoint.depth - 1})...")
+            try:
+                outputs = await (await client.submit(workflow))
+                generated_files, filenames = await client.save_outputs(outputs, seed, output_dir)
+            except ComfyExecutionError as e:
+                print(f"❌ ComfyUI generation failed: {e}")
+                return None
+            except aiohttp.ClientResponseError as e:
+                if e.status >= 500:
+                    self._mark_down(endpoint, e)
+                else:
+                    print(f"⚠️ {endpoint.address} rejected the prompt ({e.status}), trying another endpoint")
+                continue
+            except (ConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._mark_down(endpoint, e)
+                continue
+            except OSError as e:
+                print(f"❌ ComfyUI download failed: {e}")
+                return None
+            endpoint.completed += 1
+            endpoint.failures = 0
+            print("✨ Generation Complete!")
+            break
+
+        try:
+            self.result_cache.put(cache_key, generated_files, {"filenames": filenames})
+        except OSError as e:
+            print(f"⚠️ Result cache store failed: {e}")
+        return generated_files
+
+    def summary_lines(self):
+        lines = []
+        for e in self.endpoints:
+            state = " [down]" if e.down_until else ""
+            lines.append(f"{e.address}: queue {e.depth}, {e.vram_free / 1024**3:.1f} GB free, "
+                         f"{e.completed} prompts ok{state}")
+        return lines
+
+
+def _save_chunks(chunks, out_path):
+    """Write byte chunks to out_path via a temp file, so a failed download leaves nothing behind."""
+    tmp_path = f"{out_path}.tmp"
+    f = open(tmp_path, 'wb')
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+    except BaseException:
+        _discard(f, tmp_path)
+        raise
+    f.close()
+    os.replace(tmp_path, out_path)
+
+
+def _discard(f, tmp_path):
+    f.close()
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
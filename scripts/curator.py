@@ -7,6 +7,7 @@ import time
 from datetime import datetime
 from dotenv import load_dotenv
 import google.generativeai as genai
+from png_meta import sidecar_path
 
 # LOAD ENV
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -97,6 +98,10 @@ def process_images():
             dest = os.path.join(REJECTED_DIR, filename)
             
         shutil.move(filepath, dest)
+        # Older factory output keeps metadata in a .json sidecar; keep it with its image
+        # (factory.py --metadata png embeds it in the PNG instead)
+        if os.path.exists(sidecar_path(filepath)):
+            shutil.move(sidecar_path(filepath), sidecar_path(dest))
         
         # Update DB
         cursor.execute('''
@@ -3,12 +3,11 @@ from discord.ext import commands
 import os
 import sys
 import random
-import asyncio
 from dotenv import load_dotenv
 
 # Add scripts/comfy to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'comfy'))
-from comfy_client import ComfyClient
+from comfy_client import ComfyBalancer
 
 # === SETUP ===
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -16,13 +15,14 @@ load_dotenv(os.path.join(BASE_DIR, "config", ".env"))
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 COMFY_URL = os.getenv("COMFY_URL", "127.0.0.1:8188") # Add to .env if remote
+COMFY_URLS = os.getenv("COMFY_URLS", COMFY_URL) # Comma-separated, one per ComfyUI pod
 
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
 bot = commands.Bot(command_prefix="!", intents=intents)
-comfy = ComfyClient(server_address=COMFY_URL)
+comfy = ComfyBalancer(COMFY_URLS)  # Shortest-queue ComfyUI per prompt, many prompts in flight
 
 # === STATE ===
 WORKFLOW_PATH = os.path.join(BASE_DIR, "workflows", "masterpiece.json")
@@ -37,8 +37,8 @@ STYLES = {
 @bot.event
 async def on_ready():
     print(f'✨ Lady Nuggets Orchestrator Online as {bot.user}')
-    print(f'🔌 Connecting to ComfyUI at {COMFY_URL}...')
-    if comfy.connect():
+    print(f'🔌 Connecting to ComfyUI at {COMFY_URLS}...')
+    if await comfy.connect():
         print("✅ ComfyUI Connected")
     else:
         print("⚠️ ComfyUI NOT Connected (Make sure it's running)")
@@ -83,19 +83,15 @@ async def gen(ctx, *, prompt: str):
     # Inject style if specified (simple logic for now)
     final_prompt = prompt
     
-    # Run Generation (Blocking for now, should be async in prod)
-    # We run in executor to not block bot loop
-    def run_comfy():
-        return comfy.generate(
+    # Run Generation: queued on ComfyUI and awaited on the shared websocket,
+    # so concurrent !gen commands keep ComfyUI's queue full without threads
+    try:
+        files = await comfy.generate(
             WORKFLOW_PATH, 
             final_prompt, 
             negative_prompt="(worst quality, low quality:1.4)",
             output_dir=os.path.join(BASE_DIR, "content", "comfy_out")
         )
-    
-    try:
-        loop = asyncio.get_event_loop()
-        files = await loop.run_in_executor(None, run_comfy)
         
         if files:
             discord_files = [discord.File(f) for f in files]
@@ -115,6 +111,14 @@ async def styles(ctx):
         msg += f"`{s}`\n"
     await ctx.send(msg)
 
+@bot.command()
+async def comfystats(ctx):
+    """ComfyUI endpoints and execution cache hit rates"""
+    msg = "**🖥️ ComfyUI:**\n" + "\n".join(f"`{line}`" for line in comfy.summary_lines())
+    msg += f"\n**♻️ Cache:** {comfy.cache_stats.summary()}\n"
+    msg += "\n".join(f"`{line}`" for line in comfy.cache_stats.summary_lines()[:10])
+    await ctx.send(msg)
+
 @bot.command()
 async def story(ctx, *, theme: str):
     """(Stub) Create a story and generate images"""
@@ -12,18 +12,35 @@ Features:
 """
 
 import os
+import glob
 import random
 import requests
 import json
 import base64
 import time
 import argparse
+import atexit
+import threading
+import hashlib
+import sqlite3
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from dotenv import load_dotenv
+from forge_client import (ForgeClient, ServerCapabilities, CheckpointTracker, JobScheduler,
+                          ProgressMonitor, detect_sd_api, discover_sd_apis, probe_sd_api,
+                          stream_json_images, STREAM_CHUNK_SIZE)
+from result_cache import ResultCache, RESULT_CACHE_ENABLED
+from output_writer import OutputWriter, unique_suffix
+from png_meta import PngTextWriter, copy_with_metadata, read_metadata, write_metadata
 
 # === LOAD ENV ===
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 load_dotenv(os.path.join(BASE_DIR, "config", ".env"))
+DATA_DIR = os.getenv("FACTORY_DATA_DIR", os.path.join(BASE_DIR, "database"))  # Caches, queue, trace, stats
 
 # === COLORS FOR TERMINAL ===
 class Colors:
@@ -51,41 +68,17 @@ def log(level, msg):
     print(f"{icon} {msg}{Colors.END}")
 
 # === CONFIG ===
-def detect_sd_api():
-    """Dynamically detect SD API port (7860, 7861, 7862).
-    Validates response is real SD API (JSON), not nginx proxy (HTML 405)."""
-    env_api = os.getenv("REFORGE_API", "")
-    
-    # Try ports in order of priority (include Forge template ports)
-    ports = [7860, 7861, 7862, 3000, 3001, 8080, 8188]
-    for port in ports:
-        try:
-            url = f"http://127.0.0.1:{port}"
-            resp = requests.get(f"{url}/sdapi/v1/sd-models", timeout=3)
-            if resp.status_code == 200:
-                # Verify it's actual JSON from SD API, not nginx HTML
-                try:
-                    data = resp.json()
-                    if isinstance(data, list):
-                        log('success', f"SD API verified on port {port} ({len(data)} models)")
-                        return url
-                except (ValueError, TypeError):
-                    log('warning', f"Port {port} responded but not valid SD API (nginx proxy?)")
-                    continue
-        except:
-            pass
-    
-    # Fallback to env or default
-    if env_api:
-        log('warning', f"No active SD API found, using .env: {env_api}")
-        return env_api
-    log('warning', "No SD API found, defaulting to port 7860")
-    return "http://127.0.0.1:7860"
+def resolve_sd_api():
+    """Find the SD API (lazy: runs on the first Forge request, not at import)."""
+    return detect_sd_api(log=log)
 
-REFORGE_API = detect_sd_api()
+FORGE = ForgeClient(resolver=resolve_sd_api)
+FORGE_CAPS = ServerCapabilities(FORGE, os.path.join(DATA_DIR, "forge_capabilities.json"))
 # Clean keys to prevent 401 errors from invisible whitespace/quotes
 OPENROUTER_KEY = os.getenv("OPENROUTER_KEY", "").strip().replace('"', '').replace("'", "")
 GROQ_KEY = os.getenv("GROQ_KEY", "").strip().replace('"', '').replace("'", "")
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
 OUTPUT_DIR = os.path.join(BASE_DIR, "content", "raw")
 THEMES_FILE = os.path.join(BASE_DIR, "config", "themes.txt")
 
@@ -114,6 +107,9 @@ QUALITY_SUFFIX = """high detail,subtle,high contrast,colorful depth,
 chiaroscuro,impasto,(shallow depth of field:1.4),(foreshortening:1.4),
 depth of field,cinematic lighting,ambient occlusion,soft lighting"""
 
+# Theme the LLM expands when rendering the OC without --theme
+OC_THEME = "pinup pose"
+
 # Character definition (body only, no quality tags)
 OC_CHARACTER = """1girl, solo, full body, centered composition, looking at viewer, 
 (very long black hair:1.4), large purple eyes, soft black eyeliner, makeup shadows, glossy lips, subtle blush, mole on chin, bright pupils, 
@@ -207,22 +203,739 @@ Output: masterpiece, best quality, ultra-detailed, 8k, absurdres, 1girl, solo, r
 # To re-enable, pass --lora flag when running factory.py
 USE_LORA = False
 
-def detect_loras():
-    """Detect available LoRAs from server"""
+# === PROMPT CACHE (Memoized LLM scene prompts) ===
+PROMPT_CACHE_FILE = os.path.join(DATA_DIR, "prompt_cache.json")
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE", "true").lower() == "true"
+PROMPT_CACHE_TTL_HOURS = float(os.getenv("PROMPT_CACHE_TTL_HOURS", "24"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "500"))
+PROMPT_CACHE_MAX_REUSE = int(os.getenv("PROMPT_CACHE_MAX_REUSE", "3"))
+PROMPT_SYSTEM_HASH = hashlib.sha256(PROMPT_SYSTEM.encode("utf-8")).hexdigest()[:16]
+
+class PromptCache:
+    """On-disk LRU cache of LLM responses keyed by (theme, model, PROMPT_SYSTEM hash).
+    Entries expire after a TTL or after being served max_reuse times, so
+    repeated themes still get fresh prompts now and then. Hits only update
+    memory; use counts reach the file with the next put() or flush() (at exit)."""
+
+    def __init__(self, path, ttl_hours=24, max_entries=500, max_reuse=3, enabled=True):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.max_reuse = max_reuse
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = False
+        if enabled:
+            self._load()
+
+    @staticmethod
+    def _key(theme, model):
+        return hashlib.sha256(f"{PROMPT_SYSTEM_HASH}|{model}|{theme}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                for entry in json.load(f):
+                    self._entries[entry["key"]] = entry
+        except (OSError, ValueError, KeyError, TypeError):
+            self._entries = OrderedDict()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._entries.values()), f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def flush(self):
+        """Persist use counts and evictions from get() since the last write."""
+        with self._lock:
+            if self._dirty:
+                try:
+                    self._save()
+                except OSError:
+                    pass
+
+    def _is_stale(self, entry):
+        return (time.time() - entry["created"] > self.ttl
+                or entry["uses"] >= self.max_reuse)
+
+    def get(self, theme, models):
+        """Return (model, prompt) for the first fresh entry among models, else None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            for model in models:
+                key = self._key(theme, model)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                self._dirty = True
+                if self._is_stale(entry):
+                    del self._entries[key]
+                    continue
+                entry["uses"] += 1
+                entry["last_used"] = time.time()
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["model"], entry["prompt"]
+            self.misses += 1
+            return None
+
+    def put(self, theme, model, prompt):
+        if not self.enabled or not prompt:
+            return
+        with self._lock:
+            key = self._key(theme, model)
+            now = time.time()
+            self._entries[key] = {
+                "key": key, "theme": theme, "model": model, "prompt": prompt,
+                "created": now, "last_used": now, "uses": 1,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)  # Evict least recently used
+            self._save()
+
+    def summary(self):
+        if not self.enabled:
+            return "disabled"
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0
+        return f"{self.hits} hits / {self.misses} misses ({rate:.0f}% hit rate)"
+
+PROMPT_CACHE = PromptCache(PROMPT_CACHE_FILE,
+                           ttl_hours=PROMPT_CACHE_TTL_HOURS,
+                           max_entries=PROMPT_CACHE_MAX_ENTRIES,
+                           max_reuse=PROMPT_CACHE_MAX_REUSE,
+                           enabled=PROMPT_CACHE_ENABLED)
+atexit.register(PROMPT_CACHE.flush)
+
+# === PROMPT POOL (Prefetched prompts, no network on the render path) ===
+PROMPT_POOL_DB = os.path.join(DATA_DIR, "prompt_pool.db")
+PROMPT_POOL_ENABLED = os.getenv("PROMPT_POOL", "true").lower() == "true"
+
+class PromptPool:
+    """SQLite pool of LLM scene prompts filled ahead of time by `factory.py prefetch`.
+    Each prompt is handed out once; prompts made with an older PROMPT_SYSTEM are ignored."""
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.served = 0
+        self.empty = 0
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''CREATE TABLE IF NOT EXISTS prompt_pool
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, theme TEXT NOT NULL, prompt TEXT NOT NULL,
+                      system_hash TEXT NOT NULL, created_at REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pool_theme ON prompt_pool (theme, system_hash)")
+        return conn
+
+    def add(self, theme, prompt):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO prompt_pool (theme, prompt, system_hash, created_at) VALUES (?, ?, ?, ?)",
+                             (theme, prompt, PROMPT_SYSTEM_HASH, time.time()))
+        finally:
+            conn.close()
+
+    def take(self, theme):
+        """Pop the oldest prompt for theme, or None if the pool is empty."""
+        if not self.enabled or not os.path.exists(self.path):
+            return None
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, prompt FROM prompt_pool WHERE theme = ? AND system_hash = ? ORDER BY id LIMIT 1",
+                               (theme, PROMPT_SYSTEM_HASH)).fetchone()
+            if row:
+                conn.execute("DELETE FROM prompt_pool WHERE id = ?", (row[0],))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if row:
+            self.served += 1
+            return row[1]
+        self.empty += 1
+        return None
+
+    def counts(self):
+        """Return {theme: available prompts} for the current PROMPT_SYSTEM."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT theme, COUNT(*) FROM prompt_pool WHERE system_hash = ? GROUP BY theme",
+                                (PROMPT_SYSTEM_HASH,)).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def summary(self):
+        if not self.enabled:
+            return "disabled"
+        return f"{self.served} served / {self.empty} empty (fell back to LLM)"
+
+PROMPT_POOL = PromptPool(PROMPT_POOL_DB, enabled=PROMPT_POOL_ENABLED)
+
+# === COMBO INDEX (Character x scenario x artist coverage across runs) ===
+COMBO_INDEX_DB = os.path.join(DATA_DIR, "combo_index.db")
+COMBO_SAMPLER_ENABLED = os.getenv("COMBO_SAMPLER", "true").lower() == "true"
+COMBO_REPEAT_BUDGET = int(os.getenv("COMBO_REPEAT_BUDGET", "1"))  # Renders per combo before repeats are allowed
+
+class ComboIndex:
+    """Persistent count of rendered prompt combinations (character, scenario,
+    artist mix). pick() hands out the least-rendered combination, counting jobs
+    still in flight, so repeats only start once every combination has been
+    rendered COMBO_REPEAT_BUDGET times. Random picks when disabled."""
+
+    def __init__(self, path, enabled=True, repeat_budget=1):
+        self.path = path
+        self.enabled = enabled
+        self.repeat_budget = max(1, repeat_budget)
+        self.counts = None  # key -> renders, loaded on first pick
+        self.pending = {}  # key -> jobs picked this run, not rendered yet
+        self.picked = []
+        self.space = set()  # Keys of the current combination space
+        self.new = 0
+        self.over_budget = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''CREATE TABLE IF NOT EXISTS combos
+                     (key TEXT PRIMARY KEY, renders INTEGER NOT NULL DEFAULT 0, images INTEGER NOT NULL DEFAULT 0,
+                      last_rendered REAL)''')
+        return conn
+
+    @staticmethod
+    def key(combo):
+        return hashlib.md5(json.dumps(combo, sort_keys=True).encode()).hexdigest()
+
+    def _load(self):
+        conn = self._connect()
+        try:
+            self.counts = dict(conn.execute("SELECT key, renders FROM combos").fetchall())
+        finally:
+            conn.close()
+
+    def pick(self, choices):
+        """choices: {dimension: [options]}. Returns ({dimension: option}, key)."""
+        if not self.enabled:
+            combo = {dim: random.choice(options) for dim, options in choices.items()}
+            return combo, None
+        dims = list(choices)
+        combos = [dict(zip(dims, values)) for values in itertools.product(*(choices[d] for d in dims))]
+        with self._lock:
+            if self.counts is None:
+                self._load()
+            load = {}
+            for combo in combos:
+                k = self.key(combo)
+                load[k] = self.counts.get(k, 0) + self.pending.get(k, 0)
+            lowest = min(load.values())
+            candidates = [combo for combo in combos if load[self.key(combo)] == lowest]
+            combo = random.choice(candidates)
+            k = self.key(combo)
+            if not self.counts.get(k) and k not in self.picked:
+                self.new += 1
+            if lowest >= self.repeat_budget:
+                self.over_budget += 1
+                if self.over_budget == 1:
+                    log('warning', f"All {len(combos)} prompt combos used {lowest}x (budget {self.repeat_budget}), repeating least used")
+            self.pending[k] = self.pending.get(k, 0) + 1
+            self.picked.append(k)
+            self.space = set(load)
+        return combo, k
+
+    def record(self, key, images):
+        """A job with this combo finished (images > 0) or failed (images == 0)."""
+        if not self.enabled or not key:
+            return
+        with self._lock:
+            if self.pending.get(key):
+                self.pending[key] -= 1
+            if not images:
+                return
+            if self.counts is not None:
+                self.counts[key] = self.counts.get(key, 0) + 1
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('''INSERT INTO combos (key, renders, images, last_rendered) VALUES (?, 1, ?, ?)
+                                 ON CONFLICT(key) DO UPDATE SET renders = renders + 1, images = images + excluded.images,
+                                 last_rendered = excluded.last_rendered''', (key, images, time.time()))
+            finally:
+                conn.close()
+
+    def summary(self):
+        if not self.enabled:
+            return "disabled (random picks)"
+        if not self.picked:
+            return "no prompts built"
+        distinct = len(set(self.picked))
+        covered = sum(1 for k in self.space if self.counts.get(k))
+        return (f"{distinct}/{len(self.picked)} distinct ({distinct / len(self.picked) * 100:.0f}% yield), "
+                f"{self.new} new, {covered}/{len(self.space)} covered")
+
+COMBOS = ComboIndex(COMBO_INDEX_DB, enabled=COMBO_SAMPLER_ENABLED, repeat_budget=COMBO_REPEAT_BUDGET)
+
+# === TELEMETRY (Per-stage spans as JSONL, read by `factory.py report`) ===
+TRACE_FILE = os.getenv("FACTORY_TRACE_FILE", os.path.join(DATA_DIR, "telemetry.jsonl"))
+TRACE_ENABLED = os.getenv("FACTORY_TRACE", "true").lower() == "true"
+
+class Tracer:
+    """Appends one JSON line per stage span: run, job, stage, start, seconds
+    (+ stage attributes). The current job is bound per thread, so the prompt
+    builder and render workers can trace concurrently."""
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.run_id = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def job(self, job_id):
+        """Attribute spans recorded by this thread to job_id."""
+        previous = getattr(self._local, "job", None)
+        self._local.job = job_id
+        try:
+            yield
+        finally:
+            self._local.job = previous
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """Time a block; the yielded dict can be filled with extra attributes."""
+        start = time.time()
+        try:
+            yield attrs
+        finally:
+            self.record(stage, time.time() - start, start=start, **attrs)
+
+    def record(self, stage, seconds, start=None, **attrs):
+        if not self.enabled:
+            return
+        entry = {"run": self.run_id, "job": getattr(self._local, "job", None), "stage": stage,
+                 "start": round(start if start is not None else time.time() - seconds, 3),
+                 "seconds": round(seconds, 4)}
+        entry.update(attrs)
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError:
+                pass
+
+TRACER = Tracer(TRACE_FILE, enabled=TRACE_ENABLED)
+
+def timed_chunks(chunks, timings):
+    """Yield response chunks, adding time spent waiting on the network to timings["transfer"]."""
+    chunks = iter(chunks)
+    while True:
+        start = time.time()
+        chunk = next(chunks, None)
+        timings["transfer"] += time.time() - start
+        if chunk is None:
+            return
+        yield chunk
+
+class TimedFile:
+    """Binary file whose write() time (handing bytes to the writer) is added to timings["write"]."""
+
+    def __init__(self, f, timings):
+        self.f = f
+        self.timings = timings
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        start = time.time()
+        self.f.close()
+        self.timings["write"] += time.time() - start
+        return False
+
+    def write(self, data):
+        start = time.time()
+        self.f.write(data)
+        self.timings["write"] += time.time() - start
+
+# Stage order for `factory.py report`
+REPORT_STAGES = ["prompt", "llm", "backend_wait", "checkpoint_swap", "queue_wait", "sampling", "hires",
+                 "adetailer", "postprocess", "transfer", "decode", "write", "job"]
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def run_report(args):
+    """Print p50/p95/p99 per stage and images/hour for one run of the trace file."""
     try:
-        # Refresh LoRA list first
-        requests.post(f"{REFORGE_API}/sdapi/v1/refresh-loras", timeout=5)
-        import time; time.sleep(1)
-        
-        resp = requests.get(f"{REFORGE_API}/sdapi/v1/loras", timeout=5)
-        if resp.status_code == 200:
-            loras = resp.json()
-            log('debug', f"Found {len(loras)} LoRAs: {[l['name'] for l in loras]}")
-            return loras
-        return []
-    except Exception as e:
-        log('warning', f"Could not fetch LoRAs: {e}")
-        return []
+        with open(TRACE_FILE, "r") as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError) as e:
+        log('error', f"Cannot read {TRACE_FILE}: {e}")
+        return
+    runs = list(dict.fromkeys(s.get("run") for s in spans if s.get("run")))
+    if not runs:
+        log('warning', f"No traced runs in {TRACE_FILE}")
+        return
+    run_id = args.run or runs[-1]
+    spans = [s for s in spans if s.get("run") == run_id]
+    if not spans:
+        log('error', f"Run {run_id} not found (known: {', '.join(runs[-5:])})")
+        return
+
+    by_stage = {}
+    for s in spans:
+        by_stage.setdefault(s["stage"], []).append(s["seconds"])
+    jobs = [s for s in spans if s["stage"] == "job"]
+    images = sum(s.get("images", 0) for s in jobs)
+    wall = max(s["start"] + s["seconds"] for s in spans) - min(s["start"] for s in spans)
+
+    print(f"\n{Colors.CYAN}{'='*60}{Colors.END}")
+    print(f"{Colors.BOLD}📊 RUN REPORT {run_id}{Colors.END}")
+    print(f"{Colors.CYAN}{'='*60}{Colors.END}")
+    print(f"   {'stage':<16}{'count':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'total':>10}")
+    stages = [st for st in REPORT_STAGES if st in by_stage] + sorted(set(by_stage) - set(REPORT_STAGES))
+    for stage in stages:
+        values = by_stage[stage]
+        print(f"   {stage:<16}{len(values):>6}{percentile(values, 50):>8.2f}s{percentile(values, 95):>8.2f}s"
+              f"{percentile(values, 99):>8.2f}s{sum(values):>9.1f}s")
+    print(f"\n   Images: {images} in {wall:.0f}s wall → {images * 3600 / wall if wall else 0:.1f} images/hour")
+    print()
+
+# === JOB QUEUE (Crash-safe run state for --resume) ===
+JOB_QUEUE_DB = os.path.join(DATA_DIR, "job_queue.db")
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE", "true").lower() == "true"
+# Flags restored from the original run on --resume
+RESUME_KEYS = ["count", "output", "theme", "lora", "upscale", "no_hires", "oc", "batch_size", "n_iter", "models", "vae",
+               "draft", "draft_threshold", "metadata"]
+
+class JobQueue:
+    """SQLite record of every render request in a run. A job's assembled prompt,
+    negative, seed and settings are stored before it goes to Forge, and the row is
+    marked done in a single UPDATE once its PNGs are on disk, so --resume renders
+    exactly the jobs that never finished."""
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''CREATE TABLE IF NOT EXISTS runs
+                     (id TEXT PRIMARY KEY, settings TEXT NOT NULL, status TEXT NOT NULL, created_at REAL NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT NOT NULL, seq INTEGER NOT NULL,
+                      batch_size INTEGER NOT NULL, n_iter INTEGER NOT NULL, model TEXT NOT NULL, vae TEXT,
+                      status TEXT NOT NULL, job TEXT, images INTEGER NOT NULL DEFAULT 0,
+                      attempts INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_run ON jobs (run_id, status, seq)")
+        return conn
+
+    def _update(self, sql, params):
+        if not self.enabled or params[-1] is None:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    def create_run(self, settings, plan):
+        """Record a new run and its (batch_size, n_iter, model, vae) requests. Returns the run id."""
+        if not self.enabled:
+            return None
+        run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{random.randint(0, 0xffff):04x}"
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO runs (id, settings, status, created_at) VALUES (?, ?, 'running', ?)",
+                             (run_id, json.dumps(settings), now))
+                conn.executemany('''INSERT INTO jobs (run_id, seq, batch_size, n_iter, model, vae, status, updated_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, 'planned', ?)''',
+                                 [(run_id, seq, *request, now) for seq, request in enumerate(plan)])
+        finally:
+            conn.close()
+        return run_id
+
+    def load_run(self, run_id=None):
+        """Return (run_id, settings) for run_id, or the latest unfinished run."""
+        if not os.path.exists(self.path):
+            return None
+        conn = self._connect()
+        try:
+            if run_id:
+                row = conn.execute("SELECT id, settings FROM runs WHERE id = ?", (run_id,)).fetchone()
+            else:
+                row = conn.execute("SELECT id, settings FROM runs WHERE status = 'running' ORDER BY created_at DESC LIMIT 1").fetchone()
+        finally:
+            conn.close()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def pending(self, run_id):
+        """Unfinished requests of a run in plan order. "job" holds the stored
+        prompt/seed for requests that were assembled before the run stopped."""
+        conn = self._connect()
+        try:
+            rows = conn.execute('''SELECT id, batch_size, n_iter, model, vae, job FROM jobs
+                                WHERE run_id = ? AND status != 'done' ORDER BY seq''', (run_id,)).fetchall()
+        finally:
+            conn.close()
+        return [{"id": row[0], "request": tuple(row[1:5]), "job": json.loads(row[5]) if row[5] else None}
+                for row in rows]
+
+    def assemble(self, job_id, job):
+        """Store the fully assembled job before it is dispatched."""
+        stored = {k: v for k, v in job.items() if k != "id"}
+        self._update("UPDATE jobs SET status = 'pending', job = ?, updated_at = ? WHERE id = ?",
+                     (json.dumps(stored), time.time(), job_id))
+
+    def mark_dispatched(self, job_id):
+        self._update("UPDATE jobs SET status = 'dispatched', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                     (time.time(), job_id))
+
+    def mark_done(self, job_id, images):
+        self._update("UPDATE jobs SET status = 'done', images = ?, updated_at = ? WHERE id = ?",
+                     (images, time.time(), job_id))
+
+    def mark_failed(self, job_id):
+        self._update("UPDATE jobs SET status = 'failed', updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def progress(self, run_id):
+        """Return (images done, images planned) for a run."""
+        if not self.enabled or run_id is None:
+            return 0, 0
+        conn = self._connect()
+        try:
+            row = conn.execute('''SELECT COALESCE(SUM(images), 0), COALESCE(SUM(batch_size * n_iter), 0)
+                               FROM jobs WHERE run_id = ?''', (run_id,)).fetchone()
+        finally:
+            conn.close()
+        return row
+
+    def finish(self, run_id):
+        self._update("UPDATE runs SET status = 'done' WHERE id = ?", (run_id,))
+
+JOB_QUEUE = JobQueue(JOB_QUEUE_DB, enabled=JOB_QUEUE_ENABLED)
+
+# === LLM RACE (Concurrent provider calls + adaptive ordering) ===
+LLM_RACE_WIDTH = int(os.getenv("LLM_RACE_WIDTH", "2"))  # 1 = classic serial fallback
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "8"))  # Next model only if nobody answered by then (0 = all at once)
+LLM_LATENCY_FILE = os.path.join(DATA_DIR, "llm_latency.json")
+LLM_LATENCY_FLUSH = 30  # Seconds between llm_latency.json rewrites (and once at exit)
+
+def set_llm_race_width(width):
+    global LLM_RACE_WIDTH
+    LLM_RACE_WIDTH = max(1, width)
+
+class LatencyTracker:
+    """Rolling per-model latency samples persisted across runs.
+    Failures count as a full timeout so flaky models sink in the race order.
+    The file is rewritten at most every flush_interval seconds, not per sample."""
+
+    def __init__(self, path, window=50, flush_interval=LLM_LATENCY_FLUSH):
+        self.path = path
+        self.window = window
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._touched = set()
+        self._dirty = False
+        self._flushed_at = time.time()
+        try:
+            with open(path, "r") as f:
+                self._samples = {m: list(v)[-window:] for m, v in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            self._samples = {}
+
+    def _add(self, model, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(model, [])
+            samples.append(round(seconds, 3))
+            del samples[:-self.window]
+            self._touched.add(model)
+            self._dirty = True
+            due = time.time() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the samples if anything changed since the last write."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._flushed_at = time.time()
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self._samples, f)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass
+
+    def record(self, model, seconds):
+        self._add(model, seconds)
+
+    def record_failure(self, model, timeout):
+        self._add(model, timeout)
+
+    def percentile(self, model, pct):
+        samples = sorted(self._samples.get(model, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def rank(self, candidates):
+        """Sort (model, fn) pairs by p50. Unmeasured models go first so they get sampled."""
+        def key(item):
+            p50 = self.percentile(item[0], 50)
+            return 0 if p50 is None else p50
+        return sorted(candidates, key=key)
+
+    def summary_lines(self):
+        lines = []
+        for model in sorted(self._touched):
+            lines.append(f"{model}: p50 {self.percentile(model, 50):.1f}s / "
+                         f"p95 {self.percentile(model, 95):.1f}s ({len(self._samples[model])} samples)")
+        return lines
+
+LLM_LATENCY = LatencyTracker(LLM_LATENCY_FILE)
+atexit.register(LLM_LATENCY.flush)
+
+# === PROVIDER HEALTH (Circuit breaker per LLM model) ===
+PROVIDER_HEALTH_FILE = os.path.join(DATA_DIR, "provider_health.json")
+CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "3"))  # Consecutive failures before opening
+CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "300"))  # Seconds; doubles on each re-open
+CIRCUIT_MAX_COOLDOWN = 6 * 3600
+
+def parse_retry_after(value):
+    """Retry-After header → seconds (accepts delta-seconds or an HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class ProviderHealth:
+    """Persistent circuit breaker shared across runs.
+    closed → open after repeated failures (or at once on 401/403/429),
+    open → half-open when the cooldown (or Retry-After) expires; a single
+    trial request then closes it again or re-opens it with double cooldown."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._trials = set()  # Half-open models with a trial request in flight
+        try:
+            with open(path, "r") as f:
+                self._models = json.load(f)
+        except (OSError, ValueError):
+            self._models = {}
+
+    def _state(self, model):
+        return self._models.setdefault(model, {
+            "failures": 0, "open_until": 0, "cooldown": CIRCUIT_COOLDOWN,
+            "score": 1.0, "last_status": None,
+        })
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._models, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def is_open(self, model):
+        """True while the circuit is open (no request should be sent)."""
+        state = self._models.get(model)
+        return bool(state) and time.time() < state["open_until"]
+
+    def allow(self, model):
+        """Gate a request. Half-open circuits let exactly one trial through."""
+        with self._lock:
+            state = self._models.get(model)
+            if not state or not state["open_until"]:
+                return True
+            if time.time() < state["open_until"] or model in self._trials:
+                return False
+            self._trials.add(model)
+            return True
+
+    def record_success(self, model):
+        with self._lock:
+            state = self._state(model)
+            was_open = bool(state["open_until"])
+            state.update(failures=0, open_until=0, cooldown=CIRCUIT_COOLDOWN, last_status=200)
+            state["score"] = round(0.8 * state["score"] + 0.2, 3)
+            self._trials.discard(model)
+            self._save()
+        if was_open:
+            log('success', f"[Health] {model} recovered, circuit closed")
+
+    def record_failure(self, model, status=None, retry_after=None):
+        with self._lock:
+            state = self._state(model)
+            state["failures"] += 1
+            state["last_status"] = status
+            state["score"] = round(0.8 * state["score"], 3)
+            half_open = model in self._trials
+            self._trials.discard(model)
+
+            wait_s = parse_retry_after(retry_after)
+            should_open = (half_open or wait_s is not None or status in (401, 403, 429)
+                           or state["failures"] >= CIRCUIT_FAILURES)
+            if not should_open:
+                self._save()
+                return
+            if half_open:
+                state["cooldown"] = min(state["cooldown"] * 2, CIRCUIT_MAX_COOLDOWN)
+            cooldown = wait_s if wait_s is not None else state["cooldown"]
+            state["open_until"] = time.time() + cooldown
+            self._save()
+        log('warning', f"[Health] {model} circuit OPEN for {cooldown:.0f}s (status {status})")
+
+    def summary_lines(self):
+        lines = []
+        for model, state in sorted(self._models.items()):
+            if self.is_open(model):
+                left = state["open_until"] - time.time()
+                lines.append(f"{model}: OPEN {left:.0f}s (score {state['score']:.2f}, last {state['last_status']})")
+        return lines
+
+PROVIDER_HEALTH = ProviderHealth(PROVIDER_HEALTH_FILE)
+
+def detect_loras():
+    """Detect available LoRAs from the cached server capability snapshot"""
+    loras = FORGE_CAPS.loras
+    log('debug', f"Found {len(loras)} LoRAs: {[l['name'] for l in loras]}")
+    return loras
 
 def build_lora_block():
     """Build LoRA activation string based on available LoRAs.
@@ -282,135 +995,233 @@ def build_lora_block():
     
     return ", ".join(lora_tags)
 
-def call_groq(theme):
-    """Call Groq API for prompt generation"""
-    if not GROQ_KEY:
-        return None
+def clean_llm_response(content):
+    """Strip quotes, <think> blocks and explanations; keep the first tag line."""
+    content = content.strip().strip('"\'')
+    # If content starts with thinking process <think>, remove it
+    if '<think>' in content:
+        content = content.split('</think>')[-1].strip()
     
+    if '\n' in content:
+        lines = [l.strip() for l in content.split('\n') if l.strip()]
+        if lines:
+            # Prefer the last line if it looks like tags, or first line if narrative
+            content = lines[0]
+    return content.strip('"\'')
+
+def request_groq(model, theme):
+    """Single Groq chat completion. Returns cleaned content or None."""
     headers = {
         "Authorization": f"Bearer {GROQ_KEY}",
         "Content-Type": "application/json"
     }
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": PROMPT_SYSTEM},
+            {"role": "user", "content": f"Create a prompt for theme: {theme}"}
+        ],
+        "temperature": 0.7,
+        "max_tokens": 256
+    }
     
-    for model in GROQ_MODELS:
-        log('ai', f"[Groq] Trying {model}...")
-        try:
-            payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": PROMPT_SYSTEM},
-                    {"role": "user", "content": f"Create a prompt for theme: {theme}"}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 256
-            }
-            
-            resp = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=15
-            )
-            
-            if resp.status_code == 200:
-                content = resp.json()['choices'][0]['message']['content'].strip()
-                # Clean up response (remove quotes, explanations)
-                content = content.strip('"\'')
-                if '\n' in content:
-                    content = content.split('\n')[0]  # Take first line only
+    if not PROVIDER_HEALTH.allow(model):
+        log('debug', f"[Groq] {model} skipped (circuit open)")
+        return None
+    
+    status, retry_after = None, None
+    start = time.time()
+    try:
+        resp = requests.post(
+            GROQ_API_URL,
+            headers=headers,
+            json=payload,
+            timeout=15
+        )
+        
+        if resp.status_code == 200:
+            # Clean up response (remove quotes, explanations)
+            content = clean_llm_response(resp.json()['choices'][0]['message']['content'])
+            if content:
+                LLM_LATENCY.record(model, time.time() - start)
+                PROVIDER_HEALTH.record_success(model)
                 log('success', f"[Groq] {model} responded!")
                 return content
-            else:
-                log('warning', f"[Groq] {model} failed: {resp.status_code}")
-                
-        except Exception as e:
-            log('warning', f"[Groq] {model} error: {str(e)[:50]}")
+            log('warning', f"   ⚠️ Empty response from {model}")
+        else:
+            log('warning', f"[Groq] {model} failed: {resp.status_code}")
+            status, retry_after = resp.status_code, resp.headers.get("Retry-After")
+            
+    except Exception as e:
+        log('warning', f"[Groq] {model} error: {str(e)[:50]}")
     
+    PROVIDER_HEALTH.record_failure(model, status, retry_after)
+    LLM_LATENCY.record_failure(model, timeout=15)
     return None
 
-def call_openrouter(theme):
-    """Call OpenRouter API for prompt generation"""
-    if not OPENROUTER_KEY:
-        return None
-    
+def request_openrouter(model, theme):
+    """Single OpenRouter chat completion. Returns cleaned content or None."""
     headers = {
         "Authorization": f"Bearer {OPENROUTER_KEY}",
         "Content-Type": "application/json",
         "HTTP-Referer": "https://ladynuggets.com",
         "X-Title": "Lady Nuggets Factory"
     }
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": PROMPT_SYSTEM},
+            {"role": "user", "content": f"Create a prompt for theme: {theme}"}
+        ],
+        "max_tokens": 256
+    }
     
-    for model in OPENROUTER_MODELS:
-        log('ai', f"[OpenRouter] Trying {model}...")
-        try:
-            payload = {
-                "model": model,
-                "messages": [
-                    {"role": "system", "content": PROMPT_SYSTEM},
-                    {"role": "user", "content": f"Create a prompt for theme: {theme}"}
-                ],
-                "max_tokens": 256
-            }
-            
-            resp = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=20
-            )
-            
-            if resp.status_code == 200:
-                content = resp.json()['choices'][0]['message']['content'].strip()
-                log('debug', f"   📝 Raw response: {content[:100]}...")  # Debug log
-                content = content.strip('"\'')
-                # If content starts with thinking process <think>, remove it
-                if '<think>' in content:
-                    content = content.split('</think>')[-1].strip()
-                
-                if '\n' in content:
-                    lines = [l.strip() for l in content.split('\n') if l.strip()]
-                    if lines:
-                        # Prefer the last line if it looks like tags, or first line if narrative
-                        content = lines[0] 
-                
-                if not content:
-                    log('warning', f"   ⚠️ Empty response from {model}")
-                    continue  # Try next model in list
-                    
+    if not PROVIDER_HEALTH.allow(model):
+        log('debug', f"[OpenRouter] {model} skipped (circuit open)")
+        return None
+    
+    status, retry_after = None, None
+    start = time.time()
+    try:
+        resp = requests.post(
+            OPENROUTER_API_URL,
+            headers=headers,
+            json=payload,
+            timeout=20
+        )
+        
+        if resp.status_code == 200:
+            content = resp.json()['choices'][0]['message']['content'].strip()
+            log('debug', f"   📝 Raw response: {content[:100]}...")  # Debug log
+            content = clean_llm_response(content)
+            if content:
+                LLM_LATENCY.record(model, time.time() - start)
+                PROVIDER_HEALTH.record_success(model)
                 log('success', f"[OpenRouter] {model} responded: {content[:50]}...")
                 return content
-            else:
-                log('warning', f"[OpenRouter] {model} failed: {resp.status_code}")
-                if resp.status_code == 401:
-                    try:
-                        err_msg = resp.json().get('error', {}).get('message', resp.text)
-                        log('warning', f"   ❌ Error details: {err_msg}")
-                    except:
-                        log('warning', f"   ❌ Response body: {resp.text[:200]}")
-                
-        except Exception as e:
-            log('warning', f"[OpenRouter] {model} error: {str(e)[:50]}")
+            log('warning', f"   ⚠️ Empty response from {model}")
+        else:
+            log('warning', f"[OpenRouter] {model} failed: {resp.status_code}")
+            status, retry_after = resp.status_code, resp.headers.get("Retry-After")
+            if resp.status_code == 401:
+                try:
+                    err_msg = resp.json().get('error', {}).get('message', resp.text)
+                    log('warning', f"   ❌ Error details: {err_msg}")
+                except:
+                    log('warning', f"   ❌ Response body: {resp.text[:200]}")
+            
+    except Exception as e:
+        log('warning', f"[OpenRouter] {model} error: {str(e)[:50]}")
+    
+    PROVIDER_HEALTH.record_failure(model, status, retry_after)
+    LLM_LATENCY.record_failure(model, timeout=20)
+    return None
+
+def call_groq(theme):
+    """Call Groq API for prompt generation. Returns (model, content) or None."""
+    if not GROQ_KEY:
+        return None
+    
+    for model in GROQ_MODELS:
+        log('ai', f"[Groq] Trying {model}...")
+        content = request_groq(model, theme)
+        if content:
+            return model, content
+    
+    return None
+
+def call_openrouter(theme):
+    """Call OpenRouter API for prompt generation. Returns (model, content) or None."""
+    if not OPENROUTER_KEY:
+        return None
+    
+    for model in OPENROUTER_MODELS:
+        log('ai', f"[OpenRouter] Trying {model}...")
+        content = request_openrouter(model, theme)
+        if content:
+            return model, content
     
     return None
 
+def race_llm_prompt(theme):
+    """Race the configured providers: up to LLM_RACE_WIDTH requests in flight,
+    fastest models (by recorded p50) first. With LLM_HEDGE_DELAY > 0 the next
+    model is only fired if nobody answered within that many seconds.
+    HTTP requests can't be aborted, so the losers run to completion in the
+    background: their answers are dropped, but their latency and failures
+    still feed LLM_LATENCY and PROVIDER_HEALTH like any other call.
+    Returns (model, content) for the first valid answer, or None."""
+    candidates = []
+    if OPENROUTER_KEY:
+        candidates += [(model, request_openrouter) for model in OPENROUTER_MODELS]
+    if GROQ_KEY:
+        candidates += [(model, request_groq) for model in GROQ_MODELS]
+    candidates = LLM_LATENCY.rank([c for c in candidates if not PROVIDER_HEALTH.is_open(c[0])])
+    if not candidates:
+        return None
+    
+    executor = ThreadPoolExecutor(max_workers=LLM_RACE_WIDTH, thread_name_prefix="llm-race")
+    in_flight = {}
+    next_hedge = 0
+    try:
+        while True:
+            # Launch more contenders while slots (and the hedge timer) allow
+            now = time.time()
+            while candidates and len(in_flight) < LLM_RACE_WIDTH and (not in_flight or now >= next_hedge):
+                model, request_fn = candidates.pop(0)
+                log('ai', f"[Race] Firing {model}...")
+                in_flight[executor.submit(request_fn, model, theme)] = model
+                next_hedge = now + LLM_HEDGE_DELAY
+            if not in_flight:
+                return None
+            
+            hedging = candidates and len(in_flight) < LLM_RACE_WIDTH
+            timeout = max(0, next_hedge - time.time()) if hedging else None
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                model = in_flight.pop(future)
+                content = future.result()
+                if content:
+                    log('success', f"[Race] {model} won ({len(in_flight)} still running, answers dropped)")
+                    return model, content
+                next_hedge = 0  # A contender failed: replace it right away
+    finally:
+        # Don't wait for the losers: they finish in the background (see docstring)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def fetch_llm_prompt(theme):
+    """Ask the LLM providers directly (OpenRouter → Groq), bypassing PROMPT_CACHE.
+    Returns (model, content) or None if all fail."""
+    if LLM_RACE_WIDTH > 1:
+        return race_llm_prompt(theme)
+    
+    # Try OpenRouter first (paid, reliable), fall back to Groq (free tier, daily limits)
+    return call_openrouter(theme) or call_groq(theme)
+
+def with_oc_lora(model, result):
+    """FEATURE FLAG: Force OC LoRA on Groq prompts if requested and not present."""
+    if model in GROQ_MODELS and FORCE_OC and "<lora:LadyNuggets" not in result:
+        result += f" <lora:LadyNuggets:{LORA_WEIGHT}>"
+    return result
+
 def get_ai_prompt(theme):
     """Get AI-generated prompt with fallback chain"""
     log('ai', f"Generating prompt for theme: '{theme}'")
     
-    # Try OpenRouter first (paid, reliable)
-    if OPENROUTER_KEY:
-        result = call_openrouter(theme)
-        if result:
-            return result
+    # Serve from cache when a configured provider already answered this theme
+    cache_models = (OPENROUTER_MODELS if OPENROUTER_KEY else []) + (GROQ_MODELS if GROQ_KEY else [])
+    cached = PROMPT_CACHE.get(theme, cache_models)
+    if cached:
+        model, result = cached
+        log('success', f"[Cache] Reusing {model} prompt for '{theme}'")
+        return with_oc_lora(model, result)
     
-    # Fallback to Groq (free tier, daily limits)
-    if GROQ_KEY:
-        result = call_groq(theme)
-        if result:
-            # FEATURE FLAG: Force OC LoRA if requested and not present
-            if FORCE_OC and "<lora:LadyNuggets" not in result:
-                result += f" <lora:LadyNuggets:{LORA_WEIGHT}>"
-            return result
+    with TRACER.span("llm", theme=theme) as span:
+        fetched = fetch_llm_prompt(theme)
+        span["ok"] = bool(fetched)
+    if fetched:
+        PROMPT_CACHE.put(theme, *fetched)
+        return with_oc_lora(*fetched)
     
     # Ultimate fallback — rich Danbooru-style prompts per theme
     log('warning', "All AI providers failed. Using built-in PROFESSIONAL prompt library.")
@@ -429,10 +1240,8 @@ def get_ai_prompt(theme):
 def get_model_info():
     """Get current model info from server. Prioritizes OneObsession > WAI."""
     try:
-        resp = requests.get(f"{REFORGE_API}/sdapi/v1/sd-models", timeout=5)
-        if resp.status_code == 200:
-            models = resp.json()
-            
+        models = FORGE_CAPS.models
+        if models:
             # Priority 1: OneObsession (User Request: Pinup/Ecchi)
             for m in models:
                 if 'oneobsession' in m['title'].lower() or 'obsession' in m['title'].lower():
@@ -456,7 +1265,7 @@ def get_model_info():
                     return m['title']
             
             # Last resort: first model
-            return models[0]['title'] if models else None
+            return models[0]['title']
     except:
         pass
     return "waiIllustriousSDXL_v160.safetensors"
@@ -466,39 +1275,282 @@ def log_server_state():
     print(f"\n{Colors.CYAN}{'='*60}{Colors.END}")
     log('debug', "Server Inventory:")
     
-    try:
-        # Refresh models
-        requests.post(f"{REFORGE_API}/sdapi/v1/refresh-checkpoints", timeout=5)
-        
-        # List models
-        resp = requests.get(f"{REFORGE_API}/sdapi/v1/sd-models", timeout=5)
-        if resp.status_code == 200:
-            models = [m['title'] for m in resp.json()]
-            print(f"   {Colors.WHITE}📂 Checkpoints ({len(models)}):{Colors.END}")
-            for m in models:
-                print(f"      - {m}")
-        
-        # List LoRAs
-        resp = requests.get(f"{REFORGE_API}/sdapi/v1/loras", timeout=5)
-        if resp.status_code == 200:
-            loras = [l['name'] for l in resp.json()]
-            print(f"   {Colors.WHITE}🧩 LoRAs ({len(loras)}):{Colors.END}")
-            for l in loras:
-                print(f"      - {l}")
-                
-    except Exception as e:
-        log('error', f"Failed to query server: {e}")
+    snapshot = FORGE_CAPS.load()
+    age = time.time() - snapshot.get("fetched_at", time.time())
+    log('debug', f"Capability snapshot age: {age:.0f}s (--refresh-capabilities to rescan)")
+    
+    # List models
+    models = [m['title'] for m in FORGE_CAPS.models]
+    print(f"   {Colors.WHITE}📂 Checkpoints ({len(models)}):{Colors.END}")
+    for m in models:
+        print(f"      - {m}")
+    
+    # List LoRAs
+    loras = [l['name'] for l in FORGE_CAPS.loras]
+    print(f"   {Colors.WHITE}🧩 LoRAs ({len(loras)}):{Colors.END}")
+    for l in loras:
+        print(f"      - {l}")
+    
+    if not models:
+        log('error', "Failed to query server: no checkpoints reported")
     
     print(f"{Colors.CYAN}{'='*60}{Colors.END}\n")
 
-def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_hires=False, output_dir=None):
+# === BATCHING ===
+BASE_WIDTH = 832
+BASE_HEIGHT = 1216
+VRAM_BUDGET_GB = float(os.getenv("FORGE_VRAM_GB", "0"))  # 0 = ask the server (/sdapi/v1/memory)
+VRAM_RESERVED_GB = 7.0  # SDXL weights + Forge overhead that stay resident
+VRAM_PER_MEGAPIXEL_GB = 1.0  # Activations/VAE decode per output megapixel (conservative)
+MAX_AUTO_BATCH = 8
+BATCH_PROMPTS = os.getenv("FACTORY_BATCH_PROMPTS", "true").lower() == "true"  # One LLM prompt per image in a batch
+PROMPT_LISTS_REJECTED = set()  # Backends whose API schema only takes a single prompt string (422)
+
+def new_seed():
+    """Explicit seed for a job, so every image is reproducible from its metadata."""
+    return random.randint(0, 2**32 - 1)
+
+def auto_batch_size(upscale_factor=2.0, no_hires=False):
+    """Largest batch_size that fits the VRAM budget at the final output size."""
+    budget = VRAM_BUDGET_GB
+    if not budget:
+        try:
+            memory = FORGE.get("/sdapi/v1/memory").json()
+            budget = memory["cuda"]["system"]["total"] / 1024**3
+        except Exception as e:
+            log('warning', f"Could not read GPU memory ({str(e)[:50]}), using batch size 1")
+            return 1
+    scale = upscale_factor if not no_hires and upscale_factor > 1.0 else 1.0
+    megapixels = BASE_WIDTH * scale * BASE_HEIGHT * scale / 1e6
+    size = int((budget - VRAM_RESERVED_GB) // (megapixels * VRAM_PER_MEGAPIXEL_GB))
+    size = max(1, min(MAX_AUTO_BATCH, size))
+    log('info', f"Auto batch size: {size} ({budget:.0f} GB VRAM, {megapixels:.1f} MP per image)")
+    return size
+
+def plan_batches(count, batch_size=1, n_iter=1):
+    """Split --count images into (batch_size, n_iter) requests."""
+    per_request = batch_size * n_iter
+    full, rest = divmod(count, per_request)
+    plan = [(batch_size, n_iter)] * full
+    if rest >= batch_size:
+        plan.append((batch_size, rest // batch_size))
+    if rest % batch_size:
+        plan.append((rest % batch_size, 1))
+    return plan
+
+# === CHECKPOINT AFFINITY (Drain one checkpoint before loading the next) ===
+CHECKPOINTS = CheckpointTracker(log=log)
+
+def resolve_checkpoints(names):
+    """Match --models name fragments against the server's checkpoint titles."""
+    titles = [m['title'] for m in FORGE_CAPS.models]
+    resolved = []
+    for name in names:
+        name = name.strip().lower()
+        match = next((t for t in titles if name and name in t.lower()), None)
+        if match:
+            resolved.append(match)
+        elif name:
+            log('warning', f"Checkpoint not found on server: {name}")
+    return resolved
+
+def assign_checkpoints(plan, checkpoints, vae=None, affinity=True):
+    """Give every request of the plan a checkpoint (round-robin) and, with
+    affinity, group requests by checkpoint starting with the one Forge has loaded.
+    Returns (batch_size, n_iter, checkpoint, vae) tuples."""
+    plan = [(bs, ni, checkpoints[i % len(checkpoints)], vae) for i, (bs, ni) in enumerate(plan)]
+    if affinity and len(checkpoints) > 1:
+        order = sorted(dict.fromkeys(checkpoints), key=lambda c: not CHECKPOINTS.is_loaded(FORGE, c, vae))
+        plan.sort(key=lambda request: order.index(request[2]))
+    return plan
+
+# === RESULT CACHE (Identical payload + seed → same PNGs, served from disk) ===
+# Off by default here: every job draws a fresh seed, so a payload only repeats when a
+# stored job is rendered again (e.g. --resume after its output was packaged away).
+# ComfyUI/Discord derive the seed from the request and keep the cache on (RESULT_CACHE).
+RESULT_CACHE = ResultCache(enabled=RESULT_CACHE_ENABLED and os.getenv("FACTORY_RESULT_CACHE", "false").lower() == "true")
+
+# === OUTPUT WRITER (PNG/JSON writes off the render thread, temp file + rename) ===
+OUTPUT_WRITER = OutputWriter(log=lambda level, msg: log(level, msg))
+# Where per-image metadata goes: "sidecar" (.json next to the PNG), "png" (iTXt chunk) or "both"
+METADATA_MODES = ["sidecar", "png", "both"]
+METADATA_MODE = os.getenv("FACTORY_METADATA", "sidecar").lower()
+
+def set_metadata_mode(mode):
+    global METADATA_MODE
+    METADATA_MODE = mode
+
+def output_name(seed, idx):
+    """lady_nuggets_{timestamp}_{seed}_{idx}_{suffix}: unique even for the same
+    seed rendered twice in one second (cache hits, finalize, parallel backends)."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"lady_nuggets_{timestamp}_{seed}_{idx}_{unique_suffix()}"
+
+def image_metadata(metadata, all_seeds, seed, idx):
+    """Metadata of one image of a batch, with its own seed (and prompt, for per-image prompts)."""
+    image_meta = dict(metadata, batch_index=idx)
+    if isinstance(metadata.get("prompt"), list):
+        image_meta["prompt"] = metadata["prompt"][min(idx, len(metadata["prompt"]) - 1)]
+    if idx < len(all_seeds):
+        image_meta["seed"] = all_seeds[idx]
+    elif seed != -1:
+        image_meta["seed"] = seed + idx
+    return image_meta
+
+def save_metadata(saved, png_writers, metadata, all_seeds, seed):
+    """Hand each image its metadata: embedded via its PngTextWriter and/or a
+    queued JSON sidecar (METADATA_MODE). Returns the sidecar writer futures."""
+    futures = []
+    for idx, filepath in enumerate(saved):
+        image_meta = image_metadata(metadata, all_seeds, seed, idx)
+        if png_writers:
+            png_writers[idx].set_metadata(image_meta)
+        if METADATA_MODE != "png":
+            json_filepath = filepath[:-len(".png")] + ".json"
+            futures.append(OUTPUT_WRITER.write_json(json_filepath, image_meta))
+        log('success', f"Saved: {os.path.basename(filepath)}" + (" + .json" if METADATA_MODE != "png" else ""))
+    return futures
+
+# === FORGE BACKEND POOL (One Forge instance per GPU) ===
+FORGE_BACKENDS = os.getenv("FORGE_BACKENDS", "")  # Comma-separated URLs (empty = scan SD_API_PORTS)
+BACKEND_MAX_INFLIGHT = int(os.getenv("FORGE_BACKEND_INFLIGHT", "1"))  # Forge renders one job at a time
+BACKEND_RETRY_AFTER = float(os.getenv("FORGE_BACKEND_RETRY", "30"))  # Seconds before re-probing an evicted backend
+BACKEND_ACQUIRE_TIMEOUT = 300
+JOB_ATTEMPTS = 2  # A failed job is retried once on another backend
+
+class ForgeBackend:
+    def __init__(self, client):
+        self.client = client
+        self.outstanding = 0
+        self.completed = 0
+        self.failures = 0  # Consecutive connection failures (eviction back-off)
+        self.errors = 0    # Failed renders on a reachable backend (500/OOM, bad response)
+        self.evicted_until = 0.0  # 0 = in rotation
+        self.probing = False
+    
+    @property
+    def url(self):
+        return self.client.base_url
+
+class ForgePool:
+    """Dispatches render jobs over every live Forge instance using
+    least-outstanding-requests. A backend that cannot be reached (connection
+    error / timeout) is evicted and re-probed after BACKEND_RETRY_AFTER seconds
+    (backing off on repeat failures); one that answers with an error stays in
+    rotation and the job is retried elsewhere."""
+    
+    def __init__(self, primary, max_inflight=BACKEND_MAX_INFLIGHT, retry_after=BACKEND_RETRY_AFTER):
+        self.primary = primary
+        self.max_inflight = max(1, max_inflight)
+        self.retry_after = retry_after
+        self.backends = []
+        self.cond = threading.Condition()
+    
+    def discover(self):
+        """Primary API first, then every other live SD API (or FORGE_BACKENDS)."""
+        urls = [u.strip().rstrip("/") for u in FORGE_BACKENDS.split(",") if u.strip()]
+        if not urls:
+            urls = discover_sd_apis()
+        primary_url = self.primary.base_url
+        ordered = [primary_url] + [u for u in dict.fromkeys(urls) if u != primary_url]
+        self.backends = [ForgeBackend(self.primary if url == primary_url else ForgeClient(base_url=url))
+                         for url in ordered]
+        return len(self.backends)
+    
+    @property
+    def workers(self):
+        return len(self.backends) * self.max_inflight
+    
+    def _readmit(self, backend):
+        # Called with the lock held; probes without it so other workers keep dispatching
+        backend.probing = True
+        self.cond.release()
+        try:
+            alive = probe_sd_api(backend.url) is not None
+        finally:
+            self.cond.acquire()
+            backend.probing = False
+        if alive:
+            backend.evicted_until = 0.0
+            log('success', f"Forge backend back in rotation: {backend.url}")
+            self.cond.notify_all()
+        else:
+            backend.evicted_until = time.time() + self.retry_after * min(backend.failures, 4)
+    
+    def acquire(self, prefer=None, avoid=None, timeout=BACKEND_ACQUIRE_TIMEOUT):
+        """Reserve the backend with the fewest in-flight jobs (other than avoid, if
+        another one is free). Blocks while all are busy or evicted; returns None if
+        nothing is available before the timeout."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                ready = [b for b in self.backends if not b.evicted_until and b.outstanding < self.max_inflight]
+                if ready:
+                    # Least outstanding first, then the backend the caller prefers (checkpoint loaded)
+                    backend = min(ready, key=lambda b: (b is avoid, b.outstanding,
+                                                        not prefer(b) if prefer else False, b.completed))
+                    backend.outstanding += 1
+                    return backend
+                
+                due = [b for b in self.backends if b.evicted_until and not b.probing and b.evicted_until <= now]
+                if due:
+                    self._readmit(due[0])
+                    continue
+                
+                if now >= deadline:
+                    return None
+                waits = [deadline - now] + [b.evicted_until - now for b in self.backends
+                                            if b.evicted_until and not b.probing]
+                self.cond.wait(max(0.05, min(waits)))
+    
+    def release(self, backend, ok, reachable=True):
+        """ok: the job rendered. reachable=False (connection error / timeout) evicts
+        the backend; a failed render on a reachable backend only counts an error."""
+        with self.cond:
+            backend.outstanding -= 1
+            if ok:
+                backend.completed += 1
+                backend.failures = 0
+            elif reachable:
+                backend.errors += 1
+                backend.failures = 0
+            else:
+                backend.failures += 1
+                retry_in = self.retry_after * min(backend.failures, 4)
+                backend.evicted_until = time.time() + retry_in
+                log('warning', f"Forge backend evicted: {backend.url} (retry in {retry_in:.0f}s)")
+            self.cond.notify_all()
+    
+    def summary_lines(self):
+        lines = []
+        for b in self.backends:
+            state = " [evicted]" if b.evicted_until else ""
+            lines.append(f"{b.url}: {b.completed} requests ok, {b.errors} render errors, "
+                         f"{b.failures} recent connection failures{state}")
+        return lines
+
+FORGE_POOL = ForgePool(FORGE)
+
+def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_hires=False, output_dir=None,
+                   batch_size=1, n_iter=1, seed=-1, client=None, draft=False, on_written=None, init_image=None):
     """Call SD API with retry logic
     Args:
+        prompt: one prompt for the whole request, or a list with one prompt per image
         upscale_factor: 2.0 (default for high qual), 1.5, 1.0 (off)
         output_dir: Directory to save images to (fixes ZIP bug)
+        batch_size/n_iter: images per request (seeds seed, seed+1, ...)
+        seed: base seed (-1 = let Forge pick; recorded per image either way)
+        client: ForgeClient of the backend to render on (default: primary API)
+        draft: base resolution only (no hires, no ADetailer) for scoring before finalizing
+        init_image: base64 PNG of a draft to finalize through img2img: upscaled and
+                    resampled like the hires pass, then ADetailer (needs hires enabled)
+        on_written: called with the image count (0 on a write error) once the PNGs and
+                    sidecars are on disk; files are written in the background by OUTPUT_WRITER
     """
     if output_dir is None:
         output_dir = OUTPUT_DIR
+    forge = client or FORGE
     log('gen', f"Starting generation with model: {model_name}")
     
     # Detect model type
@@ -539,11 +1591,13 @@ def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_h
         # High Quality Settings
         "steps": steps,
         "cfg_scale": cfg,
-        "width": 832,
-        "height": 1216,
+        "width": BASE_WIDTH,
+        "height": BASE_HEIGHT,
         "sampler_name": sampler,
         "scheduler": "Karras",
-        "batch_size": 1,
+        "batch_size": batch_size,
+        "n_iter": n_iter,
+        "seed": seed,
         
         "override_settings": {
             "sd_model_checkpoint": model_name,
@@ -552,8 +1606,23 @@ def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_h
     }
     
     # Hires Fix (2x Default)
-    use_hires = not no_hires and upscale_factor > 1.0
-    if use_hires:
+    use_hires = not no_hires and upscale_factor > 1.0 and not draft
+    endpoint = "img2img" if init_image else "txt2img"
+    if init_image:
+        # Finalize: the draft is the first pass, only the hires pass is sampled
+        final_w = int(BASE_WIDTH * upscale_factor)
+        final_h = int(BASE_HEIGHT * upscale_factor)
+        payload.update({
+            "init_images": [init_image],
+            "resize_mode": 0,  # Just resize, through upscaler_for_img2img
+            "width": final_w,
+            "height": final_h,
+            "denoising_strength": hr_denoise,
+            "steps": hr_steps,
+        })
+        payload["override_settings"]["upscaler_for_img2img"] = "R-ESRGAN 4x+ Anime6B"
+        log('info', f"Hires from draft: {upscale_factor}x → {final_w}x{final_h} (img2img, denoise {hr_denoise}, steps {hr_steps})")
+    elif use_hires:
         payload.update({
             "enable_hr": True,
             "hr_scale": upscale_factor,
@@ -562,8 +1631,8 @@ def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_h
             "hr_second_pass_steps": hr_steps,
             "hr_cfg_scale": cfg,
         })
-        final_w = int(832 * upscale_factor)
-        final_h = int(1216 * upscale_factor)
+        final_w = int(BASE_WIDTH * upscale_factor)
+        final_h = int(BASE_HEIGHT * upscale_factor)
         log('info', f"Hires Fix: {upscale_factor}x → {final_w}x{final_h} (denoise {hr_denoise}, steps {hr_steps})")
     else:
         payload["enable_hr"] = False
@@ -571,41 +1640,36 @@ def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_h
     
     # ADetailer: HIGH RES FIX (1024x1024)
     # This prevents the blurry face issue by rendering the face at high res before pasting back
-    try:
-        scripts_resp = requests.get(f"{REFORGE_API}/sdapi/v1/scripts", timeout=5)
-        if scripts_resp.status_code == 200:
-            scripts_data = scripts_resp.json()
-            available_scripts = [s.lower() for s in scripts_data.get("txt2img", [])]
-            if "adetailer" in available_scripts:
-                payload["alwayson_scripts"] = {
-                    "ADetailer": {
-                        "args": [
-                            {   # Slot 1: Face fix (High Res)
-                                "ad_model": "face_yolov8n.pt",
-                                "ad_prompt": "detailed face, beautiful eyes, perfect face",
-                                "ad_negative_prompt": "ugly face, deformed face, gas mask, mask",
-                                "ad_confidence": 0.3,
-                                "ad_denoising_strength": 0.4,
-                                "ad_inpaint_width": 1024,
-                                "ad_inpaint_height": 1024
-                            },
-                            {   # Slot 2: Hand fix (High Res)
-                                "ad_model": "hand_yolov8n.pt",
-                                "ad_prompt": "detailed hands, perfect fingers, 5 fingers",
-                                "ad_negative_prompt": "extra fingers, fewer fingers, bad hands, 6 fingers",
-                                "ad_confidence": 0.3,
-                                "ad_denoising_strength": 0.45,
-                                "ad_inpaint_width": 1024,
-                                "ad_inpaint_height": 1024
-                            }
-                        ]
+    if draft:
+        log('info', "Draft: ADetailer skipped until finalize")
+    elif FORGE_CAPS.has_script("adetailer", kind=endpoint):
+        payload["alwayson_scripts"] = {
+            "ADetailer": {
+                "args": [
+                    {   # Slot 1: Face fix (High Res)
+                        "ad_model": "face_yolov8n.pt",
+                        "ad_prompt": "detailed face, beautiful eyes, perfect face",
+                        "ad_negative_prompt": "ugly face, deformed face, gas mask, mask",
+                        "ad_confidence": 0.3,
+                        "ad_denoising_strength": 0.4,
+                        "ad_inpaint_width": 1024,
+                        "ad_inpaint_height": 1024
+                    },
+                    {   # Slot 2: Hand fix (High Res)
+                        "ad_model": "hand_yolov8n.pt",
+                        "ad_prompt": "detailed hands, perfect fingers, 5 fingers",
+                        "ad_negative_prompt": "extra fingers, fewer fingers, bad hands, 6 fingers",
+                        "ad_confidence": 0.3,
+                        "ad_denoising_strength": 0.45,
+                        "ad_inpaint_width": 1024,
+                        "ad_inpaint_height": 1024
                     }
-                }
-                log('success', "ADetailer: face + hand fix enabled (@ 1024px)")
-            else:
-                log('warning', "ADetailer not found")
-    except Exception:
-        pass
+                ]
+            }
+        }
+        log('success', "ADetailer: face + hand fix enabled (@ 1024px)")
+    else:
+        log('warning', "ADetailer not found")
 
     # FreeU Integration (Quality Boost)
     # Using conservative settings for SDXL/Pony/Illustrious
@@ -637,43 +1701,131 @@ def generate_image(prompt, negative_prompt, model_name, upscale_factor=2.0, no_h
             "timestamp": datetime.now().isoformat(),
             "prompt": prompt,
             "negative_prompt": negative_prompt,
-            "steps": payload["steps"],
+            "steps": steps,
             "cfg_scale": payload["cfg_scale"],
             "sampler": payload["sampler_name"],
             "model": model_name,
             "hires_upscale": upscale_factor if use_hires else "None",
-            "denoising_strength": hr_denoise if use_hires else "N/A"
+            "denoising_strength": hr_denoise if use_hires else "N/A",
+            "seed": seed,
+            "batch_size": batch_size,
+            "n_iter": n_iter,
+            "draft": draft,
+            "from_draft": bool(init_image),
         }
     except:
         metadata = {}
 
-    log('info', "Sending request to SD Forge...")
-    resp = requests.post(f"{REFORGE_API}/sdapi/v1/txt2img", json=payload, timeout=600)
+    images_requested = batch_size * n_iter
+    if images_requested > 1:
+        shared = "per-image prompts" if isinstance(prompt, list) else "one prompt"
+        log('info', f"Batch: {batch_size} x {n_iter} images, {shared} (seeds from {seed})")
+    
+    # Same payload (incl. explicit seed) and VAE already rendered → copy the PNGs from the cache.
+    # The VAE is set through /options, not the payload, so key on the one loaded on this backend.
+    cache_key = RESULT_CACHE.key({"payload": payload, "vae": CHECKPOINTS.current(forge)[1]})
+    cached = RESULT_CACHE.get(cache_key)
+    if cached:
+        log('success', f"Result cache hit ({cache_key[:12]}): {len(cached['paths'])} images from disk")
+        saved = []
+        futures = []
+        metadata["cached"] = True
+        all_seeds = cached["meta"].get("all_seeds", [])
+        for idx, src in enumerate(cached["paths"]):
+            filepath = os.path.join(output_dir, output_name(seed, idx) + ".png")
+            if METADATA_MODE == "sidecar":
+                RESULT_CACHE.restore(src, filepath)
+            else:
+                # Chunk-level copy so the embedded metadata describes this request
+                with OUTPUT_WRITER.open(filepath) as handle:
+                    copy_with_metadata(src, handle, image_metadata(metadata, all_seeds, seed, idx))
+                futures.append(handle.future)
+            saved.append(filepath)
+        futures += save_metadata(saved, [], metadata, all_seeds, seed)
+        OUTPUT_WRITER.when_done(futures, lambda ok: on_written and on_written(len(saved) if ok == len(futures) else 0))
+        return len(saved)
+    
+    log('info', "Sending request to SD Forge..." if forge is FORGE else f"Sending request to SD Forge ({forge.base_url})...")
+    passes = (["hires"] if init_image else ["sampling"] + (["hires"] if use_hires else [])) + \
+             (["adetailer"] if "ADetailer" in payload.get("alwayson_scripts", {}) else [])
+    with ProgressMonitor(forge, passes) as monitor:
+        resp = forge.post(f"/sdapi/v1/{endpoint}", json=payload, stream=True,
+                          timeout=forge.timeouts[endpoint] * images_requested)
+        if resp.status_code == 422 and isinstance(payload["prompt"], list):
+            # API schema types "prompt" as a string: the whole batch gets the first prompt
+            resp.close()
+            log('warning', f"{forge.base_url} rejected per-image prompts, batch shares the first one")
+            PROMPT_LISTS_REJECTED.add(forge.base_url)
+            payload["prompt"] = metadata["prompt"] = payload["prompt"][0]
+            cache_key = RESULT_CACHE.key({"payload": payload, "vae": CHECKPOINTS.current(forge)[1]})
+            resp = forge.post(f"/sdapi/v1/{endpoint}", json=payload, stream=True,
+                              timeout=forge.timeouts[endpoint] * images_requested)
+    for phase, seconds in monitor.phases.items():
+        TRACER.record(phase, seconds, backend=forge.base_url)
     
     if resp.status_code == 200:
-        data = resp.json()
-        if 'images' not in data:
+        saved = []
+        handles = []
+        png_writers = []
+        
+        def open_image(idx):
+            # Decoded chunks go to the writer threads; the file appears under its
+            # final name only once complete and fsynced
+            handle = OUTPUT_WRITER.open(os.path.join(output_dir, output_name(seed, idx) + ".png"))
+            handles.append(handle)
+            saved.append(handle.path)
+            if METADATA_MODE == "sidecar":
+                return TimedFile(handle, timings)
+            # Metadata chunk (and IEND) are written once "info" has been parsed
+            png_writers.append(PngTextWriter(handle))
+            return TimedFile(png_writers[-1], timings)
+        
+        timings = {"transfer": 0.0, "write": 0.0}
+        stream_start = time.time()
+        try:
+            chunks = timed_chunks(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE), timings)
+            _, fields = stream_json_images(chunks, open_image)
+        except (ValueError, requests.RequestException) as e:
+            log('error', f"Failed to read SD response: {e}")
+            for handle in handles:
+                handle.abort()  # Drop partial files
+            return 0
+        finally:
+            resp.close()
+        
+        TRACER.record("transfer", timings["transfer"], start=stream_start)
+        TRACER.record("decode", time.time() - stream_start - timings["transfer"] - timings["write"])
+        
+        if not saved:
             log('error', "No images returned")
-            return
-            
-        for idx, img_b64 in enumerate(data['images']):
-            # Save Image
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"lady_nuggets_{timestamp}_{idx}.png"
-            filepath = os.path.join(output_dir, filename)
+            return 0
             
-            with open(filepath, "wb") as f:
-                f.write(base64.b64decode(img_b64))
+        # Forge reports the seed actually used for every image in the batch
+        try:
+            all_seeds = json.loads(fields.get("info") or "{}").get("all_seeds") or []
+        except (ValueError, AttributeError):
+            all_seeds = []
             
-            # Save JSON Metadata
-            json_filename = f"lady_nuggets_{timestamp}_{idx}.json"
-            json_filepath = os.path.join(output_dir, json_filename)
-            with open(json_filepath, "w") as f:
-                json.dump(metadata, f, indent=2)
-                
-            log('success', f"Saved: {filename} + .json")
+        # Save JSON Metadata
+        start = time.time()
+        futures = [handle.future for handle in handles] + save_metadata(saved, png_writers, metadata, all_seeds, seed)
+        timings["write"] += time.time() - start
+        TRACER.record("write", timings["write"], images=len(saved))
+        
+        def written(ok):
+            # Writer thread: everything for this request is on disk (or failed)
+            if ok < len(futures):
+                log('error', f"Only {ok}/{len(futures)} files written for seed {seed}")
+            else:
+                try:
+                    RESULT_CACHE.put(cache_key, saved, {"all_seeds": all_seeds})
+                except OSError as e:
+                    log('warning', f"Result cache store failed: {e}")
+            if on_written:
+                on_written(len(saved) if ok == len(futures) else 0)
         
-        return len(data['images'])
+        OUTPUT_WRITER.when_done(futures, written)
+        return len(saved)
     else:
         log('error', f"Generation failed: {resp.text}")
         return 0
@@ -706,13 +1858,398 @@ def save_image(data, prompt, output_dir):
     
     return saved
 
+def get_scene_prompt(theme):
+    """Scene prompt for the render path: prefetched pool first, live LLM second."""
+    pooled = PROMPT_POOL.take(theme)
+    if pooled:
+        log('success', f"[Pool] Using prefetched prompt for '{theme}'")
+        return pooled
+    return get_ai_prompt(theme)
+
+def prefetch_themes():
+    """Themes get_scene_prompt() asks the LLM about when no --theme is given:
+    the random-char scenarios and the OC theme."""
+    themes = PINUP_SCENARIOS + [OC_THEME]
+    return list(dict.fromkeys(themes))  # Dedupe, keep order
+
+def run_prefetch(args):
+    """Top up the prompt pool to --per-theme prompts for every theme."""
+    themes = [args.theme] if args.theme else prefetch_themes()
+    available = PROMPT_POOL.counts()
+    log('info', f"Prefetching up to {args.per_theme} prompts for {len(themes)} themes")
+
+    added = 0
+    for theme in themes:
+        missing = args.per_theme - available.get(theme, 0)
+        if missing <= 0:
+            log('debug', f"'{theme[:40]}' already has {available.get(theme, 0)} prompts")
+            continue
+        for _ in range(missing):
+            # Not via PROMPT_CACHE: a cached copy would be rendered again once the pool runs dry
+            fetched = fetch_llm_prompt(theme)
+            if not fetched:
+                log('error', "All AI providers failed. Stopping prefetch (pool keeps what we have).")
+                return added
+            PROMPT_POOL.add(theme, with_oc_lora(*fetched))
+            added += 1
+    return added
+
 def load_themes():
     """Load themes. User requested to OMIT complex external themes."""
     # Return Hardcoded Pinup Themes by default
     return ["Bedroom", "Beach", "Onsen", "Gym", "Office", "Simple Background", "Poolside", "Lingerie"]
 
+# === DRAFT → FINALIZE (Hires GPU time only for winners) ===
+DRAFT_THRESHOLD = float(os.getenv("FACTORY_DRAFT_THRESHOLD", "28"))  # curator total (0-40); 28 = "standard"
+DRAFT_SCORE_DELAY = 2  # Gemini rate limit, same pause as curator.py
+
+def finalize_drafts(args, drafts_dir, output_dir):
+    """Score every draft in drafts_dir with curator's Gemini rubric and finalize
+    the ones at or above args.draft_threshold: the draft PNG is upscaled and
+    resampled through img2img (the hires pass only, same prompt and seed) plus
+    ADetailer. With hires off (--no-hires / --upscale 1) there is nothing to
+    upscale and the winner is re-rendered with txt2img + ADetailer instead.
+    Scores and results are written back into the
+    draft metadata (sidecar or PNG chunk), so this can be re-run after a crash without re-scoring.
+    Returns (scored, finalized)."""
+    try:
+        from curator import analyze_image
+    except Exception as e:  # google-generativeai missing or Gemini not configured
+        log('error', f"Draft scoring needs curator.py (Gemini): {str(e)[:80]}")
+        log('info', f"Drafts kept in {drafts_dir} (run `factory.py finalize` once curator works)")
+        return 0, 0
+
+    scored = finalized = 0
+    for png_path in sorted(glob.glob(os.path.join(drafts_dir, "*.png"))):
+        meta = read_metadata(png_path)
+        if not meta or not meta.get("draft") or meta.get("finalized"):
+            continue
+        name = os.path.basename(png_path)[:-len(".png")]
+        
+        if "draft_score" not in meta:
+            with TRACER.span("draft_score"):
+                result = analyze_image(png_path)
+            if not result:
+                log('warning', f"Draft {name}: scoring failed, will retry next finalize")
+                continue
+            meta["draft_score"] = result.get("total", 0)
+            write_metadata(png_path, meta)
+            scored += 1
+            time.sleep(DRAFT_SCORE_DELAY)
+        
+        if meta["draft_score"] < args.draft_threshold:
+            log('info', f"Draft {name}: score {meta['draft_score']} < {args.draft_threshold:g}, not finalized")
+            continue
+        
+        log('gen', f"Finalizing {name} (score {meta['draft_score']}, seed {meta['seed']})")
+        job = {"model": meta["model"], "vae": args.vae}
+        init_image = None
+        if not args.no_hires and args.upscale > 1.0:
+            with open(png_path, "rb") as f:
+                init_image = base64.b64encode(f.read()).decode()
+        with TRACER.span("job", model=meta["model"], finalize=True) as span:
+            switch_checkpoint(job, FORGE)
+            saved = generate_image(meta["prompt"], meta["negative_prompt"], meta["model"],
+                                   upscale_factor=args.upscale, no_hires=args.no_hires,
+                                   output_dir=output_dir, seed=meta["seed"], init_image=init_image) or 0
+            span["images"] = saved
+        if saved:
+            OUTPUT_WRITER.flush()  # Only mark finalized once the full-quality PNG is on disk
+            meta["finalized"] = True
+            write_metadata(png_path, meta)
+            finalized += 1
+    return scored, finalized
+
+# === JOB STAGES (Prompt builder → Render) ===
+def build_job(args, lora_block):
+    """Prompt-builder stage: pick character/scenario, call the LLM and
+    assemble the full BREAK prompt. Returns a job dict ready for rendering."""
+    # Build full prompt with BREAK sections (proven high-quality structure)
+    # Character x scenario x artist: least-rendered combination first (COMBOS)
+    choices = {"artist": ARTIST_MIXES}
+    if USE_RANDOM_CHAR:
+        choices.update(character=KNOWN_CHARACTERS, scenario=PINUP_SCENARIOS)
+    combo, combo_key = COMBOS.pick(choices)
+    artist_mix = combo["artist"]
+
+    # Character & Scenario Logic (FIXED: No more random generic girls)
+    if USE_RANDOM_CHAR:
+        # Known Waifu in one of the pinup scenarios
+        character = combo["character"]
+        char_name = character.split(",")[0].strip()
+        random_scenario = combo["scenario"]
+        log('info', f"Character: {char_name} | Scenario: {random_scenario[:20]}...")
+
+        # Combine: Identity + Scenario
+        # Note: We append the scenario to the character block
+        character_block = f"{character}, {random_scenario}"
+    else:
+        # Lady Nuggets Mode
+        character_block = OC_CHARACTER
+        log('info', "Character: Lady Nuggets OC (Forced)")
+
+    # Theme Handling
+    # If user provided a specific theme (e.g. from Discord !gen arg), use it.
+    # Otherwise, the LLM will expand on the random PINUP_SCENARIO we just picked?
+    # Actually, let's simplify:
+    # If args.theme is set -> LLM expands that theme.
+    # If not -> LLM expands the random scenario we picked.
+
+    base_theme = args.theme if args.theme else (random_scenario if USE_RANDOM_CHAR else OC_THEME)
+    log('info', f"Scenario: {base_theme[:40]}")
+    scene_block = get_scene_prompt(base_theme)
+
+
+    # INJECT EMBEDDINGS (lazypos/lazyneg)
+    # These are Textual Inversion embeddings downloaded by runpod_ultra.sh
+    embedding_pos = "lazypos, "
+    embedding_neg = "lazyneg, "
+
+    # Added "perfect eyes" trigger word here
+    section1 = f"{embedding_pos}perfect eyes, {artist_mix},\n{QUALITY_PREFIX}"
+    # Use the combined blocks
+    section2 = f"{character_block}, {scene_block}"
+    section3 = f"{QUALITY_SUFFIX}"
+    if lora_block:
+        section3 += f", {lora_block}"
+
+    full_prompt = f"{section1},\nBREAK\n{section2},\nBREAK\n{section3}"
+    final_negative = f"{embedding_neg}{NEGATIVE_PROMPT}"
+
+    log('info', f"Artists: {artist_mix}")
+    log('success', "Embeddings injected: lazypos, lazyneg")
+
+    return {
+        "prompt": full_prompt,
+        "negative_prompt": final_negative,
+        "scenario": base_theme,
+        "combo": combo_key,
+    }
+
+def switch_checkpoint(job, client):
+    """Load the job's checkpoint/VAE explicitly so swaps show up in the metrics."""
+    try:
+        swap_seconds = CHECKPOINTS.ensure(client, job["model"], job["vae"])
+        if swap_seconds:
+            TRACER.record("checkpoint_swap", swap_seconds, model=job["model"], backend=client.base_url)
+    except requests.RequestException as e:
+        log('warning', f"Checkpoint switch failed ({str(e)[:60]}), relying on override_settings")
+
+def record_result(job, saved):
+    """Queue bookkeeping; for saved > 0 this runs on a writer thread once the files landed."""
+    combos = job.get("combos") or [job.get("combo")]
+    for combo in combos:
+        COMBOS.record(combo, saved // len(combos))
+    if saved:
+        JOB_QUEUE.mark_done(job["id"], saved)
+    else:
+        JOB_QUEUE.mark_failed(job["id"])
+
+def render_job(job, args, output_dir):
+    """Render stage: send one assembled job to Forge. Returns images saved."""
+    JOB_QUEUE.mark_dispatched(job["id"])
+    with TRACER.job(job["id"]), TRACER.span("job", model=job["model"]) as span:
+        switch_checkpoint(job, FORGE)
+        result = generate_image(job["prompt"], job["negative_prompt"], job["model"],
+                               upscale_factor=args.upscale, no_hires=args.no_hires,
+                               output_dir=output_dir, batch_size=job["batch_size"],
+                               n_iter=job["n_iter"], seed=job["seed"], draft=args.draft,
+                               on_written=lambda saved: record_result(job, saved)) or 0
+        span["images"] = result
+    if not result:
+        record_result(job, 0)
+    return result
+
+def make_job(args, lora_block, entry):
+    """Prompt-builder stage for one request of the plan. The assembled job is
+    stored in the job queue before it can be dispatched."""
+    if entry["job"]:
+        # Resumed run: same prompt and seed as before the crash, no LLM call
+        return dict(entry["job"], id=entry["id"])
+    batch_size, n_iter = entry["request"][:2]
+    images = batch_size * n_iter
+    with TRACER.job(entry["id"]), TRACER.span("prompt"):
+        job = build_job(args, lora_block)
+        if images > 1 and BATCH_PROMPTS and not PROMPT_LISTS_REJECTED:
+            # One prompt (and combo) per image instead of batch_size x the same scene
+            extra = [build_job(args, lora_block) for _ in range(images - 1)]
+            job["prompt"] = [job["prompt"]] + [e["prompt"] for e in extra]
+            job["combos"] = [job.pop("combo")] + [e["combo"] for e in extra]
+    job["batch_size"], job["n_iter"], job["model"], job["vae"] = entry["request"]
+    job["seed"] = new_seed()
+    JOB_QUEUE.assemble(entry["id"], job)
+    job["id"] = entry["id"]
+    return job
+
+def recover_rendered(job, output_dir):
+    """True if every image of an assembled job is on disk with its metadata
+    (the run died after saving them but before the queue was updated)."""
+    def rendered(idx):
+        paths = (glob.glob(os.path.join(output_dir, f"lady_nuggets_*_{job['seed']}_{idx}_*.png"))
+                 + glob.glob(os.path.join(output_dir, f"lady_nuggets_*_{job['seed']}_{idx}.png")))  # Older names
+        return any(read_metadata(path) is not None for path in paths)
+    return all(rendered(idx) for idx in range(job["batch_size"] * job["n_iter"]))
+
+def job_header(done, job, count):
+    images = job["batch_size"] * job["n_iter"]
+    span = f"{done+1}" if images == 1 else f"{done+1}-{done+images}"
+    print(f"\n{Colors.BOLD}[{span}/{count}]{Colors.END}")
+
+def run_sequential(args, lora_block, output_dir, plan, done=0):
+    """Classic loop: build prompt, render, repeat."""
+    total_saved = 0
+    for i, entry in enumerate(plan):
+        job = make_job(args, lora_block, entry)
+        job_header(done, job, args.count)
+        done += job["batch_size"] * job["n_iter"]
+        total_saved += render_job(job, args, output_dir)
+
+        # Small delay between generations
+        if i < len(plan) - 1:
+            time.sleep(1)
+    return total_saved
+
+def render_on_pool(job, args, output_dir):
+    """Render stage for the backend pool: least-busy backend (preferring one with
+    the job's checkpoint loaded), one retry on another backend if one is free.
+    Only connection errors / timeouts take the backend out of rotation."""
+    def has_checkpoint(backend):
+        return CHECKPOINTS.is_loaded(backend.client, job["model"], job["vae"])
+
+    JOB_QUEUE.mark_dispatched(job["id"])
+    saved = 0
+    backend = None
+    with TRACER.job(job["id"]), TRACER.span("job", model=job["model"]) as span:
+        for attempt in range(JOB_ATTEMPTS):
+            with TRACER.span("backend_wait"):
+                backend = FORGE_POOL.acquire(prefer=has_checkpoint, avoid=backend)
+            if backend is None:
+                log('error', "No Forge backend available, dropping job")
+                break
+            reachable = True
+            try:
+                swap_seconds = CHECKPOINTS.ensure(backend.client, job["model"], job["vae"])
+                if swap_seconds:
+                    TRACER.record("checkpoint_swap", swap_seconds, model=job["model"], backend=backend.url)
+                saved = generate_image(job["prompt"], job["negative_prompt"], job["model"],
+                                       upscale_factor=args.upscale, no_hires=args.no_hires,
+                                       output_dir=output_dir, batch_size=job["batch_size"],
+                                       n_iter=job["n_iter"], seed=job["seed"], client=backend.client,
+                                       draft=args.draft,
+                                       on_written=lambda saved: record_result(job, saved)) or 0
+            except (requests.ConnectionError, requests.Timeout) as e:
+                reachable = False
+                log('error', f"Forge backend {backend.url} unreachable: {str(e)[:80]}")
+            except requests.RequestException as e:
+                log('error', f"Forge request to {backend.url} failed: {str(e)[:80]}")
+            finally:
+                FORGE_POOL.release(backend, saved > 0, reachable)
+            if saved:
+                break
+        span["images"] = saved
+    if not saved:
+        record_result(job, 0)
+    return saved
+
+def start_prompt_builder(args, lora_block, plan, depth, stop):
+    """Prompt-builder thread feeding a bounded JobScheduler; closes it when done."""
+    jobs = JobScheduler(maxsize=depth, affinity=not args.no_affinity)
+
+    def put(item):
+        # Bounded put that gives up if the render stage has stopped
+        while not stop.is_set():
+            if jobs.put(item, timeout=0.5):
+                return True
+        return False
+
+    def producer():
+        try:
+            for i, entry in enumerate(plan):
+                if stop.is_set():
+                    return
+                job = make_job(args, lora_block, entry)
+                log('debug', f"Prompt {i+1}/{len(plan)} queued ({jobs.qsize() + 1}/{depth} buffered)")
+                if not put(job):
+                    return
+        except Exception as e:
+            log('error', f"Prompt builder crashed: {e}")
+        finally:
+            jobs.close()  # No more jobs
+
+    builder = threading.Thread(target=producer, name="prompt-builder", daemon=True)
+    builder.start()
+    return jobs, builder
+
+def run_pipelined(args, lora_block, output_dir, plan, done=0):
+    """Producer/consumer loop: a prompt-builder thread keeps a bounded queue
+    of assembled jobs full while this thread keeps Forge busy rendering.
+    LLM latency is hidden behind the previous image's render time."""
+    stop = threading.Event()
+    jobs, builder = start_prompt_builder(args, lora_block, plan, args.pipeline_depth, stop)
+
+    def loaded_here(job):
+        return CHECKPOINTS.is_loaded(FORGE, job["model"], job["vae"])
+
+    total_saved = 0
+    try:
+        while True:
+            job = jobs.get(prefer=loaded_here)
+            if job is None:
+                break
+            job_header(done, job, args.count)
+            done += job["batch_size"] * job["n_iter"]
+            total_saved += render_job(job, args, output_dir)
+    finally:
+        stop.set()
+        builder.join(timeout=5)
+
+    if done < args.count:
+        log('warning', f"Prompt builder stopped early: rendered {done}/{args.count}")
+    return total_saved
+
+def run_pooled(args, lora_block, output_dir, plan, done=0):
+    """Pipelined loop with one render worker per backend slot, so every
+    Forge instance on the pod stays busy."""
+    stop = threading.Event()
+    depth = max(args.pipeline_depth, FORGE_POOL.workers)
+    jobs, builder = start_prompt_builder(args, lora_block, plan, depth, stop)
+    lock = threading.Lock()
+    totals = {"saved": 0, "done": done}
+
+    def worker():
+        last = None  # Keep taking jobs for the checkpoint this worker just rendered
+        while True:
+            job = jobs.get(prefer=lambda j: (j["model"], j["vae"]) == last)
+            if job is None:
+                return
+            last = (job["model"], job["vae"])
+            with lock:
+                job_header(totals["done"], job, args.count)
+                totals["done"] += job["batch_size"] * job["n_iter"]
+            saved = render_on_pool(job, args, output_dir)
+            with lock:
+                totals["saved"] += saved
+
+    workers = [threading.Thread(target=worker, name=f"render-{i}", daemon=True)
+               for i in range(FORGE_POOL.workers)]
+    try:
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+    finally:
+        stop.set()
+        builder.join(timeout=5)
+
+    if totals["done"] < args.count:
+        log('warning', f"Prompt builder stopped early: rendered {totals['done']}/{args.count}")
+    return totals["saved"]
+
 def main():
     parser = argparse.ArgumentParser(description="Lady Nuggets Factory V10")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "prefetch", "report", "finalize"],
+                        help="run: generate images (default) | prefetch: fill the prompt pool | "
+                             "report: per-stage latency of a run | finalize: score and finish --output's drafts")
     parser.add_argument("--count", type=int, default=1, help="Number of images to generate")
     parser.add_argument("--output", type=str, default=None, help="Output directory")
     parser.add_argument("--theme", type=str, default=None, help="Specific theme to use")
@@ -721,11 +2258,63 @@ def main():
     parser.add_argument("--no-hires", action="store_true", help="Disable Hires Fix entirely")
     parser.add_argument("--oc", action="store_true", help="Force use Lady Nuggets OC instead of random characters")
     parser.add_argument("--debug", action="store_true", help="Show debug information")
+    parser.add_argument("--pipeline-depth", type=int, default=0,
+                        help="Build up to N prompts ahead while Forge renders (0 = sequential)")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Images per Forge request (0 = auto from VRAM). Each image gets its own LLM prompt "
+                             "(FACTORY_BATCH_PROMPTS=false: one shared prompt)")
+    parser.add_argument("--n-iter", type=int, default=1, help="Sequential batches per Forge request")
+    parser.add_argument("--models", type=str, default=None,
+                        help="Comma-separated checkpoint names to spread the run over (default: auto-pick one)")
+    parser.add_argument("--vae", type=str, default=None, help="VAE to load with the checkpoints (default: keep current)")
+    parser.add_argument("--no-affinity", action="store_true",
+                        help="Render jobs in plan order instead of grouping them by checkpoint")
+    parser.add_argument("--single-backend", action="store_true",
+                        help="Render on the primary SD API only (skip multi-GPU backend discovery)")
+    parser.add_argument("--draft", action="store_true",
+                        help="Render base-resolution drafts, score them with curator, finalize only the winners")
+    parser.add_argument("--draft-threshold", type=float, default=DRAFT_THRESHOLD,
+                        help="Minimum curator score (0-40) for a draft to be finalized")
+    parser.add_argument("--metadata", choices=METADATA_MODES, default=METADATA_MODE,
+                        help="Per-image metadata: .json sidecar, PNG iTXt chunk, or both")
+    parser.add_argument("--per-theme", type=int, default=5, help="prefetch: prompts to keep in the pool per theme")
+    parser.add_argument("--llm-race-width", type=int, default=LLM_RACE_WIDTH,
+                        help=f"LLM requests in flight per prompt, fastest models first (1 = serial fallback; "
+                             f"the next one fires after {LLM_HEDGE_DELAY:g}s without an answer)")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None, metavar="RUN_ID",
+                        help="Continue an interrupted run (default: the latest unfinished one)")
+    parser.add_argument("--run", type=str, default=None, help="report: run id to report on (default: latest)")
+    parser.add_argument("--refresh-capabilities", action="store_true",
+                        help="Rescan checkpoints/LoRAs on the server instead of using the cached snapshot")
     args = parser.parse_args()
+    set_llm_race_width(args.llm_race_width)
+    
+    if args.command == "prefetch":
+        added = run_prefetch(args)
+        pool_counts = PROMPT_POOL.counts()
+        log('success', f"Prefetch done: {added} new prompts, {sum(pool_counts.values())} in pool across {len(pool_counts)} themes")
+        return
+    
+    if args.command == "report":
+        run_report(args)
+        return
+    
+    # Resume: restore the interrupted run's flags
+    run_id = None
+    if args.resume:
+        run = JOB_QUEUE.load_run(None if args.resume == "latest" else args.resume)
+        if not run:
+            log('error', f"No run to resume ({args.resume})")
+            return
+        run_id, settings = run
+        for key in RESUME_KEYS:
+            setattr(args, key, settings.get(key, getattr(args, key)))
+        log('info', f"Resuming run {run_id}")
     
     # Apply flags
     global USE_LORA, USE_RANDOM_CHAR
     USE_LORA = args.lora
+    set_metadata_mode(args.metadata)
     # Random characters are enabled by default (USE_RANDOM_CHAR = True at top)
     # Only disable if user explicitly asks for --oc OR FORCE_OC env var is set
     if args.oc or FORCE_OC:
@@ -738,6 +2327,9 @@ def main():
     if not output_dir.startswith('/'):
         output_dir = os.path.join(BASE_DIR, output_dir)
     os.makedirs(output_dir, exist_ok=True)
+    drafts_dir = os.path.join(output_dir, "drafts")
+    render_dir = drafts_dir if args.draft else output_dir
+    os.makedirs(render_dir, exist_ok=True)
     
     # Banner
     print(f"\n{Colors.CYAN}{'='*60}{Colors.END}")
@@ -745,7 +2337,9 @@ def main():
     print(f"{Colors.CYAN}{'='*60}{Colors.END}")
     print(f"   Target: {args.count} images")
     print(f"   Output: {output_dir}")
-    print(f"   API: {REFORGE_API}")
+    print(f"   API: {FORGE.base_url}")
+    if not args.single_backend and FORGE_POOL.discover() > 1:
+        print(f"   Backends: {', '.join(b.url for b in FORGE_POOL.backends)}")
     
     # Check API keys
     print(f"\n{Colors.WHITE}🔑 API Keys:{Colors.END}")
@@ -759,108 +2353,114 @@ def main():
     else:
         print(f"   {Colors.YELLOW}✗{Colors.END} OpenRouter: Not configured")
     
+    # Server capabilities (cached snapshot unless --refresh-capabilities)
+    FORGE_CAPS.load(refresh=args.refresh_capabilities)
+    
+    if args.command == "finalize":
+        scored, finalized = finalize_drafts(args, drafts_dir, output_dir)
+        OUTPUT_WRITER.close()
+        log('success', f"Finalize done: {scored} drafts scored, {finalized} finalized into {output_dir}")
+        return
+    
     # Log server state
     log_server_state()
     
     # Get model and LoRAs
-    model_name = get_model_info()
+    checkpoints = resolve_checkpoints(args.models.split(",")) if args.models else []
+    if not checkpoints:
+        checkpoints = [get_model_info()]
     lora_block = build_lora_block()
     
-    log('info', f"Using model: {model_name}")
+    log('info', f"Using model: {', '.join(checkpoints)}")
     
     # Load themes
     themes = load_themes()
     log('info', f"Loaded {len(themes)} themes")
     
+    # Batch plan
+    if args.batch_size <= 0:
+        args.batch_size = auto_batch_size(args.upscale, args.no_hires)
+    args.n_iter = max(1, args.n_iter)
+    CHECKPOINTS.current(FORGE)
+    if run_id is None:
+        requests_plan = assign_checkpoints(plan_batches(args.count, args.batch_size, args.n_iter),
+                                           checkpoints, args.vae, affinity=not args.no_affinity)
+        if len(requests_plan) != args.count:
+            log('info', f"Batching: {args.count} images in {len(requests_plan)} requests")
+        settings = {key: getattr(args, key) for key in RESUME_KEYS}
+        settings["output"] = output_dir
+        run_id = JOB_QUEUE.create_run(settings, requests_plan)
+        if run_id:
+            log('info', f"Run id: {run_id}")
+    TRACER.run_id = run_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    # Job plan (from the queue, so a resumed run skips everything already done)
+    if run_id:
+        plan = []
+        for entry in JOB_QUEUE.pending(run_id):
+            job = entry["job"]
+            if job and recover_rendered(job, render_dir):
+                JOB_QUEUE.mark_done(entry["id"], job["batch_size"] * job["n_iter"])
+                log('success', f"Recovered finished job (seed {job['seed']}) from disk")
+                continue
+            plan.append(entry)
+    else:
+        plan = [{"id": None, "request": request, "job": None} for request in requests_plan]
+    done_before, _ = JOB_QUEUE.progress(run_id)
+    if args.resume:
+        log('info', f"Resume: {done_before}/{args.count} images already done, {len(plan)} requests left")
+    
     # Generation loop
-    total_saved = 0
-    for i in range(args.count):
-        print(f"\n{Colors.BOLD}[{i+1}/{args.count}]{Colors.END}")
-        
-        # Select Pinup Scenario (formerly Theme)
-        # User requested: "ecchi, nsfw, feet focus, chest focus, from behind, dynamic poses"
-        pinup_scenarios = [
-            "Bedroom (Lingerie)", "Beach (Bikini)", "Onsen (Steam)", 
-            "Simple Background (White)", "Simple Background (Black)",
-            "Feet Focus", "Chest Focus", "From Behind (Ass Focus)", 
-            "Dynamic Pose (Angle)", "Wet Skin (Shower)", 
-            "Sweaty (Gym)", "Closeup (Face)", "Mirror Selfie"
-        ]
-        
-        scenario = args.theme if args.theme else random.choice(pinup_scenarios)
-        log('info', f"Scenario: {scenario}")
-        
-        # Get AI-generated prompt for this scenario
-        scene_prompt = get_ai_prompt(scenario)
-        
-        # Build full prompt with BREAK sections (proven high-quality structure)
-        artist_mix = random.choice(ARTIST_MIXES)
-        
-        # Character & Scenario Logic (FIXED: No more random generic girls)
-        if USE_RANDOM_CHAR:
-            # Pick a known Waifu
-            character = random.choice(KNOWN_CHARACTERS)
-            char_name = character.split(",")[0].strip()
-            # Pick a random scenario to put them in
-            random_scenario = random.choice(PINUP_SCENARIOS)
-            log('info', f"Character: {char_name} | Scenario: {random_scenario[:20]}...")
-            
-            # Combine: Identity + Scenario
-            # Note: We append the scenario to the character block
-            character_block = f"{character}, {random_scenario}"
-        else:
-            # Lady Nuggets Mode
-            character_block = OC_CHARACTER
-            log('info', "Character: Lady Nuggets OC (Forced)")
-
-        # Theme Handling
-        # If user provided a specific theme (e.g. from Discord !gen arg), use it.
-        # Otherwise, the LLM will expand on the random PINUP_SCENARIO we just picked?
-        # Actually, let's simplify:
-        # If args.theme is set -> LLM expands that theme.
-        # If not -> LLM expands the random scenario we picked.
-        
-        base_theme = args.theme if args.theme else (random_scenario if USE_RANDOM_CHAR else "pinup pose")
-        scene_block = get_ai_prompt(base_theme)
-
-        
-        # INJECT EMBEDDINGS (lazypos/lazyneg)
-        # These are Textual Inversion embeddings downloaded by runpod_ultra.sh
-        embedding_pos = "lazypos, "
-        embedding_neg = "lazyneg, "
-        
-        # Added "perfect eyes" trigger word here
-        section1 = f"{embedding_pos}perfect eyes, {artist_mix},\n{QUALITY_PREFIX}"
-        # Use the combined blocks
-        section2 = f"{character_block}, {scene_block}"
-        section3 = f"{QUALITY_SUFFIX}"
-        if lora_block:
-            section3 += f", {lora_block}"
-        
-        full_prompt = f"{section1},\nBREAK\n{section2},\nBREAK\n{section3}"
-        final_negative = f"{embedding_neg}{NEGATIVE_PROMPT}"
-        
-        log('info', f"Artists: {artist_mix}")
-        log('success', "Embeddings injected: lazypos, lazyneg")
-        
-        # Generate
-        result = generate_image(full_prompt, final_negative, model_name, 
-                               upscale_factor=args.upscale, no_hires=args.no_hires,
-                               output_dir=output_dir)
-        
-        # Save check
-        if result:
-            total_saved += result
-        
-        # Small delay between generations
-        if i < args.count - 1:
-            time.sleep(1)
+    if len(FORGE_POOL.backends) > 1:
+        log('info', f"Multi-backend mode: {len(FORGE_POOL.backends)} Forge instances, {FORGE_POOL.workers} render workers")
+        total_saved = run_pooled(args, lora_block, render_dir, plan, done_before)
+    elif args.pipeline_depth > 0:
+        log('info', f"Pipeline mode: prompt queue depth {args.pipeline_depth}")
+        total_saved = run_pipelined(args, lora_block, render_dir, plan, done_before)
+    else:
+        total_saved = run_sequential(args, lora_block, render_dir, plan, done_before)
+    OUTPUT_WRITER.flush()  # Drafts must be on disk before scoring; queue marks land here too
+    
+    # Draft mode: score, then spend hires/ADetailer only on the winners
+    if args.draft:
+        log('info', f"Drafts done, finalizing those scoring >= {args.draft_threshold:g}")
+        drafts_scored, drafts_finalized = finalize_drafts(args, drafts_dir, output_dir)
+    OUTPUT_WRITER.close()
     
     # Summary
     print(f"\n{Colors.GREEN}{'='*60}{Colors.END}")
     print(f"{Colors.BOLD}✅ GENERATION COMPLETE{Colors.END}")
     print(f"{Colors.GREEN}{'='*60}{Colors.END}")
-    print(f"   Images saved: {total_saved}/{args.count}")
+    print(f"   Images saved: {total_saved + done_before}/{args.count}" + (f" ({done_before} before resume)" if done_before else ""))
+    if args.draft:
+        print(f"   Drafts: {drafts_scored} scored, {drafts_finalized} finalized (threshold {args.draft_threshold:g})")
+    if run_id:
+        images_done, images_planned = JOB_QUEUE.progress(run_id)
+        if images_done >= images_planned:
+            JOB_QUEUE.finish(run_id)
+        else:
+            print(f"   Run {run_id}: {images_done}/{images_planned} done (continue with --resume {run_id})")
+    print(f"   Prompt cache: {PROMPT_CACHE.summary()}")
+    print(f"   Prompt pool: {PROMPT_POOL.summary()}")
+    print(f"   Prompt combos: {COMBOS.summary()}")
+    print(f"   Result cache: {RESULT_CACHE.summary()}")
+    print(f"   Writer: {OUTPUT_WRITER.summary()}")
+    print(f"   Checkpoints: {CHECKPOINTS.summary()}")
+    for line in LLM_LATENCY.summary_lines():
+        print(f"   LLM latency {line}")
+    for line in PROVIDER_HEALTH.summary_lines():
+        print(f"   LLM circuit {line}")
+    if len(FORGE_POOL.backends) > 1:
+        for line in FORGE_POOL.summary_lines():
+            print(f"   Forge backend {line}")
+        for backend in FORGE_POOL.backends:
+            for line in backend.client.latency_lines():
+                print(f"   Forge {backend.url} {line}")
+    else:
+        for line in FORGE.latency_lines():
+            print(f"   Forge {line}")
+    if TRACER.enabled:
+        print(f"   Trace: {TRACER.path} (python3 scripts/factory.py report --run {TRACER.run_id})")
     print(f"   Location: {output_dir}")
     print()
 
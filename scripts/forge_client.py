@@ -0,0 +1,663 @@
+#!/usr/bin/env python3
+"""
+🔌 FORGE CLIENT - Shared HTTP client for the SD WebUI API (Forge/Reforge)
+=========================================================================
+One pooled requests.Session per server instead of a fresh TCP (and, through
+the RunPod proxy, TLS) handshake on every call.
+
+Features:
+- Lazy, parallel SD API discovery (REFORGE_API first, cached on disk)
+- Keep-alive connection pool (size via FORGE_POOL_SIZE)
+- Per-endpoint default timeouts
+- Per-endpoint latency counters
+- ServerCapabilities: disk-cached snapshot of models/LoRAs/scripts/samplers/upscalers
+- CheckpointTracker / JobScheduler: checkpoint-affinity ordering with swap metrics
+- ProgressMonitor: split a txt2img call into queue wait / sampling / hires / ADetailer
+- stream_json_images: decode txt2img images to disk without buffering the response
+
+Usage:
+    forge = ForgeClient("http://127.0.0.1:7860")   # or ForgeClient(resolver=detect_sd_api)
+    models = forge.get("/sdapi/v1/sd-models").json()
+    resp = forge.post("/sdapi/v1/txt2img", json=payload)
+    for line in forge.latency_lines(): print(line)
+"""
+
+import os
+import json
+import binascii
+import time
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORGE_POOL_SIZE = int(os.getenv("FORGE_POOL_SIZE", "4"))
+
+# Seconds per endpoint (last path segment). Generation calls get the long ones.
+DEFAULT_TIMEOUTS = {
+    "sd-models": 5,
+    "loras": 5,
+    "scripts": 5,
+    "samplers": 5,
+    "upscalers": 5,
+    "refresh-loras": 5,
+    "refresh-checkpoints": 5,
+    "progress": 5,
+    "options": 120,  # Setting sd_model_checkpoint loads the weights
+    "txt2img": 600,
+    "img2img": 600,
+}
+FALLBACK_TIMEOUT = 30
+
+
+# === SD API DISCOVERY ===
+# Ports in order of priority (include Forge template ports)
+SD_API_PORTS = [7860, 7861, 7862, 3000, 3001, 8080, 8188]
+DEFAULT_SD_API = "http://127.0.0.1:7860"
+DISCOVERY_CACHE = os.path.join(os.getenv("FACTORY_DATA_DIR", os.path.join(BASE_DIR, "database")), "sd_api.json")
+DISCOVERY_TTL = float(os.getenv("FORGE_DISCOVERY_TTL", "300"))
+
+
+def _print_log(level, msg):
+    print(msg)
+
+
+def probe_sd_api(url, timeout=2):
+    """Return the model count if url is a real SD API, else None.
+    Validates the JSON body, not just HTTP 200 (nginx proxies answer HTML)."""
+    try:
+        resp = requests.get(f"{url}/sdapi/v1/sd-models", timeout=timeout)
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        return len(data) if isinstance(data, list) else None
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def discover_sd_apis(ports=SD_API_PORTS, host="127.0.0.1", timeout=2):
+    """Probe all candidate ports concurrently. Returns live URLs in priority order."""
+    urls = [f"http://{host}:{port}" for port in ports]
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        counts = list(pool.map(lambda u: probe_sd_api(u, timeout), urls))
+    return [url for url, count in zip(urls, counts) if count is not None]
+
+
+def _read_discovery_cache(cache_path):
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if time.time() - cached["verified_at"] < DISCOVERY_TTL:
+            return cached["url"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def _write_discovery_cache(cache_path, url):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "verified_at": time.time()}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def detect_sd_api(cache_path=DISCOVERY_CACHE, log=_print_log):
+    """Find the SD API: REFORGE_API if it answers, then a recently verified
+    endpoint from disk, then a parallel scan of SD_API_PORTS."""
+    env_api = os.getenv("REFORGE_API", "").strip().rstrip("/")
+    if env_api and probe_sd_api(env_api) is not None:
+        log('success', f"SD API verified at REFORGE_API ({env_api})")
+        return env_api
+
+    cached = _read_discovery_cache(cache_path) if cache_path else None
+    if cached:
+        log('success', f"SD API (cached): {cached}")
+        return cached
+
+    live = discover_sd_apis()
+    if live:
+        log('success', f"SD API verified at {live[0]}" + (f" (+{len(live) - 1} more)" if len(live) > 1 else ""))
+        if cache_path:
+            _write_discovery_cache(cache_path, live[0])
+        return live[0]
+
+    # Fallback to env or default
+    if env_api:
+        log('warning', f"No active SD API found, using .env: {env_api}")
+        return env_api
+    log('warning', "No SD API found, defaulting to port 7860")
+    return DEFAULT_SD_API
+
+
+class ForgeClient:
+    """Pooled, instrumented client for one SD WebUI server."""
+
+    def __init__(self, base_url=None, pool_size=FORGE_POOL_SIZE, timeouts=None, resolver=None):
+        # base_url may be resolved lazily (on first request) via resolver()
+        self._base_url = base_url.rstrip("/") if base_url else None
+        self._resolver = resolver or detect_sd_api
+        self._resolve_lock = threading.Lock()
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Connection"] = "keep-alive"
+        self._lock = threading.Lock()
+        self._stats = {}  # endpoint -> {"calls", "errors", "total", "max"}
+
+    @property
+    def base_url(self):
+        if self._base_url is None:
+            with self._resolve_lock:
+                if self._base_url is None:
+                    self._base_url = self._resolver().rstrip("/")
+        return self._base_url
+
+    @staticmethod
+    def _endpoint(path):
+        return path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+
+    def _record(self, endpoint, seconds, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            stats["calls"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            if error:
+                stats["errors"] += 1
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Send a request to base_url + path. Raises requests exceptions like requests does."""
+        endpoint = self._endpoint(path)
+        if timeout is None:
+            timeout = self.timeouts.get(endpoint, FALLBACK_TIMEOUT)
+        start = time.perf_counter()
+        try:
+            resp = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+        except requests.RequestException:
+            self._record(endpoint, time.perf_counter() - start, error=True)
+            raise
+        self._record(endpoint, time.perf_counter() - start, error=resp.status_code >= 400)
+        return resp
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def latency_stats(self):
+        """Snapshot of {endpoint: {"calls", "errors", "avg", "max"}}."""
+        with self._lock:
+            return {
+                endpoint: {
+                    "calls": s["calls"],
+                    "errors": s["errors"],
+                    "avg": s["total"] / s["calls"] if s["calls"] else 0.0,
+                    "max": s["max"],
+                }
+                for endpoint, s in self._stats.items()
+            }
+
+    def latency_lines(self):
+        lines = []
+        for endpoint, s in sorted(self.latency_stats().items()):
+            errors = f", {s['errors']} errors" if s["errors"] else ""
+            lines.append(f"{endpoint}: {s['calls']} calls, avg {s['avg']*1000:.0f}ms, max {s['max']*1000:.0f}ms{errors}")
+        return lines
+
+    def close(self):
+        self.session.close()
+
+
+# === CAPABILITY SNAPSHOT ===
+CAPS_TTL = float(os.getenv("FORGE_CAPS_TTL", "3600"))
+CAPS_ENDPOINTS = {
+    "models": "/sdapi/v1/sd-models",
+    "loras": "/sdapi/v1/loras",
+    "scripts": "/sdapi/v1/scripts",
+    "samplers": "/sdapi/v1/samplers",
+    "upscalers": "/sdapi/v1/upscalers",
+}
+
+
+class ServerCapabilities:
+    """What a Forge server offers (checkpoints, LoRAs, scripts, samplers,
+    upscalers), fetched once and cached on disk per server URL with a TTL.
+    Pass refresh=True to make Forge rescan its folders and refetch."""
+
+    def __init__(self, client, cache_path, ttl=CAPS_TTL):
+        self.client = client
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.snapshot = None
+        self._lock = threading.Lock()
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, snapshot):
+        cache = self._read_cache()
+        cache[self.client.base_url] = snapshot
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def load(self, refresh=False):
+        """Return the snapshot dict, from disk when fresh, else from the server."""
+        with self._lock:
+            if self.snapshot is not None and not refresh:
+                return self.snapshot
+            if not refresh:
+                cached = self._read_cache().get(self.client.base_url)
+                if cached and time.time() - cached.get("fetched_at", 0) < self.ttl:
+                    self.snapshot = cached
+                    return cached
+            self.snapshot = self._fetch(refresh)
+            return self.snapshot
+
+    def _fetch(self, refresh):
+        if refresh:
+            for path in ("/sdapi/v1/refresh-checkpoints", "/sdapi/v1/refresh-loras"):
+                try:
+                    self.client.post(path)
+                except requests.RequestException:
+                    pass
+        snapshot = {"fetched_at": time.time()}
+        complete = True
+        for key, path in CAPS_ENDPOINTS.items():
+            try:
+                resp = self.client.get(path)
+                resp.raise_for_status()
+                snapshot[key] = resp.json()
+            except (requests.RequestException, ValueError):
+                snapshot[key] = [] if key != "scripts" else {}
+                complete = False
+        if complete:
+            self._write_cache(snapshot)  # Never persist a half-empty snapshot
+        return snapshot
+
+    @property
+    def models(self):
+        return self.load().get("models", [])
+
+    @property
+    def loras(self):
+        return self.load().get("loras", [])
+
+    @property
+    def samplers(self):
+        return [s.get("name") for s in self.load().get("samplers", [])]
+
+    @property
+    def upscalers(self):
+        return [u.get("name") for u in self.load().get("upscalers", [])]
+
+    def has_script(self, name, kind="txt2img"):
+        scripts = self.load().get("scripts", {}).get(kind, [])
+        return name.lower() in (s.lower() for s in scripts)
+
+
+# === CHECKPOINT AFFINITY ===
+class CheckpointTracker:
+    """Which checkpoint/VAE each Forge instance has loaded. Switches go through
+    /sdapi/v1/options explicitly, so every swap is counted and timed instead
+    of hiding inside the next txt2img call. vae=None means "whatever is loaded"."""
+
+    def __init__(self, log=_print_log):
+        self.log = log
+        self.loaded = {}  # base_url -> (checkpoint, vae)
+        self.swaps = 0
+        self.swap_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def current(self, client):
+        """Loaded (checkpoint, vae) for client, asking the server the first time."""
+        url = client.base_url
+        with self._lock:
+            if url in self.loaded:
+                return self.loaded[url]
+        try:
+            resp = client.get("/sdapi/v1/options")
+            resp.raise_for_status()
+            options = resp.json()
+            key = (options.get("sd_model_checkpoint"), options.get("sd_vae"))
+        except (requests.RequestException, ValueError):
+            key = (None, None)
+        with self._lock:
+            return self.loaded.setdefault(url, key)
+
+    def is_loaded(self, client, checkpoint, vae=None):
+        """Cache-only check (no network), safe to call while holding other locks."""
+        loaded = self.loaded.get(client.base_url)
+        if not loaded or loaded[0] is None:
+            return False
+        return _same_checkpoint(loaded[0], checkpoint) and (vae is None or loaded[1] == vae)
+
+    def ensure(self, client, checkpoint, vae=None):
+        """Load checkpoint (and vae) on client unless already there. Returns swap seconds."""
+        self.current(client)
+        if self.is_loaded(client, checkpoint, vae):
+            return 0.0
+        options = {"sd_model_checkpoint": checkpoint}
+        if vae is not None:
+            options["sd_vae"] = vae
+        self.log('info', f"Loading checkpoint {checkpoint}" + (f" + VAE {vae}" if vae else "") + f" on {client.base_url}...")
+        start = time.time()
+        resp = client.post("/sdapi/v1/options", json=options)
+        resp.raise_for_status()
+        elapsed = time.time() - start
+        with self._lock:
+            previous = self.loaded.get(client.base_url, (None, None))
+            self.loaded[client.base_url] = (checkpoint, vae if vae is not None else previous[1])
+            self.swaps += 1
+            self.swap_seconds += elapsed
+        self.log('success', f"Checkpoint loaded in {elapsed:.1f}s")
+        return elapsed
+
+    def summary(self):
+        with self._lock:
+            return f"{self.swaps} swaps, {self.swap_seconds:.1f}s loading weights"
+
+
+def _same_checkpoint(a, b):
+    # Options report "name.safetensors [hash]"; callers may pass the bare name
+    a, b = a.lower(), b.lower()
+    return a == b or a.split(" [")[0] == b.split(" [")[0]
+
+
+class JobScheduler:
+    """Bounded, thread-safe job buffer between the prompt builder and the
+    renderers. get(prefer=...) hands out a job for the checkpoint the caller
+    already has loaded; otherwise it drains the largest buffered group before
+    switching. With affinity=False it is a plain FIFO."""
+
+    def __init__(self, maxsize=0, key=lambda job: (job.get("model"), job.get("vae")), affinity=True):
+        self.maxsize = maxsize
+        self.key = key
+        self.affinity = affinity
+        self.jobs = []
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, job, timeout=None):
+        """Add a job; returns False if the buffer stayed full for timeout seconds."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: not self.maxsize or len(self.jobs) < self.maxsize, timeout):
+                return False
+            self.jobs.append(job)
+            self.cond.notify_all()
+            return True
+
+    def close(self):
+        """No more jobs: get() returns None once the buffer is empty."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.jobs)
+
+    def _pick(self, prefer):
+        if not self.affinity:
+            return 0
+        if prefer:
+            for idx, job in enumerate(self.jobs):
+                if prefer(job):
+                    return idx
+        counts = {}
+        for job in self.jobs:
+            key = self.key(job)
+            counts[key] = counts.get(key, 0) + 1
+        largest = max(counts.values())
+        # Oldest job among the largest groups
+        return next(idx for idx, job in enumerate(self.jobs) if counts[self.key(job)] == largest)
+
+    def get(self, prefer=None):
+        """Next job (blocking), or None when closed and drained.
+        prefer: job -> bool, e.g. "its checkpoint is already loaded here"."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.jobs or self.closed)
+            if not self.jobs:
+                return None
+            job = self.jobs.pop(self._pick(prefer))
+            self.cond.notify_all()
+            return job
+
+
+# === PROGRESS MONITOR ===
+PROGRESS_INTERVAL = float(os.getenv("FORGE_PROGRESS_INTERVAL", "0.5"))
+
+
+class ProgressMonitor:
+    """Polls /sdapi/v1/progress while a generation request is in flight and
+    splits its wall time into phases: "queue_wait" until Forge starts sampling,
+    one phase per sampling pass (pass_names, e.g. sampling -> hires -> adetailer;
+    a new pass starts when the step counter resets), then "postprocess" once
+    Forge reports idle (image encoding, building the response).
+
+    Usage:
+        with ProgressMonitor(forge, ["sampling", "hires"]) as monitor:
+            resp = forge.post("/sdapi/v1/txt2img", json=payload)
+        monitor.phases   # {"queue_wait": 0.4, "sampling": 9.1, "hires": 14.2, ...}
+    """
+
+    def __init__(self, client, pass_names=("sampling",), interval=PROGRESS_INTERVAL):
+        self.client = client
+        self.pass_names = list(pass_names)
+        self.interval = interval
+        self.phases = {}
+        self._phase = "queue_wait"
+        self._pass = -1
+        self._last_step = 0
+        self._last_total = None
+        self._mark = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._mark = time.time()
+        self._thread = threading.Thread(target=self._poll, name="forge-progress", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 5)
+        with self._lock:
+            self._switch(self._phase)
+        return False
+
+    def _switch(self, phase):
+        # Close the running phase and start `phase` (called with the lock held)
+        now = time.time()
+        self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._mark
+        self._mark = now
+        self._phase = phase
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            try:
+                resp = self.client.get("/sdapi/v1/progress", params={"skip_current_image": "true"})
+                progress = resp.json()
+                state = progress.get("state") or {}
+            except (requests.RequestException, ValueError, AttributeError):
+                continue
+            step = state.get("sampling_step") or 0
+            total = state.get("sampling_steps") or 0
+            active = (state.get("job_count") or 0) > 0 or (progress.get("progress") or 0) > 0
+            with self._lock:
+                if self._stop.is_set():
+                    return
+                if not active:
+                    if self._pass >= 0 and self._phase != "postprocess":
+                        self._switch("postprocess")
+                    continue
+                if step and (self._pass < 0 or step < self._last_step or total != self._last_total):
+                    self._pass += 1
+                    self._switch(self.pass_names[min(self._pass, len(self.pass_names) - 1)])
+                if step:
+                    self._last_step, self._last_total = step, total
+
+
+# === STREAMING RESPONSE DECODING ===
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class _ByteStream:
+    """Minimal pull parser over an iterator of byte chunks."""
+
+    WHITESPACE = b" \t\r\n"
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self.buf = self.buf[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """Next non-whitespace byte (as a 1-byte bytes object) or None at EOF."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos:self.pos + 1]
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r}, got {found!r}")
+        self.pos += 1
+
+    def read_raw_value(self):
+        """Raw bytes of the next JSON value (any type), for json.loads."""
+        self.peek()
+        out = bytearray()
+        depth, in_string, escaped = 0, False, False
+        while True:
+            if self.pos >= len(self.buf) and not self._fill():
+                if depth == 0 and not in_string and out:
+                    return bytes(out)
+                raise ValueError("Truncated JSON value")
+            byte = self.buf[self.pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif byte == 0x5C:  # backslash
+                    escaped = True
+                elif byte == 0x22:  # quote
+                    in_string = False
+                    if depth == 0:
+                        out.append(byte)
+                        self.pos += 1
+                        return bytes(out)
+            elif byte == 0x22:
+                in_string = True
+            elif byte in b"{[":
+                depth += 1
+            elif byte in b"}]":
+                if depth == 0:
+                    return bytes(out)  # Scalar ended by its parent's closing bracket
+                depth -= 1
+                if depth == 0:
+                    out.append(byte)
+                    self.pos += 1
+                    return bytes(out)
+            elif depth == 0 and byte in b", \t\r\n":
+                return bytes(out)  # Scalar ended by a separator
+            out.append(byte)
+            self.pos += 1
+
+    def stream_base64_string(self, write):
+        """Decode the next JSON string as base64, handing decoded chunks to write()."""
+        self.expect(b'"')
+        carry = b""
+        while True:
+            end = self.buf.find(b'"', self.pos)
+            if end != -1:
+                segment, self.pos = self.buf[self.pos:end], end + 1
+            else:
+                segment = self.buf[self.pos:]
+                if segment.endswith(b"\\"):
+                    segment = segment[:-1]  # Keep a split escape for the next chunk
+                self.pos += len(segment)
+            data = carry + segment.replace(b"\\/", b"/")
+            usable = len(data) - len(data) % 4
+            if usable:
+                write(binascii.a2b_base64(data[:usable]))
+            carry = data[usable:]
+            if end != -1:
+                if carry:
+                    write(binascii.a2b_base64(carry + b"=" * (-len(carry) % 4)))
+                return
+            if not self._fill():
+                raise ValueError("Truncated base64 string")
+
+
+def stream_json_images(chunks, open_image):
+    """Parse a txt2img/img2img JSON body incrementally.
+
+    Each entry of the top-level "images" array is base64-decoded in pieces
+    straight into open_image(index) (a context manager yielding a binary
+    file), so no full image string is ever held in memory. Returns
+    (image_count, other_fields) where other_fields holds e.g. "parameters"
+    and "info" parsed normally.
+    """
+    stream = _ByteStream(chunks)
+    stream.expect(b"{")
+    fields = {}
+    count = 0
+    if stream.peek() == b"}":
+        return count, fields
+    while True:
+        key = json.loads(stream.read_raw_value())
+        stream.expect(b":")
+        if key == "images" and stream.peek() == b"[":
+            stream.expect(b"[")
+            if stream.peek() == b"]":
+                stream.pos += 1
+            else:
+                while True:
+                    with open_image(count) as f:
+                        stream.stream_base64_string(f.write)
+                    count += 1
+                    separator = stream.peek()
+                    stream.pos += 1
+                    if separator == b"]":
+                        break
+                    if separator != b",":
+                        raise ValueError(f"Unexpected {separator!r} in images array")
+        else:
+            fields[key] = json.loads(stream.read_raw_value())
+        separator = stream.peek()
+        stream.pos += 1
+        if separator == b"}":
+            return count, fields
+        if separator != b",":
+            raise ValueError(f"Unexpected {separator!r} after {key!r}")
@@ -4,27 +4,10 @@ import base64
 import os
 import time
 from datetime import datetime
+from forge_client import ForgeClient
 
 # === CONFIG ===
-# === CONFIG ===
-def detect_sd_api():
-    """Dynamically detect SD API port (7860, 7861, 7862, 3000)."""
-    env_api = os.getenv("REFORGE_API", "")
-    ports = [7860, 7861, 7862, 3000, 3001, 8080, 8188]
-    for port in ports:
-        try:
-            url = f"http://127.0.0.1:{port}"
-            resp = requests.get(f"{url}/sdapi/v1/sd-models", timeout=2)
-            if resp.status_code == 200:
-                print(f"✅ Found SD API at: {url}")
-                return url
-        except:
-            pass
-    
-    if env_api: return env_api
-    return "http://127.0.0.1:7860"
-
-API_URL = detect_sd_api()
+FORGE = ForgeClient()  # SD API is detected on the first request
 OUTPUT_DIR = "content/logo_concepts"
 
 # === LOGO PARAMS ===
@@ -42,7 +25,7 @@ def generate_logo():
         os.makedirs(OUTPUT_DIR)
 
     print(f"🎨 Generating Logo Concepts with {MODEL}...")
-    print(f"   Target API: {API_URL}")
+    print(f"   Target API: {FORGE.base_url}")
     
     payload = {
         "prompt": PROMPT,
@@ -59,7 +42,7 @@ def generate_logo():
     }
 
     try:
-        resp = requests.post(f"{API_URL}/sdapi/v1/txt2img", json=payload, timeout=300)
+        resp = FORGE.post("/sdapi/v1/txt2img", json=payload, timeout=300)
         if resp.status_code == 200:
             data = resp.json()
             if 'images' not in data:
@@ -80,7 +63,7 @@ def generate_logo():
         else:
             print(f"❌ Error: {resp.status_code} - {resp.text}")
     except requests.exceptions.ConnectionError:
-        print(f"\n❌ CONNECTION REFUSED to {API_URL}")
+        print(f"\n❌ CONNECTION REFUSED to {FORGE.base_url}")
         print("   👉 CAUSE: The Stable Diffusion WebUI is NOT running.")
         print("   👉 FIX: Run './scripts/runpod_ultra.sh --count 1' first to start the server.")
     except Exception as e:
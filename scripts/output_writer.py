@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+💾 OUTPUT WRITER - Background, crash-safe writes for rendered images
+====================================================================
+Render threads hand decoded bytes to a small pool of writer threads and
+move on, so Forge dispatch never waits on the disk.
+
+Features:
+- Sharded writer threads: each file belongs to one thread, so its chunks stay in order
+- Temp file + os.replace: a final name only ever points at a complete, fsynced file
+- Batched fsync: one sync round per OUTPUT_FSYNC_BATCH files, or OUTPUT_FSYNC_DELAY
+  seconds after the oldest unsynced file, whichever comes first
+- Collision-free names via unique_suffix() (process counter + random hex)
+- Bounded backlog (OUTPUT_WRITER_QUEUE_MB) so a stalled disk cannot eat the RAM
+
+Usage:
+    writer = OutputWriter()
+    with writer.open("/out/image.png") as f:   # file-like, write() only
+        f.write(data)
+    writer.write_json("/out/image.json", meta)
+    writer.when_done([f.future, ...], callback)  # callback(files_ok) from a writer thread
+    writer.flush()                               # block until everything queued is on disk
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+
+OUTPUT_WRITER_THREADS = int(os.getenv("OUTPUT_WRITER_THREADS", "2"))
+OUTPUT_FSYNC_BATCH = int(os.getenv("OUTPUT_FSYNC_BATCH", "8"))
+OUTPUT_FSYNC_DELAY = float(os.getenv("OUTPUT_FSYNC_DELAY", "1.0"))
+OUTPUT_WRITER_QUEUE_MB = int(os.getenv("OUTPUT_WRITER_QUEUE_MB", "256"))
+
+_counter = itertools.count()
+
+
+def unique_suffix():
+    """Short name suffix that never repeats within a process and rarely across them."""
+    return f"{next(_counter) % 10000:04d}{uuid.uuid4().hex[:4]}"
+
+
+def _print_log(level, msg):
+    print(msg)
+
+
+class PendingFile:
+    """Write handle returned by OutputWriter.open(). future resolves to True once
+    the file is fsynced under its final name, False if writing failed."""
+
+    def __init__(self, writer, shard, path):
+        self.writer = writer
+        self.shard = shard
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.future = Future()
+        self.f = None
+        self.error = None
+
+    def write(self, data):
+        self.writer._submit(self.shard, ("write", self, bytes(data)), len(data))
+
+    def close(self):
+        self.writer._submit(self.shard, ("close", self, None), 0)
+
+    def abort(self):
+        """Drop the file (e.g. the response was truncated); nothing reaches path."""
+        self.writer._submit(self.shard, ("abort", self, None), 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class _Shard(threading.Thread):
+    def __init__(self, writer, idx):
+        super().__init__(name=f"output-writer-{idx}", daemon=True)
+        self.writer = writer
+        self.ops = queue.Queue()
+        self.unsynced = []
+        self.oldest = None
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.unsynced:
+                timeout = max(0.0, self.oldest + self.writer.fsync_delay - time.time())
+            try:
+                op = self.ops.get(timeout=timeout)
+            except queue.Empty:
+                self._sync()
+                continue
+            kind, handle, data = op
+            if kind == "stop":
+                self._sync()
+                return
+            if kind == "barrier":
+                self._sync()
+                handle.set()
+                continue
+            self._apply(kind, handle, data)
+            if len(self.unsynced) >= self.writer.fsync_batch:
+                self._sync()
+
+    def _apply(self, kind, handle, data):
+        if kind == "abort":
+            if handle in self.unsynced:
+                self.unsynced.remove(handle)
+            if not handle.future.done():
+                self._discard(handle, None)
+            elif handle.future.result():
+                try:
+                    os.remove(handle.path)  # Already landed, but the caller gave up on it
+                except OSError:
+                    pass
+            return
+        try:
+            if handle.error is None:
+                if handle.f is None:
+                    handle.f = open(handle.tmp_path, "wb")
+                if kind == "write":
+                    start = time.time()
+                    handle.f.write(data)
+                    self.writer._account(len(data), time.time() - start)
+                elif kind == "close":
+                    handle.f.flush()
+                    self.unsynced.append(handle)
+                    self.oldest = self.oldest or time.time()
+                    return
+        except OSError as e:
+            handle.error = e
+        finally:
+            if kind == "write":
+                self.writer._release(len(data))
+        if kind == "close":
+            self._discard(handle, handle.error)
+
+    def _discard(self, handle, error):
+        if handle.f is not None:
+            handle.f.close()
+        try:
+            os.remove(handle.tmp_path)
+        except OSError:
+            pass
+        if error is not None:
+            self.writer.log('error', f"Write failed for {os.path.basename(handle.path)}: {error}")
+        handle.future.set_result(False)
+
+    def _sync(self):
+        if not self.unsynced:
+            return
+        start = time.time()
+        done = []
+        dirs = set()
+        for handle in self.unsynced:
+            try:
+                os.fsync(handle.f.fileno())
+                handle.f.close()
+                os.replace(handle.tmp_path, handle.path)
+                dirs.add(os.path.dirname(handle.path))
+                done.append(handle)
+            except OSError as e:
+                self._discard(handle, e)
+        for d in dirs:
+            # Persist the renames themselves
+            try:
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        self.unsynced = []
+        self.oldest = None
+        self.writer._synced(len(done), time.time() - start)
+        for handle in done:
+            handle.future.set_result(True)
+
+
+class OutputWriter:
+    """Pool of writer threads for image/sidecar files (see module docstring)."""
+
+    def __init__(self, threads=OUTPUT_WRITER_THREADS, fsync_batch=OUTPUT_FSYNC_BATCH,
+                 fsync_delay=OUTPUT_FSYNC_DELAY, max_backlog_mb=OUTPUT_WRITER_QUEUE_MB, log=_print_log):
+        self.fsync_batch = max(1, fsync_batch)
+        self.fsync_delay = fsync_delay
+        self.max_backlog = max_backlog_mb * 1024 * 1024
+        self.log = log
+        self._shards = [_Shard(self, i) for i in range(max(1, threads))]
+        self._next = itertools.count()
+        self._cond = threading.Condition()
+        self._backlog = 0
+        self._started = False
+        self._closed = False
+        self.files = 0
+        self.bytes = 0
+        self.write_seconds = 0.0
+        self.sync_rounds = 0
+        self.sync_seconds = 0.0
+        self.peak_backlog = 0
+
+    def _start(self):
+        with self._cond:
+            if not self._started:
+                for shard in self._shards:
+                    shard.start()
+                self._started = True
+
+    def _submit(self, shard, op, size):
+        if size:
+            with self._cond:
+                # Backpressure only when the disk is far behind
+                self._cond.wait_for(lambda: self._backlog == 0 or self._backlog + size <= self.max_backlog)
+                self._backlog += size
+                self.peak_backlog = max(self.peak_backlog, self._backlog)
+        shard.ops.put(op)
+
+    def _release(self, size):
+        with self._cond:
+            self._backlog -= size
+            self._cond.notify_all()
+
+    def _account(self, size, seconds):
+        with self._cond:
+            self.bytes += size
+            self.write_seconds += seconds
+
+    def _synced(self, files, seconds):
+        with self._cond:
+            self.files += files
+            self.sync_rounds += 1
+            self.sync_seconds += seconds
+
+    def open(self, path):
+        """File-like handle whose bytes land at path (atomically) in the background."""
+        self._start()
+        shard = self._shards[next(self._next) % len(self._shards)]
+        return PendingFile(self, shard, path)
+
+    def write_bytes(self, path, data):
+        handle = self.open(path)
+        handle.write(data)
+        handle.close()
+        return handle.future
+
+    def write_json(self, path, obj):
+        return self.write_bytes(path, json.dumps(obj, indent=2).encode("utf-8"))
+
+    def when_done(self, futures, callback):
+        """Call callback(number of files written OK) once every future has resolved."""
+        futures = list(futures)
+        if not futures:
+            callback(0)
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def one_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            callback(sum(1 for f in futures if f.result()))
+
+        for future in futures:
+            future.add_done_callback(one_done)
+
+    def flush(self):
+        """Block until everything submitted so far is fsynced under its final name."""
+        if not self._started:
+            return
+        barriers = []
+        for shard in self._shards:
+            event = threading.Event()
+            shard.ops.put(("barrier", event, None))
+            barriers.append(event)
+        for event in barriers:
+            event.wait()
+
+    def close(self):
+        if not self._started or self._closed:
+            return
+        self._closed = True
+        for shard in self._shards:
+            shard.ops.put(("stop", None, None))
+        for shard in self._shards:
+            shard.join()
+
+    def summary(self):
+        return (f"{self.files} files, {self.bytes / 1024 / 1024:.1f} MB in {self.write_seconds:.1f}s, "
+                f"{self.sync_rounds} fsync rounds ({self.sync_seconds:.1f}s), "
+                f"peak backlog {self.peak_backlog / 1024 / 1024:.1f} MB")
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+🏷️ PNG META - Generation metadata inside the PNG itself
+========================================================
+Stores the factory metadata dict as an iTXt chunk (keyword "lady_nuggets",
+UTF-8 JSON) so it travels with the image: no .json sidecar to list, skip or
+leave behind when the PNG is moved.
+
+Features:
+- PngTextWriter: wraps the streaming file handle, holds back the 12-byte IEND
+  chunk and inserts the text chunks before it (no pixel decode/re-encode)
+- read_text_chunks(): walks chunk headers and seeks over IDAT, never inflates pixels
+- read_metadata()/write_metadata(): the .json sidecar when there is one (older
+  output, --metadata both), else the embedded chunk; writes also refresh an
+  embedded chunk so both copies agree
+
+Usage:
+    with PngTextWriter(open("image.png", "wb")) as f:   # any binary file-like
+        f.write(png_bytes)
+        f.set_metadata({"seed": 42, ...})
+    meta = read_metadata("image.png")
+
+    python3 scripts/png_meta.py read content/raw/lady_nuggets_*.png
+    python3 scripts/png_meta.py embed content/raw     # fold old .json sidecars into their PNGs
+"""
+
+import os
+import sys
+import json
+import zlib
+import glob
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+META_KEYWORD = "lady_nuggets"
+IEND_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def itxt_chunk(keyword, text):
+    """Uncompressed iTXt chunk (UTF-8 text, no language tag)."""
+    data = keyword.encode("latin-1") + b"\x00\x00\x00\x00\x00" + text.encode("utf-8")
+    return _chunk(b"iTXt", data)
+
+
+def meta_chunk(meta):
+    return itxt_chunk(META_KEYWORD, json.dumps(meta, ensure_ascii=False, separators=(",", ":")))
+
+
+def _parse_text(kind, data):
+    """Return (keyword, text) for a tEXt/zTXt/iTXt payload."""
+    keyword, _, rest = data.partition(b"\x00")
+    keyword = keyword.decode("latin-1")
+    if kind == b"tEXt":
+        return keyword, rest.decode("latin-1")
+    if kind == b"zTXt":
+        return keyword, zlib.decompress(rest[1:]).decode("latin-1")
+    compressed = rest[0]
+    _, _, rest = rest[2:].partition(b"\x00")  # Language tag
+    _, _, rest = rest.partition(b"\x00")      # Translated keyword
+    return keyword, (zlib.decompress(rest) if compressed else rest).decode("utf-8")
+
+
+def read_text_chunks(path):
+    """All text chunks of a PNG as {keyword: text}, reading only chunk headers
+    and text payloads. Returns {} for non-PNG files."""
+    texts = {}
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return texts
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, kind = struct.unpack(">I4s", header)
+            if kind in (b"tEXt", b"zTXt", b"iTXt"):
+                try:
+                    keyword, text = _parse_text(kind, f.read(length))
+                    texts[keyword] = text
+                except (ValueError, IndexError, zlib.error):
+                    pass
+                f.seek(4, os.SEEK_CUR)  # CRC
+            elif kind == b"IEND":
+                break
+            else:
+                f.seek(length + 4, os.SEEK_CUR)
+    return texts
+
+
+def sidecar_path(png_path):
+    return os.path.splitext(png_path)[0] + ".json"
+
+
+def _read_chunk(png_path):
+    try:
+        text = read_text_chunks(png_path).get(META_KEYWORD)
+        return json.loads(text) if text else None
+    except (OSError, ValueError):
+        return None
+
+
+def read_metadata(png_path):
+    """Factory metadata for an image: .json sidecar, else embedded chunk, else None.
+    Same precedence as write_metadata(), so a write is always read back."""
+    try:
+        with open(sidecar_path(png_path), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return _read_chunk(png_path)
+
+
+def _iter_chunks(f):
+    """Yield (kind, raw chunk bytes) after the signature."""
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, kind = struct.unpack(">I4s", header)
+        yield kind, header + f.read(length + 4)
+        if kind == b"IEND":
+            return
+
+
+def copy_with_metadata(src, out, meta):
+    """Copy PNG src into binary file-like out, replacing the embedded metadata.
+    Chunks are copied as-is; pixels are never decoded."""
+    with open(src, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError(f"{src} is not a PNG")
+        out.write(PNG_SIGNATURE)
+        for kind, raw in _iter_chunks(f):
+            if kind == b"IEND":
+                break
+            if kind == b"iTXt" and raw[8:8 + len(META_KEYWORD) + 1] == META_KEYWORD.encode() + b"\x00":
+                continue
+            out.write(raw)
+        out.write(meta_chunk(meta))
+        out.write(IEND_CHUNK)
+
+
+def write_metadata(png_path, meta):
+    """Update an image's metadata where it lives: its sidecar if it has one, and
+    the embedded chunk if it has one (or no sidecar)."""
+    json_path = sidecar_path(png_path)
+    if not os.path.exists(json_path):
+        embed_metadata(png_path, meta)
+        return
+    with open(json_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    if _read_chunk(png_path) is not None:
+        embed_metadata(png_path, meta)  # --metadata both: keep the copy that travels with the PNG current
+
+
+def embed_metadata(png_path, meta):
+    """Rewrite the embedded chunk in place (temp file + os.replace)."""
+    tmp_path = f"{png_path}.tmp"
+    with open(tmp_path, "wb") as out:
+        copy_with_metadata(png_path, out, meta)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, png_path)
+
+
+class PngTextWriter:
+    """Binary file wrapper that appends the metadata chunk to a streamed PNG.
+
+    Everything except the trailing IEND chunk is passed straight through.
+    The metadata usually arrives after the pixels (Forge sends "info" after
+    "images"), so close() before set_metadata() only marks the image complete
+    and set_metadata() then writes chunk + IEND and closes f. Data that does
+    not end in IEND is written unchanged."""
+
+    def __init__(self, f, meta=None):
+        self.f = f
+        self.meta = meta
+        self.tail = b""
+        self.complete = False
+
+    def write(self, data):
+        data = self.tail + bytes(data)
+        if len(data) > len(IEND_CHUNK):
+            self.f.write(data[:-len(IEND_CHUNK)])
+            data = data[-len(IEND_CHUNK):]
+        self.tail = data
+
+    def set_metadata(self, meta):
+        self.meta = meta
+        if self.complete:
+            self._finish()
+
+    def close(self):
+        self.complete = True
+        if self.meta is not None:
+            self._finish()
+
+    def _finish(self):
+        if self.tail == IEND_CHUNK:
+            self.f.write(meta_chunk(self.meta))
+        self.f.write(self.tail)
+        self.tail = b""
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def embed_directory(directory):
+    """Move every .json sidecar in directory into its PNG. Returns images converted."""
+    converted = 0
+    for json_path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        png_path = os.path.splitext(json_path)[0] + ".png"
+        if not os.path.exists(png_path):
+            continue
+        try:
+            with open(json_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        embed_metadata(png_path, meta)
+        os.remove(json_path)
+        converted += 1
+    return converted
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("read", "embed"):
+        print("Usage: png_meta.py read FILE.png [...] | png_meta.py embed DIR")
+        sys.exit(1)
+    if sys.argv[1] == "embed":
+        converted = embed_directory(sys.argv[2])
+        print(f"🏷️ Embedded {converted} sidecars into their PNGs ({sys.argv[2]})")
+        return
+    for path in sys.argv[2:]:
+        print(f"{path}:")
+        for keyword, text in read_text_chunks(path).items():
+            print(f"   {keyword}: {text}")
+
+
+if __name__ == "__main__":
+    main()
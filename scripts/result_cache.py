@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+🗄️ RESULT CACHE - Content-addressed store of rendered images
+=============================================================
+A render is a pure function of its request: same prompt, negative, seed,
+checkpoint and sampler settings (Forge payload) or same ComfyUI graph give
+the same PNGs. The cache keys the finished files on a canonical SHA-256 of
+that request, so repeated requests are served from disk instead of the GPU.
+ComfyUI jobs without a seed get one derived from the request (a Discord user
+re-sending a prompt hits the cache); factory.py draws a fresh seed per job
+for variety, so its cache is opt-in (FACTORY_RESULT_CACHE=true).
+
+Features:
+- Canonical hashing (sorted keys, no whitespace) of payloads / workflow graphs
+- SQLite index with LRU eviction bounded by RESULT_CACHE_MAX_MB
+- Hardlinks in and out of the cache when possible (no extra disk), copies otherwise
+- Requests without an explicit seed are never cached (they are not reproducible)
+
+Usage:
+    cache = ResultCache()
+    key = cache.key(payload)
+    hit = cache.get(key)             # {"paths": [...], "meta": {...}} or None
+    cache.put(key, saved_paths, meta={"all_seeds": [...]})
+
+    python3 scripts/result_cache.py stats
+    python3 scripts/result_cache.py clear
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_CACHE_DIR = os.path.join(os.getenv("FACTORY_DATA_DIR", os.path.join(BASE_DIR, "database")), "result_cache")
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "true").lower() == "true"
+
+
+def canonical_hash(request):
+    """SHA-256 of a JSON-serialisable request, independent of key order and formatting."""
+    blob = json.dumps(request, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """Size-bounded LRU store of output files keyed by canonical request hash."""
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_mb=RESULT_CACHE_MAX_MB, enabled=RESULT_CACHE_ENABLED):
+        self.root = root
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30)
+        conn.execute('''CREATE TABLE IF NOT EXISTS results
+                     (key TEXT PRIMARY KEY, files TEXT NOT NULL, meta TEXT NOT NULL, bytes INTEGER NOT NULL,
+                      hits INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, last_used REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_results_lru ON results (last_used)")
+        return conn
+
+    def key(self, request):
+        """Cache key for a request, or None if it has no explicit seed anywhere."""
+        if not self.enabled or not _has_explicit_seed(request):
+            return None
+        return canonical_hash(request)
+
+    def get(self, key):
+        """Return {"paths": [...], "meta": {...}} for a cached key (and mark it used), else None."""
+        if not key:
+            return None
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    row = conn.execute("SELECT files, meta FROM results WHERE key = ?", (key,)).fetchone()
+                    if row:
+                        paths = [os.path.join(self.root, name) for name in json.loads(row[0])]
+                        if all(os.path.exists(p) for p in paths):
+                            conn.execute("UPDATE results SET hits = hits + 1, last_used = ? WHERE key = ?",
+                                         (time.time(), key))
+                            self.hits += 1
+                            return {"paths": paths, "meta": json.loads(row[1])}
+                        conn.execute("DELETE FROM results WHERE key = ?", (key,))  # Files removed by hand
+            finally:
+                conn.close()
+            self.misses += 1
+            return None
+
+    def put(self, key, paths, meta=None):
+        """Store finished output files under key, then evict LRU entries over budget."""
+        if not key or not paths:
+            return
+        names = []
+        size = 0
+        for idx, src in enumerate(paths):
+            name = f"{key}_{idx}{os.path.splitext(src)[1] or '.png'}"
+            dst = os.path.join(self.root, name)
+            os.makedirs(self.root, exist_ok=True)
+            if not os.path.exists(dst):
+                _link_or_copy(src, dst)
+            names.append(name)
+            size += os.path.getsize(dst)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('''INSERT OR REPLACE INTO results (key, files, meta, bytes, created_at, last_used)
+                                 VALUES (?, ?, ?, ?, ?, ?)''', (key, json.dumps(names), json.dumps(meta or {}), size, now, now))
+                self._evict(conn)
+            finally:
+                conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, files, size in conn.execute("SELECT key, files, bytes FROM results ORDER BY last_used").fetchall():
+            for name in json.loads(files):
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+            with conn:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                return
+
+    @staticmethod
+    def restore(src, dst):
+        """Materialise a cached file at dst (replacing whatever is there)."""
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        tmp_path = f"{dst}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _link_or_copy(src, tmp_path)
+        os.replace(tmp_path, dst)
+
+    def stats(self):
+        """Lifetime numbers from the index: entries, bytes, hits, oldest entry time."""
+        conn = self._connect()
+        try:
+            row = conn.execute('''SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(hits), 0),
+                               MIN(created_at) FROM results''').fetchone()
+        finally:
+            conn.close()
+        return {"entries": row[0], "bytes": row[1], "hits": row[2], "oldest": row[3]}
+
+    def summary(self):
+        if not self.enabled:
+            return "disabled"
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0
+        return f"{self.hits} hits / {self.misses} misses ({rate:.0f}% hit rate)"
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def _has_explicit_seed(request):
+    """True if every "seed" (Forge payload) / "seed"/"noise_seed" input (Comfy graph) is fixed."""
+    seeds = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                if k in ("seed", "noise_seed") and not isinstance(v, (dict, list)):
+                    seeds.append(v)
+                else:
+                    walk(v)
+        elif isinstance(node, list):
+            for v in node:
+                walk(v)
+
+    walk(request)
+    return bool(seeds) and all(isinstance(s, int) and s >= 0 for s in seeds)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    cache = ResultCache()
+    if command == "clear":
+        cache.clear()
+        print(f"🧹 Result cache cleared ({cache.root})")
+        return
+    stats = cache.stats()
+    age = f"{(time.time() - stats['oldest']) / 3600:.1f}h" if stats["oldest"] else "-"
+    print(f"🗄️ Result cache: {cache.root}")
+    print(f"   Entries: {stats['entries']} (oldest {age})")
+    print(f"   Size: {stats['bytes'] / 1024 / 1024:.1f} MB / {cache.max_bytes / 1024 / 1024:.0f} MB")
+    print(f"   Hits served (lifetime): {stats['hits']}")
+
+
+if __name__ == "__main__":
+    main()
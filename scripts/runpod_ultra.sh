@@ -27,6 +27,8 @@ DEFAULT_COUNT=2
 IMAGE_COUNT=$DEFAULT_COUNT
 SKIP_MODEL_DOWNLOAD=false
 VERBOSE=false
+RESUME=""
+REFRESH_CAPABILITIES=false
 
 # === PARSE ARGUMENTS ===
 FACTORY_EXTRA_ARGS=""
@@ -36,6 +38,10 @@ while [[ $# -gt 0 ]]; do
             IMAGE_COUNT="$2"
             shift 2
             ;;
+        --refresh-capabilities)
+            REFRESH_CAPABILITIES=true
+            shift
+            ;;
         --no-model)
             SKIP_MODEL_DOWNLOAD=true
             shift
@@ -56,6 +62,59 @@ while [[ $# -gt 0 ]]; do
             FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --theme \"$2\""
             shift 2
             ;;
+        --pipeline-depth)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --pipeline-depth $2"
+            shift 2
+            ;;
+        --batch-size)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --batch-size $2"
+            shift 2
+            ;;
+        --n-iter)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --n-iter $2"
+            shift 2
+            ;;
+        --single-backend)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --single-backend"
+            shift
+            ;;
+        --models)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --models \"$2\""
+            shift 2
+            ;;
+        --vae)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --vae \"$2\""
+            shift 2
+            ;;
+        --no-affinity)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --no-affinity"
+            shift
+            ;;
+        --resume)
+            RESUME=latest
+            # Optional run id (a bare number stays the legacy image count)
+            if [[ -n "$2" && "$2" != -* && ! "$2" =~ ^[0-9]+$ ]]; then
+                RESUME="$2"
+                shift
+            fi
+            shift
+            ;;
+        --draft)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --draft"
+            shift
+            ;;
+        --draft-threshold)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --draft-threshold $2"
+            shift 2
+            ;;
+        --metadata)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --metadata $2"
+            shift 2
+            ;;
+        --llm-race-width)
+            FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --llm-race-width $2"
+            shift 2
+            ;;
         --verbose|-v)
             VERBOSE=true
             shift
@@ -74,7 +133,20 @@ while [[ $# -gt 0 ]]; do
             echo "  --lora                Enable character LoRA"
             echo "  --theme TEXT          Use a specific theme"
             echo "  --no-hires            Disable Hires Fix (faster, lower quality)"
+            echo "  --pipeline-depth N    Build N prompts ahead while the GPU renders"
+            echo "  --batch-size N        Images per Forge request (0 = auto from VRAM)"
+            echo "  --n-iter N            Sequential batches per Forge request"
+            echo "  --single-backend      Use only the first SD API (default: all Forge instances)"
+            echo "  --models \"a,b\"       Spread the run over several checkpoints"
+            echo "  --vae NAME            VAE to load with the checkpoints"
+            echo "  --no-affinity         Don't group jobs by checkpoint (benchmarking)"
+            echo "  --resume [RUN_ID]     Continue an interrupted factory run (default: the latest)"
+            echo "  --draft               Draft at base res, finalize only curator winners"
+            echo "  --draft-threshold N   Minimum curator score (0-40) to finalize a draft"
+            echo "  --metadata MODE       sidecar | png (embed in PNG, no .json) | both"
+            echo "  --llm-race-width N    LLM requests in flight per prompt (1 = serial fallback)"
             echo "  --no-model            Skip model check"
+            echo "  --refresh-capabilities Rescan checkpoints/LoRAs (automatic after downloads)"
             echo "  --verbose, -v         Show detailed output"
             echo "  --help, -h            Show this help message"
             exit 0
@@ -317,6 +389,10 @@ echo -e "${BLUE}🎨 [4/7] Checking Model Checkpoints...${NC}"
 
 # CivitAI API Key (add to .env for automated downloads)
 CIVITAI_TOKEN="${CIVITAI_TOKEN:-}"
+DOWNLOADED_ASSETS=false  # Set when a checkpoint/LoRA/embedding lands, so factory.py rescans the server
+if [ "$REFRESH_CAPABILITIES" = true ]; then
+    DOWNLOADED_ASSETS=true  # --refresh-capabilities: rescan even without downloads
+fi
 
 if [ "$SKIP_MODEL_DOWNLOAD" = true ]; then
     echo -e "   ${YELLOW}⏭️  Skipping model download (--no-model flag)${NC}"
@@ -339,6 +415,7 @@ else
             FILE_SIZE=$(stat -c%s "$WAI_PATH" 2>/dev/null || stat -f%z "$WAI_PATH" 2>/dev/null || echo "0")
             if [ "$FILE_SIZE" -gt 1000000000 ]; then
                 echo -e "   ${GREEN}✅ WAI-Illustrious downloaded!${NC}"
+                DOWNLOADED_ASSETS=true
             else
                 echo -e "   ${YELLOW}⚠️  WAI download may have failed (${FILE_SIZE} bytes)${NC}"
                 rm -f "$WAI_PATH" 2>/dev/null
@@ -362,6 +439,7 @@ else
             FILE_SIZE=$(stat -c%s "$MODEL_PATH" 2>/dev/null || stat -f%z "$MODEL_PATH" 2>/dev/null || echo "0")
             if [ "$FILE_SIZE" -gt 1000000000 ]; then
                 echo -e "   ${GREEN}✅ OneObsession downloaded!${NC}"
+                DOWNLOADED_ASSETS=true
             else
                 echo -e "   ${YELLOW}⚠️  OneObsession download may have failed${NC}"
                 rm -f "$MODEL_PATH" 2>/dev/null
@@ -437,6 +515,7 @@ else
             "https://civitai.com/api/download/models/2241189?type=Model&format=SafeTensor&token=${CIVITAI_TOKEN}" 2>/dev/null
         if [ -f "$AESTHETIC_LORA" ] && [ "$(stat -c%s "$AESTHETIC_LORA" 2>/dev/null || stat -f%z "$AESTHETIC_LORA" 2>/dev/null || echo "0")" -gt 1000000 ]; then
             echo -e "   ${GREEN}✅ Aesthetic LoRA downloaded${NC}"
+            DOWNLOADED_ASSETS=true
         else
             echo -e "   ${YELLOW}⚠️  Aesthetic LoRA download may have failed${NC}"
             rm -f "$AESTHETIC_LORA" 2>/dev/null
@@ -461,7 +540,7 @@ echo -e "   ${CYAN}⬇️  Downloading Lazy Embeddings...${NC}"
 if [ ! -f "$EMBEDDING_DIR/lazypos.safetensors" ] && [ -n "$CIVITAI_TOKEN" ]; then
     curl -L -o "$EMBEDDING_DIR/lazypos.safetensors" \
         "https://civitai.com/api/download/models/1268948?type=Model&format=SafeTensor&token=${CIVITAI_TOKEN}" 2>/dev/null && \
-    echo -e "   ${GREEN}✅ lazypos downloaded${NC}"
+    echo -e "   ${GREEN}✅ lazypos downloaded${NC}" && DOWNLOADED_ASSETS=true
 else
     echo -e "   ${GREEN}✅ lazypos found${NC}"
 fi
@@ -469,7 +548,7 @@ fi
 if [ ! -f "$EMBEDDING_DIR/lazyneg.safetensors" ] && [ -n "$CIVITAI_TOKEN" ]; then
     curl -L -o "$EMBEDDING_DIR/lazyneg.safetensors" \
         "https://civitai.com/api/download/models/1268949?type=Model&format=SafeTensor&token=${CIVITAI_TOKEN}" 2>/dev/null && \
-    echo -e "   ${GREEN}✅ lazyneg downloaded${NC}"
+    echo -e "   ${GREEN}✅ lazyneg downloaded${NC}" && DOWNLOADED_ASSETS=true
 else
     echo -e "   ${GREEN}✅ lazyneg found${NC}"
 fi
@@ -481,7 +560,7 @@ if [ ! -f "$PERFECT_EYES" ]; then
     echo -e "   ${CYAN}⬇️  Downloading Perfect Eyes LoRA...${NC}"
     curl -L -o "$PERFECT_EYES" \
         "https://civitai.com/api/download/models/2066663?type=Model&format=SafeTensor&token=${CIVITAI_TOKEN}" 2>/dev/null && \
-    echo -e "   ${GREEN}✅ Perfect Eyes downloaded${NC}"
+    echo -e "   ${GREEN}✅ Perfect Eyes downloaded${NC}" && DOWNLOADED_ASSETS=true
 else
     echo -e "   ${GREEN}✅ Perfect Eyes LoRA found${NC}"
 fi
@@ -492,7 +571,7 @@ if [ ! -f "$PERFECT_HANDS" ]; then
     echo -e "   ${CYAN}⬇️  Downloading Perfect Hands LoRA...${NC}"
     curl -L -o "$PERFECT_HANDS" \
         "https://civitai.com/api/download/models/2062094?type=Model&format=SafeTensor&token=${CIVITAI_TOKEN}" 2>/dev/null && \
-    echo -e "   ${GREEN}✅ Perfect Hands downloaded${NC}"
+    echo -e "   ${GREEN}✅ Perfect Hands downloaded${NC}" && DOWNLOADED_ASSETS=true
 else
     echo -e "   ${GREEN}✅ Perfect Hands LoRA found${NC}"
 fi
@@ -623,6 +702,35 @@ cd "$WORK_DIR"
 # Create batch folder
 BATCH_ID=$(date +"%Y%m%d_%H%M%S")
 BATCH_DIR="content/batch_${BATCH_ID}"
+if [ -n "$RESUME" ]; then
+    # factory.py restores the old run's --output; package that folder, not a new one
+    RESUME_INFO=$(python3 - "${FACTORY_DATA_DIR:-$WORK_DIR/database}/job_queue.db" "$RESUME" <<'EOF'
+import sys, json, sqlite3, os
+db, run_id = sys.argv[1], sys.argv[2]
+if not os.path.exists(db):
+    sys.exit(0)  # Nothing to resume: empty output, handled below
+conn = sqlite3.connect(db)
+if run_id == "latest":
+    row = conn.execute("SELECT id, settings FROM runs WHERE status = 'running' ORDER BY created_at DESC LIMIT 1").fetchone()
+else:
+    row = conn.execute("SELECT id, settings FROM runs WHERE id = ?", (run_id,)).fetchone()
+if not row:
+    sys.exit(0)
+print(row[0], json.loads(row[1]).get("output") or "")
+EOF
+) || true  # Unreadable DB: same "nothing to resume" message, not the ERR trap
+    if [ -z "$RESUME_INFO" ]; then
+        echo -e "${RED}❌ No factory run to resume ($RESUME)${NC}"
+        exit 1
+    fi
+    RESUME_ID="${RESUME_INFO%% *}"
+    RESUME_OUTPUT="${RESUME_INFO#* }"
+    FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --resume $RESUME_ID"
+    BATCH_DIR="${RESUME_OUTPUT:-content/raw}"  # No --output: factory.py's default
+    BATCH_ID=$(basename "$BATCH_DIR")
+    BATCH_ID="${BATCH_ID#batch_}"
+    echo -e "   ${CYAN}♻️  Resuming run $RESUME_ID${NC}"
+fi
 mkdir -p "$BATCH_DIR"
 
 echo -e "   ${CYAN}📋 Configuration:${NC}"
@@ -632,6 +740,10 @@ echo "      - API endpoint: $REFORGE_API"
 echo ""
 
 # Run factory with all flags
+# Rescan the server only if models/LoRAs were downloaded above; otherwise the cached snapshot (TTL) is used
+if [ "$DOWNLOADED_ASSETS" = true ]; then
+    FACTORY_EXTRA_ARGS="$FACTORY_EXTRA_ARGS --refresh-capabilities"
+fi
 eval python3 scripts/factory.py --count "$IMAGE_COUNT" --output "$BATCH_DIR" $FACTORY_EXTRA_ARGS
 GEN_EXIT_CODE=$?
 
@@ -0,0 +1,91 @@
+"""Resume path of factory.py: JobQueue bookkeeping, make_job and recover_rendered."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+# factory.py reads its data dir at import time: keep caches and the queue out of database/
+DATA_DIR = tempfile.mkdtemp(prefix="factory_test_")
+os.environ["FACTORY_DATA_DIR"] = DATA_DIR
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from factory import JobQueue, make_job, recover_rendered
+from png_meta import PngTextWriter
+from test_png_meta import tiny_png
+
+
+def tearDownModule():
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+PLAN = [(2, 1, "oneObsession_v19", None), (1, 1, "oneObsession_v19", None), (1, 2, "wai_v14", "sdxl_vae")]
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(dir=DATA_DIR)
+        self.queue = JobQueue(os.path.join(self.tmp.name, "job_queue.db"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_resume_renders_only_unfinished_jobs(self):
+        run_id = self.queue.create_run({"count": 5, "theme": "Beach"}, PLAN)
+        first, second, third = self.queue.pending(run_id)
+        self.assertEqual([e["request"] for e in (first, second, third)], PLAN)
+        self.assertIsNone(first["job"])
+
+        job = {"id": first["id"], "prompt": "1girl, beach", "negative_prompt": "lowres", "seed": 1234,
+               "batch_size": 2, "n_iter": 1, "model": "oneObsession_v19", "vae": None}
+        self.queue.assemble(first["id"], job)
+        self.queue.mark_dispatched(first["id"])
+        self.queue.assemble(second["id"], dict(job, id=second["id"], seed=99))
+        self.queue.mark_done(second["id"], 1)
+        # Crash here: first was dispatched but never written, third never assembled
+
+        self.assertEqual(self.queue.load_run(), (run_id, {"count": 5, "theme": "Beach"}))
+        self.assertEqual(self.queue.progress(run_id), (1, 5))
+        resumed = self.queue.pending(run_id)
+        self.assertEqual([e["id"] for e in resumed], [first["id"], third["id"]])
+
+        # Same prompt and seed as before the crash, no LLM call
+        rebuilt = make_job(None, None, resumed[0])
+        self.assertEqual(rebuilt, job)
+        self.assertIsNone(resumed[1]["job"])
+
+    def test_finished_run_is_not_resumed(self):
+        run_id = self.queue.create_run({"count": 1}, PLAN[:1])
+        entry, = self.queue.pending(run_id)
+        self.queue.mark_done(entry["id"], 2)
+        self.queue.finish(run_id)
+
+        self.assertEqual(self.queue.pending(run_id), [])
+        self.assertIsNone(self.queue.load_run())
+        self.assertEqual(self.queue.load_run(run_id), (run_id, {"count": 1}))
+
+    def test_load_run_without_database(self):
+        self.assertIsNone(self.queue.load_run())
+        self.assertFalse(os.path.exists(self.queue.path))
+
+    def test_disabled_queue_records_nothing(self):
+        queue = JobQueue(self.queue.path, enabled=False)
+        self.assertIsNone(queue.create_run({}, PLAN))
+        self.assertFalse(os.path.exists(queue.path))
+
+    def test_recover_rendered(self):
+        # Images saved (with metadata) before the queue row was marked done
+        job = {"seed": 1234, "batch_size": 2, "n_iter": 1}
+        for idx in range(2):
+            path = os.path.join(self.tmp.name, f"lady_nuggets_20260101_000000_1234_{idx}_ab12.png")
+            if idx == 1:
+                self.assertFalse(recover_rendered(job, self.tmp.name))
+            with PngTextWriter(open(path, "wb"), {"seed": 1234}) as f:
+                f.write(tiny_png())
+        self.assertTrue(recover_rendered(job, self.tmp.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Round trips for scripts/png_meta.py: streamed embed, sidecar/chunk updates."""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from png_meta import (PNG_SIGNATURE, IEND_CHUNK, PngTextWriter, _chunk, embed_directory,
+                      read_metadata, read_text_chunks, sidecar_path, write_metadata)
+
+
+def tiny_png():
+    """1x1 RGB PNG, built by hand so the tests don't need Pillow."""
+    ihdr = _chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    idat = _chunk(b"IDAT", zlib.compress(b"\x00\xff\x00\x00"))
+    return PNG_SIGNATURE + ihdr + idat + IEND_CHUNK
+
+
+def chunk_kinds(path):
+    kinds = []
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        kinds.append(kind)
+        pos += length + 12
+    return kinds
+
+
+class PngMetaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.png = os.path.join(self.tmp.name, "lady_nuggets_20260101_000000_42_0.png")
+        self.meta = {"prompt": "1girl, beach, ✨", "seed": 42}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_png(self, meta=None):
+        with PngTextWriter(open(self.png, "wb"), meta) as f:
+            f.write(tiny_png())
+
+    def test_streamed_write_reads_back(self):
+        # Forge order: pixels first (in pieces), metadata after close()
+        data = tiny_png()
+        writer = PngTextWriter(open(self.png, "wb"))
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        writer.close()
+        writer.set_metadata(self.meta)
+
+        self.assertEqual(read_metadata(self.png), self.meta)
+        self.assertEqual(chunk_kinds(self.png), [b"IHDR", b"IDAT", b"iTXt", b"IEND"])
+        self.assertFalse(os.path.exists(sidecar_path(self.png)))
+
+    def test_write_metadata_embedded_only(self):
+        self.write_png(self.meta)
+        write_metadata(self.png, dict(self.meta, score=31))
+
+        self.assertEqual(read_metadata(self.png), dict(self.meta, score=31))
+        self.assertEqual(chunk_kinds(self.png).count(b"iTXt"), 1)
+        self.assertFalse(os.path.exists(sidecar_path(self.png)))
+
+    def test_write_metadata_sidecar_only(self):
+        self.write_png()
+        with open(sidecar_path(self.png), "w") as f:
+            json.dump(self.meta, f)
+        write_metadata(self.png, dict(self.meta, score=12))
+
+        self.assertEqual(read_metadata(self.png), dict(self.meta, score=12))
+        self.assertNotIn("lady_nuggets", read_text_chunks(self.png))
+
+    def test_write_metadata_both(self):
+        # --metadata both: a write must update the sidecar and the embedded copy
+        self.write_png(self.meta)
+        with open(sidecar_path(self.png), "w") as f:
+            json.dump(self.meta, f)
+        write_metadata(self.png, dict(self.meta, score=35))
+
+        self.assertEqual(read_metadata(self.png), dict(self.meta, score=35))
+        os.remove(sidecar_path(self.png))
+        self.assertEqual(read_metadata(self.png), dict(self.meta, score=35))
+
+    def test_embed_directory(self):
+        self.write_png()
+        with open(sidecar_path(self.png), "w") as f:
+            json.dump(self.meta, f)
+
+        self.assertEqual(embed_directory(self.tmp.name), 1)
+        self.assertFalse(os.path.exists(sidecar_path(self.png)))
+        self.assertEqual(read_metadata(self.png), self.meta)
+
+    def test_no_metadata(self):
+        self.write_png()
+        self.assertIsNone(read_metadata(self.png))
+        not_png = os.path.join(self.tmp.name, "notes.png")
+        with open(not_png, "wb") as f:
+            f.write(b"not a png")
+        self.assertIsNone(read_metadata(not_png))
+
+
+if __name__ == "__main__":
+    unittest.main()
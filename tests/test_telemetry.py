@@ -0,0 +1,173 @@
+"""Per-stage telemetry of factory.py: Tracer JSONL spans, the run report,
+timed_chunks and forge_client's ProgressMonitor phase split."""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from contextlib import redirect_stdout
+
+DATA_DIR = tempfile.mkdtemp(prefix="factory_test_")
+os.environ["FACTORY_DATA_DIR"] = DATA_DIR
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import factory
+from factory import Tracer, percentile, run_report, timed_chunks
+from forge_client import ProgressMonitor
+
+
+def tearDownModule():
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+def read_spans(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(dir=DATA_DIR)
+        self.path = os.path.join(self.tmp.name, "telemetry.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_span_format(self):
+        tracer = Tracer(self.path)
+        tracer.run_id = "20260101_000000"
+        with tracer.job(7):
+            with tracer.span("job", model="wai_v14") as span:
+                span["images"] = 2
+            tracer.record("transfer", 0.25, start=1000.0, backend="http://127.0.0.1:7861")
+        tracer.record("llm", 1.5)
+
+        job, transfer, llm = read_spans(self.path)
+        self.assertEqual(set(job), {"run", "job", "stage", "start", "seconds", "model", "images"})
+        self.assertEqual((job["run"], job["job"], job["stage"], job["model"], job["images"]),
+                         ("20260101_000000", 7, "job", "wai_v14", 2))
+        self.assertGreaterEqual(job["seconds"], 0)
+        self.assertEqual(transfer, {"run": "20260101_000000", "job": 7, "stage": "transfer", "start": 1000.0,
+                                    "seconds": 0.25, "backend": "http://127.0.0.1:7861"})
+        self.assertIsNone(llm["job"])  # Outside tracer.job()
+
+    def test_job_is_bound_per_thread(self):
+        tracer = Tracer(self.path)
+        ready, done = threading.Event(), threading.Event()
+
+        def worker():
+            with tracer.job(2):
+                ready.set()
+                done.wait(5)
+                tracer.record("sampling", 3.0)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        ready.wait(5)
+        with tracer.job(1):
+            tracer.record("prompt", 0.5)
+        done.set()
+        thread.join()
+
+        self.assertEqual({(s["stage"], s["job"]) for s in read_spans(self.path)}, {("prompt", 1), ("sampling", 2)})
+
+    def test_disabled(self):
+        tracer = Tracer(self.path, enabled=False)
+        with tracer.span("job"):
+            pass
+        self.assertFalse(os.path.exists(self.path))
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory(dir=DATA_DIR)
+        self.path = os.path.join(self.tmp.name, "telemetry.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def report(self, run=None):
+        out = io.StringIO()
+        with mock.patch.object(factory, "TRACE_FILE", self.path), redirect_stdout(out):
+            run_report(SimpleNamespace(run=run))
+        return out.getvalue()
+
+    def test_percentile(self):
+        values = list(range(100, 0, -1))  # Unsorted on purpose
+        self.assertEqual(percentile(values, 50), 51)
+        self.assertEqual(percentile(values, 95), 96)
+        self.assertEqual(percentile(values, 99), 100)
+        self.assertEqual(percentile([4.0], 99), 4.0)
+
+    def test_report_percentiles_and_throughput(self):
+        tracer = Tracer(self.path)
+        tracer.run_id = "old"
+        tracer.record("sampling", 99.0, start=0.0)
+        tracer.run_id = "new"
+        for i in range(100):
+            tracer.record("sampling", (i + 1) / 10, start=1000.0 + i)
+        tracer.record("job", 3600.0, start=1000.0, images=50)
+
+        lines = {line.split()[0]: line.split() for line in self.report().splitlines() if line.strip()}
+        self.assertEqual(lines["sampling"][1:], ["100", "5.10s", "9.60s", "10.00s", "505.0s"])
+        self.assertEqual(lines["job"][1:], ["1", "3600.00s", "3600.00s", "3600.00s", "3600.0s"])
+        self.assertIn("Images: 50 in 3600s wall → 50.0 images/hour", self.report())
+        self.assertIn("99.00s", self.report(run="old"))  # --run picks an older run
+
+
+class TimedChunksTest(unittest.TestCase):
+
+    def test_passes_chunks_and_counts_wait(self):
+        def slow():
+            for chunk in (b"ab", b"cd"):
+                threading.Event().wait(0.02)
+                yield chunk
+
+        timings = {"transfer": 0.0}
+        self.assertEqual(b"".join(timed_chunks(slow(), timings)), b"abcd")
+        self.assertGreaterEqual(timings["transfer"], 0.035)
+
+
+class FakeForge:
+    """Answers /sdapi/v1/progress from a script of states, then reports idle."""
+
+    def __init__(self, states):
+        self.states = list(states)
+        self.idle_polls = 0
+        self.finished = threading.Event()
+
+    def get(self, path, params=None):
+        if self.states:
+            state = self.states.pop(0)
+        else:
+            state = {"job_count": 0}
+            self.idle_polls += 1
+            if self.idle_polls > 1:  # The first idle poll has been handled
+                self.finished.set()
+        return SimpleNamespace(json=lambda: {"progress": 0, "state": state})
+
+
+class ProgressMonitorTest(unittest.TestCase):
+
+    def test_phases(self):
+        queued = [{"job_count": 1, "sampling_step": 0, "sampling_steps": 0}] * 3
+        sampling = [{"job_count": 1, "sampling_step": s, "sampling_steps": 20} for s in (1, 10, 20)]
+        hires = [{"job_count": 1, "sampling_step": s, "sampling_steps": 10} for s in (1, 5, 10)]
+        forge = FakeForge(queued + sampling + hires)
+
+        with ProgressMonitor(forge, ["sampling", "hires"], interval=0.01) as monitor:
+            self.assertTrue(forge.finished.wait(5))
+        self.assertEqual(list(monitor.phases), ["queue_wait", "sampling", "hires", "postprocess"])
+        self.assertTrue(all(seconds >= 0 for seconds in monitor.phases.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,7 +14,8 @@ def http_json(method: str, url: str, payload=None):
     data = None
     headers = {}
     if payload is not None:
-        data = json.dumps(payload).encode("utf-8")
+        # Canonical JSON: unchanged nodes are byte-identical from one run to the next
+        data = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")
         headers["Content-Type"] = "application/json"
     req = urllib.request.Request(url, data=data, headers=headers, method=method)
     with urllib.request.urlopen(req, timeout=180) as r:
@@ -88,7 +89,11 @@ def main():
     print(f"[test] target_ckpt={target_ckpt}")
     print(f"[test] target_upscaler={target_upscaler} can_hq={can_hq}")
 
-    wf = json.loads(workflow_file.read_text())
+    # _meta is UI-only; ComfyUI's execution cache keys on class_type + inputs
+    wf = {
+        node_id: {k: v for k, v in node.items() if k != "_meta"}
+        for node_id, node in json.loads(workflow_file.read_text()).items()
+    }
     wf["1"]["inputs"]["ckpt_name"] = target_ckpt
     wf["10"]["inputs"]["model_name"] = target_upscaler
     wf["2"]["inputs"]["batch_size"] = 1
@@ -169,6 +174,13 @@ def main():
         print("[test] timeout waiting for comfy history")
         sys.exit(2)
 
+    # Nodes ComfyUI reused from its execution cache (same inputs as the previous prompt)
+    cached_nodes = []
+    for message in result.get("status", {}).get("messages", []):
+        if message[0] == "execution_cached":
+            cached_nodes = message[1].get("nodes", [])
+    print(f"[test] cached_nodes={sorted(cached_nodes, key=str)} ({len(cached_nodes)}/{len(wf)} from cache)")
+
     images = []
     for node in result.get("outputs", {}).values():
         for img in node.get("images", []):